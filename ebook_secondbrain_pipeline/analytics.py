@@ -0,0 +1,349 @@
+from __future__ import annotations
+
+import argparse
+import sqlite3
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import instrumentation
+from instrumentation import span
+import warehouse
+
+
+# -----------------------------
+# Aggregate tables (in the warehouse database)
+# -----------------------------
+# Rows are keyed by book; chapter_id 0 stands for "no chapter". A highlight
+# is dated by its creation time, falling back to the last modification.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS agg_books (
+    book_id         INTEGER PRIMARY KEY,
+    highlights      INTEGER NOT NULL,
+    notes           INTEGER NOT NULL,
+    chapters        INTEGER NOT NULL,
+    first_highlight TEXT,
+    last_highlight  TEXT
+);
+
+CREATE TABLE IF NOT EXISTS agg_chapters (
+    book_id         INTEGER NOT NULL,
+    chapter_id      INTEGER NOT NULL,
+    highlights      INTEGER NOT NULL,
+    first_highlight TEXT,
+    last_highlight  TEXT,
+    PRIMARY KEY (book_id, chapter_id)
+);
+
+CREATE TABLE IF NOT EXISTS agg_colors (
+    book_id    INTEGER NOT NULL,
+    chapter_id INTEGER NOT NULL,
+    style      INTEGER NOT NULL,
+    highlights INTEGER NOT NULL,
+    PRIMARY KEY (book_id, chapter_id, style)
+);
+
+CREATE TABLE IF NOT EXISTS agg_days (
+    day        TEXT NOT NULL,
+    book_id    INTEGER NOT NULL,
+    highlights INTEGER NOT NULL,
+    PRIMARY KEY (day, book_id)
+);
+CREATE INDEX IF NOT EXISTS agg_days_book ON agg_days(book_id);
+
+CREATE TABLE IF NOT EXISTS agg_state (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+TABLES = ["agg_books", "agg_chapters", "agg_colors", "agg_days"]
+
+HIGHLIGHT_TIME = "COALESCE(a.created, a.modified)"
+
+# table -> SELECT producing its rows; {where} scopes it to a set of books
+AGGREGATE_QUERIES = {
+    "agg_books": f"""
+        SELECT a.book_id, COUNT(*), SUM(a.note IS NOT NULL AND a.note != ''),
+               COUNT(DISTINCT COALESCE(a.chapter_id, 0)),
+               MIN({HIGHLIGHT_TIME}), MAX({HIGHLIGHT_TIME})
+        FROM annotations a WHERE a.deleted = 0 {{where}}
+        GROUP BY a.book_id
+    """,
+    "agg_chapters": f"""
+        SELECT a.book_id, COALESCE(a.chapter_id, 0), COUNT(*),
+               MIN({HIGHLIGHT_TIME}), MAX({HIGHLIGHT_TIME})
+        FROM annotations a WHERE a.deleted = 0 {{where}}
+        GROUP BY a.book_id, COALESCE(a.chapter_id, 0)
+    """,
+    "agg_colors": """
+        SELECT a.book_id, COALESCE(a.chapter_id, 0), a.style, COUNT(*)
+        FROM annotations a WHERE a.deleted = 0 AND a.style IS NOT NULL {where}
+        GROUP BY a.book_id, COALESCE(a.chapter_id, 0), a.style
+    """,
+    "agg_days": f"""
+        SELECT substr({HIGHLIGHT_TIME}, 1, 10), a.book_id, COUNT(*)
+        FROM annotations a WHERE a.deleted = 0 AND {HIGHLIGHT_TIME} IS NOT NULL {{where}}
+        GROUP BY substr({HIGHLIGHT_TIME}, 1, 10), a.book_id
+    """,
+}
+
+
+def connect(path=warehouse.WAREHOUSE_PATH) -> sqlite3.Connection:
+    conn = warehouse.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_watermark(conn: sqlite3.Connection) -> str:
+    row = conn.execute("SELECT value FROM agg_state WHERE key = 'watermark'").fetchone()
+    return row["value"] if row else ""
+
+
+def set_watermark(conn: sqlite3.Connection, stamp: str) -> None:
+    conn.execute(
+        "INSERT INTO agg_state (key, value) VALUES ('watermark', ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (stamp,),
+    )
+
+
+# -----------------------------
+# Maintenance
+# -----------------------------
+def _scope(book_ids: List[int]) -> Tuple[str, list]:
+    return f"AND a.book_id IN ({','.join('?' * len(book_ids))})", list(book_ids)
+
+
+def refresh_books(conn: sqlite3.Connection, book_ids: List[int]) -> None:
+    """
+    Recompute the aggregate rows of ``book_ids`` (and only those).
+    """
+    where, params = _scope(book_ids)
+    for table, query in AGGREGATE_QUERIES.items():
+        conn.execute(f"DELETE FROM {table} WHERE book_id IN ({','.join('?' * len(params))})", params)
+        rows = conn.execute(query.format(where=where), params).fetchall()
+        if rows:
+            conn.executemany(f"INSERT INTO {table} VALUES ({','.join('?' * len(rows[0]))})", rows)
+
+
+def refresh(conn: sqlite3.Connection, chunk: int = 500) -> int:
+    """
+    Bring the aggregates up to date with the annotations changed (inserted,
+    edited or soft-deleted) since the last refresh. Returns the number of
+    books recomputed. Only touched books are read, via the
+    (book_id, updated_at) index.
+    """
+    since = get_watermark(conn)
+    stamp = conn.execute("SELECT MAX(updated_at) FROM annotations").fetchone()[0]
+    if stamp is None or stamp <= since:
+        return 0
+
+    book_ids = [
+        row[0] for row in conn.execute(
+            "SELECT DISTINCT book_id FROM annotations WHERE updated_at > ? AND updated_at <= ?",
+            (since, stamp),
+        )
+    ]
+    with conn, span("analytics.refresh"):
+        for i in range(0, len(book_ids), chunk):
+            refresh_books(conn, book_ids[i:i + chunk])
+        set_watermark(conn, stamp)
+
+    instrumentation.incr("analytics.books_refreshed", len(book_ids))
+    return len(book_ids)
+
+
+def rebuild(conn: sqlite3.Connection) -> None:
+    """
+    Recompute every aggregate from zero.
+    """
+    with conn, span("analytics.rebuild"):
+        for table in TABLES:
+            conn.execute(f"DELETE FROM {table}")
+        for table, query in AGGREGATE_QUERIES.items():
+            conn.execute(f"INSERT INTO {table} {query.format(where='')}")
+        stamp = conn.execute("SELECT MAX(updated_at) FROM annotations").fetchone()[0]
+        set_watermark(conn, stamp or "")
+
+
+def check(conn: sqlite3.Connection) -> Dict[str, int]:
+    """
+    Compare the stored aggregates with a from-scratch recomputation;
+    returns the number of differing rows per table (all 0 when consistent).
+    """
+    mismatches = {}
+    for table, query in AGGREGATE_QUERIES.items():
+        fresh = {tuple(row) for row in conn.execute(query.format(where=""))}
+        stored = {tuple(row) for row in conn.execute(f"SELECT * FROM {table}")}
+        mismatches[table] = len(fresh ^ stored)
+    return mismatches
+
+
+# -----------------------------
+# Reads
+# -----------------------------
+def book_rows(conn: sqlite3.Connection, source: Optional[str] = None) -> List[sqlite3.Row]:
+    sql = """
+        SELECT b.id, b.title, b.author, b.external_id, b.date_added, b.date_finished,
+               s.name AS source, g.highlights, g.notes, g.chapters,
+               g.first_highlight, g.last_highlight
+        FROM agg_books g
+        JOIN books b ON b.id = g.book_id
+        JOIN sources s ON s.id = b.source_id
+    """
+    if source:
+        return conn.execute(sql + " WHERE s.name = ? ORDER BY g.highlights DESC", (source,)).fetchall()
+    return conn.execute(sql + " ORDER BY g.highlights DESC").fetchall()
+
+
+def chapter_rows(conn: sqlite3.Connection, book_id: int) -> List[dict]:
+    colors: Dict[int, List[int]] = {}
+    for row in conn.execute(
+        "SELECT chapter_id, style FROM agg_colors WHERE book_id = ? ORDER BY style", (book_id,)
+    ):
+        colors.setdefault(row["chapter_id"], []).append(row["style"])
+
+    return [
+        {**dict(row), "colors_used": colors.get(row["chapter_id"], [])}
+        for row in conn.execute(
+            """
+            SELECT g.chapter_id, COALESCE(c.title, 'Unknown') AS chapter, g.highlights,
+                   g.first_highlight, g.last_highlight
+            FROM agg_chapters g LEFT JOIN chapters c ON c.id = g.chapter_id
+            WHERE g.book_id = ?
+            ORDER BY chapter
+            """,
+            (book_id,),
+        )
+    ]
+
+
+def daily_counts(conn: sqlite3.Connection, since: Optional[str] = None) -> List[Tuple[str, int]]:
+    return [
+        (row[0], row[1]) for row in conn.execute(
+            "SELECT day, SUM(highlights) FROM agg_days WHERE day >= ? GROUP BY day ORDER BY day",
+            (since or "",),
+        )
+    ]
+
+
+def streaks(days: Iterable[str], today: Optional[date] = None) -> Dict[str, int]:
+    """
+    Longest run of consecutive highlight days, and the run ending today
+    (or yesterday, so an evening without reading yet does not reset it).
+    """
+    parsed = sorted({date.fromisoformat(d) for d in days})
+    today = today or date.today()
+
+    longest = run = 0
+    previous = None
+    for day in parsed:
+        run = run + 1 if previous is not None and day - previous == timedelta(days=1) else 1
+        longest = max(longest, run)
+        previous = day
+
+    current = run if previous is not None and today - previous <= timedelta(days=1) else 0
+    return {"longest": longest, "current": current, "days": len(parsed)}
+
+
+def summary_document(conn: sqlite3.Connection) -> List[dict]:
+    """
+    The per-book/per-chapter summary of ``inspect_ibooks.summarize_annotations``
+    for iBooks books, read from the aggregates.
+    """
+    return [
+        {
+            "book_id": book["external_id"],
+            "title": book["title"] or "Unknown",
+            "author": book["author"] or "Unknown",
+            "date_added": book["date_added"],
+            "date_finished": book["date_finished"],
+            "chapters": [
+                {
+                    "chapter": ch["chapter"],
+                    "highlights_count": ch["highlights"],
+                    "colors_used": ch["colors_used"],
+                    "first_highlight": ch["first_highlight"],
+                    "last_highlight": ch["last_highlight"],
+                }
+                for ch in chapter_rows(conn, book["id"])
+            ],
+        }
+        for book in book_rows(conn, source="ibooks")
+    ]
+
+
+# -----------------------------
+# CLI
+# -----------------------------
+def print_books(conn: sqlite3.Connection, limit: int) -> None:
+    for row in book_rows(conn)[:limit]:
+        period = f"{(row['first_highlight'] or '')[:10]} – {(row['last_highlight'] or '')[:10]}"
+        print(f"{row['highlights']:>6}  {row['notes']:>4} notes  {row['chapters']:>3} ch  "
+              f"{period:<23}  {row['title']} [{row['source']}]")
+
+
+def print_chapters(conn: sqlite3.Connection, title: str) -> None:
+    book = warehouse.find_book(conn, title)
+    if book is None:
+        raise SystemExit(f"❌ No book matching '{title}'")
+    print(f"📖 {book['title']}")
+    for ch in chapter_rows(conn, book["id"]):
+        colors = ",".join(str(c) for c in ch["colors_used"])
+        print(f"{ch['highlights']:>6}  [{colors}]  {ch['chapter']}")
+
+
+def print_days(conn: sqlite3.Connection, days: int) -> None:
+    since = (date.today() - timedelta(days=days - 1)).isoformat()
+    counts = daily_counts(conn)
+    for day, n in counts:
+        if day >= since:
+            print(f"{day}  {n:>5}  {'█' * min(n, 60)}")
+    s = streaks(day for day, _ in counts)
+    print(f"🔥 Current streak: {s['current']} day(s), longest: {s['longest']}, "
+          f"{s['days']} day(s) with highlights")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Reading analytics from incrementally maintained aggregates.")
+    parser.add_argument("--book", help="per-chapter counts and colours for this title")
+    parser.add_argument("--days", type=int, default=14, help="highlights per day for the last N days")
+    parser.add_argument("--limit", type=int, default=20, help="books listed")
+    parser.add_argument("--rebuild", action="store_true", help="recompute all aggregates from zero")
+    parser.add_argument("--check", action="store_true", help="compare the aggregates with a full recomputation")
+    instrumentation.add_profile_args(parser)
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.enable("analytics", trace_memory=args.trace_memory)
+
+    conn = connect()
+
+    if args.rebuild:
+        rebuild(conn)
+        print("✔ Aggregates rebuilt")
+    else:
+        refreshed = refresh(conn)
+        if refreshed:
+            print(f"✔ {refreshed} book(s) refreshed")
+
+    if args.check:
+        with span("analytics.check"):
+            mismatches = check(conn)
+        for table, n in mismatches.items():
+            print(f"{'✅' if not n else '❌'} {table}: {n} differing row(s)")
+        if any(mismatches.values()):
+            raise SystemExit(1)
+    elif args.book:
+        print_chapters(conn, args.book)
+    else:
+        print_books(conn, args.limit)
+        print()
+        print_days(conn, args.days)
+
+    conn.close()
+    instrumentation.finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+from urllib.parse import unquote
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from paths import DERIVED_DATA_DIR
+
+
+# -----------------------------
+# Locations
+# -----------------------------
+STORE_DIR = DERIVED_DATA_DIR / "parquet"
+ANNOTATIONS_DIR = STORE_DIR / "annotations"
+BOOKS_PATH = STORE_DIR / "books.parquet"
+
+
+# -----------------------------
+# Schemas
+# -----------------------------
+# Low-cardinality strings are dictionary-encoded (pandas: category).
+ANNOTATION_SCHEMA = pa.schema([
+    ("book_id", pa.string()),
+    ("highlight", pa.string()),
+    ("note", pa.string()),
+    ("chapter", pa.dictionary(pa.int32(), pa.string())),
+    ("chapter_hint", pa.dictionary(pa.int32(), pa.string())),
+    ("location", pa.string()),
+    ("color", pa.int16()),
+    ("start_loc", pa.float64()),
+    ("end_loc", pa.float64()),
+    ("created", pa.timestamp("us")),
+    ("modified", pa.timestamp("us")),
+])
+
+BOOK_SCHEMA = pa.schema([
+    ("book_id", pa.string()),
+    ("title", pa.string()),
+    ("author", pa.dictionary(pa.int32(), pa.string())),
+    ("date_added", pa.timestamp("us")),
+    ("date_finished", pa.timestamp("us")),
+])
+
+
+# -----------------------------
+# Write
+# -----------------------------
+def write_store(books: Dict[str, dict], store_dir: Path = STORE_DIR) -> int:
+    """
+    Write ``books`` (asset_id -> book dict as built by ``epub_parser``)
+    as a books table plus an annotations dataset partitioned by book_id.
+
+    ``books`` is the whole library: partitions of books with annotations
+    are replaced, those of books now absent or empty are deleted.
+    Returns the number of annotation rows written.
+    """
+    annotations_dir = store_dir / "annotations"
+    annotations_dir.mkdir(parents=True, exist_ok=True)
+
+    book_rows = []
+    annotation_rows = []
+
+    for book_id, book in books.items():
+        book_rows.append({
+            "book_id": book_id,
+            "title": book["title"],
+            "author": book["author"],
+            "date_added": book.get("date_added"),
+            "date_finished": book.get("date_finished"),
+        })
+        for a in book["annotations"]:
+            annotation_rows.append({
+                "book_id": book_id,
+                "highlight": a.get("highlight"),
+                "note": a.get("note"),
+                "chapter": a.get("chapter"),
+                "chapter_hint": a.get("chapter_hint"),
+                "location": a.get("loc_text"),
+                "color": a.get("style"),
+                "start_loc": a.get("start_loc"),
+                "end_loc": a.get("end_loc"),
+                "created": a.get("created"),
+                "modified": a.get("modified"),
+            })
+
+    pq.write_table(pa.Table.from_pylist(book_rows, schema=BOOK_SCHEMA), store_dir / "books.parquet")
+
+    if annotation_rows:
+        pq.write_to_dataset(
+            pa.Table.from_pylist(annotation_rows, schema=ANNOTATION_SCHEMA),
+            root_path=annotations_dir,
+            partition_cols=["book_id"],
+            existing_data_behavior="delete_matching",
+        )
+
+    # delete_matching only replaces the partitions it writes
+    live = {row["book_id"] for row in annotation_rows}
+    for partition in annotations_dir.glob("book_id=*"):
+        if unquote(partition.name.split("=", 1)[1]) not in live:
+            shutil.rmtree(partition)
+
+    return len(annotation_rows)
+
+
+# -----------------------------
+# Read (column pruning + partition filters)
+# -----------------------------
+def store_exists(store_dir: Path = STORE_DIR) -> bool:
+    return (store_dir / "books.parquet").exists() and (store_dir / "annotations").exists()
+
+
+def read_annotations(
+    columns: Optional[Sequence[str]] = None,
+    book_ids: Optional[List[str]] = None,
+    highlights_only: bool = False,
+    store_dir: Path = STORE_DIR,
+):
+    """
+    Load annotations as a pandas DataFrame, reading only ``columns`` and,
+    if given, only the partitions of ``book_ids``. ``highlights_only``
+    drops note-only rows (the filter does not need the column projected).
+    """
+    dataset = ds.dataset(store_dir / "annotations", format="parquet", partitioning="hive")
+    filters = []
+    if book_ids:
+        filters.append(ds.field("book_id").isin(book_ids))
+    if highlights_only:
+        filters.append(ds.field("highlight").is_valid())
+    flt = None
+    for f in filters:
+        flt = f if flt is None else flt & f
+    return dataset.to_table(columns=list(columns) if columns else None, filter=flt).to_pandas()
+
+
+def read_books(columns: Optional[Sequence[str]] = None, store_dir: Path = STORE_DIR):
+    return pq.read_table(store_dir / "books.parquet", columns=list(columns) if columns else None).to_pandas()
@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import instrumentation
+from instrumentation import span
+from json_to_notion_page import batched, chapter_heading, entry_text, iter_keyed_blocks, record_synced, rich_text
+from notion_blocks import fetch_tree, walk
+import warehouse
+
+
+# -----------------------------
+# Layouts
+# -----------------------------
+# "page": every chapter as heading_2 + paragraphs on the book page itself.
+# "chapters": one sub-page per chapter (or per group of chapters up to a
+# block budget) below the book page, which only holds a table of contents.
+LAYOUTS = ("page", "chapters")
+DEFAULT_WORKERS = 4
+UNKNOWN_CHAPTER = "Unknown Chapter"
+
+
+def chapter_blocks(chapter: dict) -> int:
+    """
+    Blocks ``iter_keyed_blocks`` renders for one chapter.
+    """
+    return 1 + sum(1 for entry in chapter.get("entries", [])
+                   if (entry.get("highlight") or "").strip() or entry.get("note"))
+
+
+def plan_sections(book: dict, max_blocks: int = 0) -> List[dict]:
+    """
+    Split ``book`` into sub-page documents: one per chapter, or with
+    ``max_blocks`` consecutive chapters packed into pages of at most that
+    many blocks (a larger chapter still gets a page of its own).
+    """
+    sections: List[dict] = []
+    size = 0
+    for chapter in book.get("annotations", []):
+        blocks = chapter_blocks(chapter)
+        if not sections or not max_blocks or size + blocks > max_blocks:
+            sections.append({"annotations": []})
+            size = 0
+        sections[-1]["annotations"].append(chapter)
+        size += blocks
+    return sections
+
+
+def section_title(section: dict, number: int) -> str:
+    chapters = section["annotations"]
+    first, last = chapter_heading(chapters[0]), chapter_heading(chapters[-1])
+    return f"{number}. {first}" if len(chapters) == 1 else f"{number}. {first} – {last}"
+
+
+def link_block(page_id: str) -> dict:
+    return {"type": "link_to_page", "link_to_page": {"type": "page_id", "page_id": page_id}}
+
+
+# -----------------------------
+# Writing sub-pages
+# -----------------------------
+def fill_page(client, parent_id: str, title: str, section: dict) -> Tuple[str, List[Optional[str]], List[str]]:
+    """
+    Create one sub-page and append its blocks 100 at a time. Returns the
+    page id, the block fingerprints and the created block ids.
+    """
+    # POST /pages does not return the ids of initial children, so the
+    # page is created empty and filled through append_children
+    page_id = client.create_child_page(parent_id, title)["id"]
+    keys: List[Optional[str]] = []
+    created: List[str] = []
+    try:
+        for batch in batched(iter_keyed_blocks(section)):
+            keys.extend(key for _, key in batch)
+            created.extend(block["id"] for block in client.append_children(page_id, [b for b, _ in batch]))
+    except Exception:
+        # unrecorded, the page would be orphaned and created again next run
+        client.archive_block(page_id, scope=parent_id)
+        raise
+    return page_id, keys, created
+
+
+def write_book(client, conn, parent_id: str, book: dict, max_blocks: int = 0,
+               workers: int = DEFAULT_WORKERS) -> int:
+    """
+    Write ``book`` as sub-pages of ``parent_id``, creating and filling the
+    pages concurrently, then list them on the parent in reading order.
+    Chapters that already have a page are left to the incremental sync.
+    Returns the number of blocks written.
+    """
+    existing = warehouse.chapter_pages(conn, parent_id)
+    missing = {"annotations": [chapter for chapter in book.get("annotations", [])
+                               if (chapter.get("chapter") or UNKNOWN_CHAPTER) not in existing]}
+    sections = plan_sections(missing, max_blocks)
+    if not sections:
+        return 0
+
+    first_number = len(set(existing.values())) + 1
+    page_ids: Dict[int, str] = {}
+    written = 0
+    error: Optional[BaseException] = None
+
+    with span("notion.chapter_pages"), ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(fill_page, client, parent_id, section_title(section, first_number + i), section): i
+            for i, section in enumerate(sections)
+        }
+        # bookkeeping stays on this thread: the connection is not shared
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                page_id, keys, created = future.result()
+            except Exception as exc:
+                error = error or exc
+                continue
+            record_synced(conn, book.get("meta", {}).get("book_id"), page_id, keys, created)
+            with conn:
+                warehouse.record_chapter_pages(conn, parent_id, [
+                    (chapter.get("chapter") or UNKNOWN_CHAPTER, page_id) for chapter in sections[i]["annotations"]
+                ])
+            page_ids[i] = page_id
+            written += len(created)
+
+    if page_ids:
+        toc = [] if existing else [{"type": "heading_2", "heading_2": {"rich_text": rich_text("Contents")}}]
+        toc.extend(link_block(page_ids[i]) for i in sorted(page_ids))
+        for batch in batched(toc):
+            client.append_children(parent_id, batch)
+
+    instrumentation.incr("notion.chapter_pages", len(page_ids))
+    if error is not None:
+        raise error
+    return written
+
+
+def route(client, conn, parent_id: str, document: dict) -> List[Tuple[str, dict, bool]]:
+    """
+    Where new highlights of a book go: ``[(page_id, document, headings)]``.
+    A book page in page layout takes them all; in chapter layout each
+    chapter's entries go to its sub-page, and a chapter without one gets a
+    new (empty) page linked from the parent's table of contents.
+    ``headings`` is off for existing sub-pages, which already carry the
+    chapter heading (``append_entries`` skips it for chapters already on
+    the book page).
+    """
+    pages = warehouse.chapter_pages(conn, parent_id)
+    if not pages:
+        return [(parent_id, document, True)]
+
+    targets: Dict[str, dict] = {}
+    created = set()
+    for chapter in document.get("annotations", []):
+        name = chapter.get("chapter") or UNKNOWN_CHAPTER
+        page_id = pages.get(name)
+        if page_id is None:
+            title = section_title({"annotations": [chapter]}, len(set(pages.values())) + 1)
+            page_id = client.create_child_page(parent_id, title)["id"]
+            with conn:
+                warehouse.record_chapter_pages(conn, parent_id, [(name, page_id)])
+            client.append_children(parent_id, [link_block(page_id)])
+            pages[name] = page_id
+            created.add(page_id)
+        targets.setdefault(page_id, {"annotations": []})["annotations"].append(chapter)
+
+    return [(page_id, target, page_id in created) for page_id, target in targets.items()]
+
+
+# -----------------------------
+# Incremental appends
+# -----------------------------
+def drop_entries(document: dict, fingerprints: Iterable[str]) -> dict:
+    """
+    ``document`` without the entries of ``fingerprints`` (and chapters left empty).
+    """
+    fingerprints = set(fingerprints)
+    chapters = []
+    for chapter in document.get("annotations", []):
+        entries = [e for e in chapter.get("entries", []) if e.get("fingerprint") not in fingerprints]
+        if entries:
+            chapters.append({**chapter, "entries": entries})
+    return {**document, "annotations": chapters}
+
+
+def existing_blocks(client, conn, page_id: str, document: dict) -> Dict[str, str]:
+    """
+    fingerprint -> id of a paragraph on ``page_id`` already showing that
+    entry of ``document``, for pages written before block ids were
+    recorded. A page with recorded blocks is not read.
+    """
+    if warehouse.page_has_blocks(conn, page_id):
+        return {}
+
+    free: Dict[str, List[str]] = defaultdict(list)
+    for _, node in walk(fetch_tree(client, page_id)):
+        if node["type"] == "paragraph":
+            free[node["text"]].append(node["id"])
+
+    matched = {}
+    for chapter in document.get("annotations", []):
+        for entry in chapter.get("entries", []):
+            ids = free.get(entry_text(entry))
+            if ids and entry.get("fingerprint"):
+                matched[entry["fingerprint"]] = ids.pop(0)
+    return matched
+
+
+def append_entries(client, conn, page_id: str, document: dict,
+                   headings: bool = True) -> Iterator[Tuple[List[Optional[str]], List[dict]]]:
+    """
+    Send ``document`` to ``page_id`` without repeating chapter headings: a
+    chapter with a recorded block on the page continues below it (the
+    ``after`` parameter), the others are appended at the end with their
+    heading. Yields ``(fingerprints, created blocks)`` per request.
+    """
+    anchors = warehouse.chapter_anchors(conn, page_id)
+    tail = {"annotations": []}
+    for chapter in document.get("annotations", []):
+        after = anchors.get(chapter.get("chapter") or UNKNOWN_CHAPTER)
+        if after is None:
+            tail["annotations"].append(chapter)
+            continue
+        for batch in batched(iter_keyed_blocks({"annotations": [chapter]}, headings=False)):
+            created = client.append_children(page_id, [block for block, _ in batch], after=after)
+            yield [key for _, key in batch], created
+            # the next batch goes below this one
+            after = created[-1]["id"] if created else after
+
+    for batch in batched(iter_keyed_blocks(tail, headings)):
+        yield [key for _, key in batch], client.append_children(page_id, [block for block, _ in batch])
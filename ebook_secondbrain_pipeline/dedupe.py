@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import argparse
+import json
+import re
+import zlib
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import instrumentation
+from instrumentation import span
+from paths import DERIVED_DATA_DIR
+from utils_books import normalize_title
+import warehouse
+
+
+MERGED_DIR = DERIVED_DATA_DIR / "merged"
+
+# 64 permutations in 16 bands of 4 rows: pairs with Jaccard ~0.5 and up
+# collide in at least one band with high probability.
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+
+SHINGLE_WORDS = 3
+JACCARD_THRESHOLD = 0.6
+# one highlight spanning the other (different selection boundaries)
+CONTAINMENT_THRESHOLD = 0.85
+# a row is paired with at most this many later rows of its bucket, so a
+# bucket of boilerplate costs O(n) pairs; union-find still chains them
+BUCKET_WINDOW = 32
+
+# preferred source for the canonical copy: only the iBooks books are
+# mapped to Notion pages, so a Kindle canonical would never be synced
+SOURCE_RANK = {"ibooks": 0, "kindle": 1}
+
+# multiply-shift hashing needs full 64-bit multipliers (products wrap mod 2**64)
+_rng = np.random.default_rng(20240601)
+PERM_A = _rng.integers(0, 2 ** 64, NUM_PERM, dtype=np.uint64, endpoint=False) | np.uint64(1)
+PERM_B = _rng.integers(0, 2 ** 64, NUM_PERM, dtype=np.uint64, endpoint=False)
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+# -----------------------------
+# Shingles & signatures
+# -----------------------------
+def shingles(text: str) -> np.ndarray:
+    """
+    crc32 of every run of three words (case and punctuation ignored).
+    """
+    words = WORD_PATTERN.findall((text or "").lower())
+    if len(words) < SHINGLE_WORDS:
+        grams = [" ".join(words)] if words else []
+    else:
+        grams = [" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)]
+    return np.unique(np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams)))
+
+
+def minhash_signatures(shingle_sets: List[np.ndarray]) -> np.ndarray:
+    """
+    (n, NUM_PERM) MinHash signatures. All shingles are hashed in one flat
+    array per permutation (multiply-shift hashing) and reduced per record.
+    """
+    n = len(shingle_sets)
+    signatures = np.full((n, NUM_PERM), np.iinfo(np.uint64).max, dtype=np.uint64)
+
+    sizes = np.array([len(s) for s in shingle_sets])
+    present = np.flatnonzero(sizes)
+    if not len(present):
+        return signatures
+
+    flat = np.concatenate([shingle_sets[i] for i in present])
+    offsets = np.concatenate(([0], np.cumsum(sizes[present])[:-1]))
+
+    for k in range(NUM_PERM):
+        hashed = (PERM_A[k] * flat + PERM_B[k]) >> np.uint64(32)
+        signatures[present, k] = np.minimum.reduceat(hashed, offsets)
+
+    return signatures
+
+
+def lsh_candidates(signatures: np.ndarray, sources: List[str]) -> set:
+    """
+    Index pairs ``(i, j)``, ``i < j``, that share at least one band and
+    come from different sources. Each band's rows are sorted by bucket;
+    step ``d`` pairs every row with the one ``d`` places later in the same
+    bucket (up to ``BUCKET_WINDOW``), so the work is vectorised over all
+    buckets at once.
+    """
+    codes = np.unique(np.asarray(sources), return_inverse=True)[1].ravel()
+    # rows without shingles keep the all-max signature and would share every bucket
+    rows = np.flatnonzero((signatures != np.iinfo(np.uint64).max).any(axis=1))
+    found = []
+    for band in range(BANDS):
+        block = np.ascontiguousarray(signatures[rows, band * ROWS:(band + 1) * ROWS])
+        keys = block.view(np.dtype((np.void, block.dtype.itemsize * ROWS))).ravel()
+        bucket = np.unique(keys, return_inverse=True)[1].ravel()
+
+        order = np.argsort(bucket, kind="stable")
+        ranked = bucket[order]
+        members = rows[order]
+
+        for d in range(1, BUCKET_WINDOW + 1):
+            same = ranked[:-d] == ranked[d:]
+            if not same.any():
+                break
+            i, j = members[:-d][same], members[d:][same]
+            keep = codes[i] != codes[j]
+            found.append(np.stack((i[keep], j[keep]), axis=1))
+
+    if not found:
+        return set()
+    return set(map(tuple, np.unique(np.concatenate(found), axis=0).tolist()))
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> Tuple[float, float]:
+    """
+    Exact (Jaccard, containment) of two shingle sets.
+    """
+    if not len(a) or not len(b):
+        return 0.0, 0.0
+    inter = len(np.intersect1d(a, b, assume_unique=True))
+    return inter / (len(a) + len(b) - inter), inter / min(len(a), len(b))
+
+
+# -----------------------------
+# Clustering
+# -----------------------------
+def find_duplicates(records: List[dict]) -> List[Tuple[int, int, float]]:
+    """
+    ``(duplicate_index, canonical_index, similarity)`` for ``records``
+    (dicts with "highlight" and "source"). Matches are grouped with
+    union-find; a group keeps the longest highlight of its best-ranked
+    source (``SOURCE_RANK``).
+    """
+    shingle_sets = [shingles(r["highlight"]) for r in records]
+    signatures = minhash_signatures(shingle_sets)
+    candidates = lsh_candidates(signatures, [r["source"] for r in records])
+
+    parent = list(range(len(records)))
+
+    def root(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    best: Dict[int, float] = {}
+    for i, j in candidates:
+        jaccard, containment = similarity(shingle_sets[i], shingle_sets[j])
+        if jaccard >= JACCARD_THRESHOLD or containment >= CONTAINMENT_THRESHOLD:
+            parent[root(i)] = root(j)
+            score = max(jaccard, containment)
+            best[i] = max(best.get(i, 0.0), score)
+            best[j] = max(best.get(j, 0.0), score)
+
+    groups: Dict[int, List[int]] = defaultdict(list)
+    for i in best:
+        groups[root(i)].append(i)
+
+    duplicates = []
+    for members in groups.values():
+        canonical = min(members, key=lambda i: (SOURCE_RANK.get(records[i]["source"], 9),
+                                                -len(records[i]["highlight"] or "")))
+        duplicates.extend((i, canonical, best[i]) for i in members if i != canonical)
+    return duplicates
+
+
+# -----------------------------
+# Merge stage
+# -----------------------------
+def merge_book(conn, books: List) -> Tuple[dict, int]:
+    """
+    Dedupe the annotations of one title across its source books, record the
+    duplicates in the warehouse and return the merged document.
+    """
+    records = []
+    for book in books:
+        for row in warehouse.book_annotations(conn, book["id"]):
+            records.append({**dict(row), "book_id": book["id"], "source": book["source"]})
+
+    duplicates = find_duplicates(records)
+    dropped = {i for i, _, _ in duplicates}
+
+    # a note on a dropped copy moves to the canonical one; the warehouse
+    # does the same when reading (ANNOTATION_COLUMNS)
+    for i, canonical, _ in duplicates:
+        if records[i]["note"] and not records[canonical]["note"]:
+            records[canonical]["note"] = records[i]["note"]
+
+    with conn:
+        warehouse.replace_duplicates(conn, [b["id"] for b in books], [
+            (records[i]["book_id"], records[i]["fingerprint"],
+             records[c]["book_id"], records[c]["fingerprint"], round(score, 3))
+            for i, c, score in duplicates
+        ])
+
+    primary = min(books, key=lambda b: SOURCE_RANK.get(b["source"], 9))
+    # chapters in the primary book's order (chapters only another source
+    # knows follow it), highlights by position within a chapter
+    chapter_rank: Dict[Optional[str], int] = {}
+    for r in sorted(records, key=lambda r: r["book_id"] != primary["id"]):
+        chapter_rank.setdefault(r["chapter"], len(chapter_rank))
+    kept = sorted((r for i, r in enumerate(records) if i not in dropped),
+                  key=lambda r: (chapter_rank[r["chapter"]], r["position"] is None,
+                                 r["position"] or 0, r["created"] or ""))
+    return warehouse.rows_document(primary, kept), len(dropped)
+
+
+def run_merge(conn=None, title_keys: Optional[List[str]] = None) -> dict:
+    own_conn = conn is None
+    conn = conn or warehouse.connect()
+    MERGED_DIR.mkdir(parents=True, exist_ok=True)
+
+    merged = 0
+    dropped = 0
+    for title_key, books in warehouse.cross_source_books(conn).items():
+        if title_keys and title_key not in title_keys:
+            continue
+        with span("dedupe.book"):
+            document, n = merge_book(conn, books)
+
+        primary = document["meta"]
+        out_path = MERGED_DIR / f"{primary['normalized_title']}__{primary['normalized_author']}.json"
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump(document, f, ensure_ascii=False, indent=2)
+
+        merged += 1
+        dropped += n
+        print(f"🔗 {books[0]['title']}: {n} cross-source duplicate(s)")
+
+    instrumentation.incr("dedupe.books", merged)
+    instrumentation.incr("dedupe.duplicates", dropped)
+
+    if own_conn:
+        conn.close()
+    return {"books": merged, "duplicates": dropped}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Merge iBooks and Kindle highlights of the same book, dropping near-duplicates.")
+    parser.add_argument("--title", action="append", help="only this title (normalized match); repeatable")
+    instrumentation.add_profile_args(parser)
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.enable("dedupe", trace_memory=args.trace_memory)
+
+    title_keys = [normalize_title(t) for t in args.title] if args.title else None
+
+    result = run_merge(title_keys=title_keys)
+    print(f"✔ {result['books']} book(s) merged, {result['duplicates']} duplicate(s) marked")
+
+    instrumentation.finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from bs4 import BeautifulSoup
+from ebooklib import ITEM_DOCUMENT, epub
+
+import instrumentation
+from paths import DERIVED_DATA_DIR
+
+
+# -----------------------------
+# Defaults
+# -----------------------------
+DEFAULT_CACHE_DIR = DERIVED_DATA_DIR / "epub_cache"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# bump when the extraction (cleaning, titles) changes, so old entries are ignored
+FORMAT_VERSION = 1
+MAGIC = b"EPUBSPN1"
+HEADER = struct.Struct("<8sIQ")     # magic, format version, index length
+
+
+# -----------------------------
+# TOC helpers
+# -----------------------------
+def _flatten_toc(entries, toc: Dict[str, str]) -> None:
+    for entry in entries:
+        if isinstance(entry, tuple):
+            section, children = entry
+            href = getattr(section, "href", None)
+            if href:
+                toc.setdefault(href.split("#")[0], section.title)
+            _flatten_toc(children, toc)
+        else:
+            toc.setdefault(entry.href.split("#")[0], entry.title)
+
+
+def toc_titles(book: epub.EpubBook) -> Dict[str, str]:
+    """
+    Map spine href -> first TOC title pointing into that file.
+    """
+    toc: Dict[str, str] = {}
+    _flatten_toc(book.toc, toc)
+    return toc
+
+
+# -----------------------------
+# Spine extraction
+# -----------------------------
+def clean_document(content: bytes) -> BeautifulSoup:
+    soup = BeautifulSoup(content, "html.parser")
+
+    # Clean junk
+    for tag in soup(["script", "style"]):
+        tag.decompose()
+
+    return soup
+
+
+def spine_items(book: epub.EpubBook) -> list:
+    items = []
+    for idref, _linear in book.spine:
+        item = book.get_item_with_id(idref)
+        if item is not None and item.get_type() == ITEM_DOCUMENT:
+            items.append(item)
+
+    # Some EPUBs ship an empty spine; fall back to manifest order
+    return items or list(book.get_items_of_type(ITEM_DOCUMENT))
+
+
+def parse_epub(epub_path: Path) -> Dict[str, object]:
+    """
+    Unzip and parse an EPUB: ``{"toc": {href: title}, "documents": [...]}``
+    with the spine documents described in ``read_spine``.
+    """
+    book = epub.read_epub(str(epub_path))
+    toc = toc_titles(book)
+
+    documents = []
+    for item in spine_items(book):
+        soup = clean_document(item.get_content())
+        href = item.get_name()
+
+        title = toc.get(href)
+        if not title:
+            heading = soup.find(["h1", "h2", "h3"])
+            title = heading.get_text(" ", strip=True) if heading else href
+
+        documents.append({
+            "href": href,
+            "title": title,
+            "html": str(soup),
+            "text": soup.get_text(" "),
+        })
+
+    return {"toc": toc, "documents": documents}
+
+
+# -----------------------------
+# Parsed-content cache
+# -----------------------------
+class SpineCache:
+    """
+    On-disk store of parsed EPUBs, one file per book, so repeat readers
+    skip the unzip and the BeautifulSoup pass.
+
+    A file is a fixed header, a JSON index (source size/mtime, TOC, and per
+    spine document its href, title and the byte ranges of its html/text)
+    and then the UTF-8 payload. Reads memory-map the file and decode only
+    the ranges they ask for. An entry is valid while the EPUB's size and
+    mtime match; least-recently-used files go past ``max_bytes``.
+    """
+
+    def __init__(self, cache_dir: Path = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, epub_path: Path) -> Path:
+        source = str(Path(epub_path).resolve())
+        return self.cache_dir / f"{hashlib.sha1(source.encode('utf-8')).hexdigest()}.spine"
+
+    @staticmethod
+    def _stamp(epub_path: Path) -> Dict[str, int]:
+        stat = os.stat(epub_path)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def get(self, epub_path: Path, fields=("html", "text")) -> Optional[Dict[str, object]]:
+        """
+        Cached ``parse_epub`` result, or ``None`` if missing or stale.
+        Only the payload ``fields`` are decoded.
+        """
+        path = self.path_for(epub_path)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+
+        with f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                return None
+            view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with view:
+            magic, version, index_len = HEADER.unpack_from(view)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                return None
+
+            index = json.loads(view[HEADER.size:HEADER.size + index_len])
+            if index["source"] != self._stamp(epub_path):
+                return None
+
+            base = HEADER.size + index_len
+            documents = []
+            for doc in index["documents"]:
+                entry = {"href": doc["href"], "title": doc["title"]}
+                for field in fields:
+                    start, length = doc[field]
+                    entry[field] = view[base + start:base + start + length].decode("utf-8")
+                documents.append(entry)
+
+        os.utime(path)  # mark as recently used
+        return {"toc": index["toc"], "documents": documents}
+
+    def put(self, epub_path: Path, parsed: Dict[str, object], stamp: Dict[str, int]) -> Path:
+        """
+        Store ``parsed`` for the EPUB as it was when ``stamp`` was taken.
+        """
+        chunks: List[bytes] = []
+        offset = 0
+        documents = []
+        for doc in parsed["documents"]:
+            entry = {"href": doc["href"], "title": doc["title"]}
+            for field in ("html", "text"):
+                data = doc[field].encode("utf-8")
+                entry[field] = [offset, len(data)]
+                chunks.append(data)
+                offset += len(data)
+            documents.append(entry)
+
+        index = json.dumps({"source": stamp, "toc": parsed["toc"], "documents": documents},
+                           ensure_ascii=False).encode("utf-8")
+
+        path = self.path_for(epub_path)
+        fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(index)))
+                f.write(index)
+                f.writelines(chunks)
+            os.replace(tmp_name, path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        return path
+
+    def evict(self, keep: Optional[Path] = None) -> int:
+        """
+        Drop least-recently-used entries until the cache fits ``max_bytes``;
+        ``keep`` is never removed. Returns the number of evicted entries.
+        """
+        entries = []
+        total = 0
+        for path in self.cache_dir.glob("*.spine"):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+            evicted += 1
+        return evicted
+
+    def load(self, epub_path: Path, fields=("html", "text")) -> Dict[str, object]:
+        """
+        ``parse_epub`` through the cache.
+        """
+        parsed = self.get(epub_path, fields)
+        if parsed is not None:
+            instrumentation.incr("epub_cache.hits")
+            return parsed
+
+        instrumentation.incr("epub_cache.misses")
+        # stamp before parsing: a book rewritten meanwhile is re-read next time
+        stamp = self._stamp(epub_path)
+        with instrumentation.span("epub_cache.parse"):
+            parsed = parse_epub(epub_path)
+        self.evict(keep=self.put(epub_path, parsed, stamp))
+        return parsed
+
+
+def read_spine(epub_path: Path, use_cache: bool = True, fields=("html", "text")) -> List[Dict[str, str]]:
+    """
+    Spine documents of an EPUB in reading order:
+
+        {"href", "title", "html", "text"}
+
+    ``html`` is the cleaned markup (scripts/styles removed), ``text`` the
+    plain text of the same document. ``title`` comes from the TOC, then
+    the first heading, then the href. Served from ``SpineCache`` unless
+    ``use_cache`` is off; from the cache only ``fields`` are decoded.
+    """
+    if not use_cache:
+        return parse_epub(epub_path)["documents"]
+    return SpineCache().load(epub_path, fields)["documents"]
+
+
+def read_toc(epub_path: Path, use_cache: bool = True) -> Dict[str, str]:
+    """
+    Spine href -> TOC title (see ``toc_titles``).
+    """
+    if not use_cache:
+        return parse_epub(epub_path)["toc"]
+    return SpineCache().load(epub_path, fields=())["toc"]
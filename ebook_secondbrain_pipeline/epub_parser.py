@@ -1,11 +1,21 @@
+import argparse
 import sqlite3
 from pathlib import Path
 from datetime import datetime, timedelta
-import re
 import json
 from collections import defaultdict
+import os
 import shutil
-import sys
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
+
+from annotation_store import write_store
+import instrumentation
+from instrumentation import span
+from search_index import ibooks_records, index_records
+from paths import ANNOT_DB_PATTERN, ORIG_ANNOT_DB_PATH, ORIG_BOOK_DB_PATH
+from utils_books import export_name, normalize_filename, normalize_string
+import warehouse
 
 # -----------------------------
 # Project root & data directories
@@ -38,13 +48,6 @@ FOCUS_BOOK_TITLES = [
 # -----------------------------
 # Original iBooks DB paths
 # -----------------------------
-if sys.platform == "win32":
-    ORIG_BOOK_DB_PATH = Path("C:/path/to/BKLibrary.sqlite")
-    ORIG_ANNOT_DB_PATH = Path("C:/path/to/AEAnnotation.sqlite")
-else:
-    ORIG_BOOK_DB_PATH = Path.home() / "Library/Containers/com.apple.iBooksX/Data/Documents/BKLibrary/BKLibrary-1-091020131601.sqlite"
-    ORIG_ANNOT_DB_PATH = Path.home() / "Library/Containers/com.apple.iBooksX/Data/Documents/AEAnnotation/AEAnnotation_v10312011_1727_local.sqlite"
-
 BOOK_DB_PATH = RAW_DATA_DIR / ORIG_BOOK_DB_PATH.name
 ANNOT_DB_PATH = RAW_DATA_DIR / ORIG_ANNOT_DB_PATH.name
 
@@ -52,9 +55,16 @@ ANNOT_DB_PATH = RAW_DATA_DIR / ORIG_ANNOT_DB_PATH.name
 # -----------------------------
 # Helpers
 # -----------------------------
+_error_log = None
+
+
 def log_error(msg: str):
-    with open(ERROR_LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(f"[{datetime.now()}] {msg}\n")
+    global _error_log
+    if _error_log is None:
+        # opened once per run, line-buffered so nothing is lost on a crash
+        _error_log = open(ERROR_LOG_FILE, "a", encoding="utf-8", buffering=1)
+    _error_log.write(f"[{datetime.now()}] {msg}\n")
+    instrumentation.incr("errors")
     print(f"ERROR: {msg}")
 
 
@@ -69,28 +79,6 @@ def cocoa_timestamp_to_datetime(ts):
     return datetime(2001, 1, 1) + timedelta(seconds=ts)
 
 
-def normalize_string(value: str) -> str:
-    """
-    Strong normalization:
-    - lowercase
-    - remove punctuation
-    - collapse whitespace
-    """
-    if not value:
-        return ""
-    value = value.lower()
-    value = re.sub(r"\([^)]*\)", "", value)  # remove parentheses (ISBNs etc.)
-    value = re.sub(r"[^\w\s]", " ", value)
-    value = re.sub(r"\s+", " ", value)
-    return value.strip()
-
-
-def normalize_filename(value: str) -> str:
-    value = normalize_string(value)
-    value = re.sub(r"\s+", "_", value)
-    return value
-
-
 # -----------------------------
 # Normalize focus titles once
 # -----------------------------
@@ -102,94 +90,186 @@ FOCUS_TITLES_NORMALIZED = {
 # -----------------------------
 # Sync raw DBs
 # -----------------------------
-copy_if_newer(ORIG_BOOK_DB_PATH, BOOK_DB_PATH)
-copy_if_newer(ORIG_ANNOT_DB_PATH, ANNOT_DB_PATH)
+def sync_raw_dbs():
+    for src, dst in ((ORIG_BOOK_DB_PATH, BOOK_DB_PATH), (ORIG_ANNOT_DB_PATH, ANNOT_DB_PATH)):
+        copy_if_newer(src, dst)
+
+        # Recent writes sit in the WAL until iBooks checkpoints
+        for suffix in ("-wal", "-shm"):
+            side = src.with_name(src.name + suffix)
+            copy = dst.with_name(dst.name + suffix)
+            if side.exists():
+                copy_if_newer(side, copy)
+            else:
+                # checkpointed since the last sync: an old copy would replay stale pages
+                copy.unlink(missing_ok=True)
+
+
+def table_columns(conn: sqlite3.Connection, table: str) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
 
 
 # -----------------------------
 # Load books
 # -----------------------------
-books = {}
+OPTIONAL_BOOK_COLUMNS = {
+    "ZDATEADDED": "date_added",
+    "ZDATEFINISHED": "date_finished",
+}
 
-conn = sqlite3.connect(BOOK_DB_PATH)
-cur = conn.cursor()
-cur.execute("SELECT ZASSETID, ZTITLE, ZAUTHOR FROM ZBKLIBRARYASSET;")
 
-for asset_id, title, author in cur.fetchall():
-    books[asset_id] = {
-        "title": title or "Unknown Title",
-        "author": author or "Unknown Author",
-        "annotations": []
-    }
+def load_books(db_path: Path = BOOK_DB_PATH) -> dict:
+    books = {}
+
+    conn = sqlite3.connect(db_path)
+    columns = table_columns(conn, "ZBKLIBRARYASSET")
 
-conn.close()
+    # Optional columns differ between iBooks versions
+    optional = [(col, key) for col, key in OPTIONAL_BOOK_COLUMNS.items() if col in columns]
+    select_cols = ["ZASSETID", "ZTITLE", "ZAUTHOR"] + [col for col, _ in optional]
+
+    cur = conn.cursor()
+    cur.execute(f"SELECT {', '.join(select_cols)} FROM ZBKLIBRARYASSET;")
+
+    for asset_id, title, author, *dates in cur.fetchall():
+        book = {
+            "title": title or "Unknown Title",
+            "author": author or "Unknown Author",
+            "annotations": []
+        }
+        for (_, key), value in zip(optional, dates):
+            book[key] = cocoa_timestamp_to_datetime(value)
+        books[asset_id] = book
+
+    conn.close()
+    return books
 
 
 # -----------------------------
 # Load annotations
 # -----------------------------
-conn = sqlite3.connect(ANNOT_DB_PATH)
-cur = conn.cursor()
+OPTIONAL_ANNOTATION_COLUMNS = {
+    "ZANNOTATIONUUID": "uuid",
+    "ZANNOTATIONSTYLE": "style",
+    "ZANNOTATIONMODIFICATIONDATE": "modified",
+    "ZANNOTATIONSTARTLOC": "start_loc",
+    "ZANNOTATIONENDLOC": "end_loc",
+    "ZANNOTATIONDELETED": "deleted",
+    "ZFUTUREPROOFING5": "chapter_hint",
+}
 
-cur.execute("""
-    SELECT 
-        ZANNOTATIONASSETID,
-        ZANNOTATIONSELECTEDTEXT,
-        ZANNOTATIONNOTE,
-        ZANNOTATIONCREATIONDATE,
-        ZANNOTATIONLOCATION
-    FROM ZAEANNOTATION
-""")
 
-for asset_id, highlight, note, created, loc_text in cur.fetchall():
-    if asset_id not in books:
-        continue
+def discover_annotation_dbs(raw_dir: Path = RAW_DATA_DIR) -> list:
+    """
+    Every AEAnnotation database collected into data/raw (one per Mac / user).
+    """
+    return sorted(raw_dir.glob(ANNOT_DB_PATTERN))
 
-    books[asset_id]["annotations"].append({
-        "highlight": highlight,
-        "note": note,
-        "created": cocoa_timestamp_to_datetime(created),
-        "loc_text": loc_text
-    })
 
-conn.close()
+def read_annotation_db(db_path: Path) -> list:
+    """
+    Read all annotations of one AEAnnotation database.
+    Runs in a worker process, so it only returns plain dicts.
+    """
+    # quoted: "?" or "#" in a path would otherwise end the file name
+    conn = sqlite3.connect(f"file:{quote(db_path.as_posix(), safe='/:')}?mode=ro", uri=True)
+    columns = table_columns(conn, "ZAEANNOTATION")
+    optional = [(col, key) for col, key in OPTIONAL_ANNOTATION_COLUMNS.items() if col in columns]
+
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT 
+            ZANNOTATIONASSETID,
+            ZANNOTATIONSELECTEDTEXT,
+            ZANNOTATIONNOTE,
+            ZANNOTATIONCREATIONDATE,
+            ZANNOTATIONLOCATION
+            {"".join(f", {col}" for col, _ in optional)}
+        FROM ZAEANNOTATION
+    """)
+
+    rows = []
+    for asset_id, highlight, note, created, loc_text, *extra in cur.fetchall():
+        annotation = {
+            "asset_id": asset_id,
+            "highlight": highlight,
+            "note": note,
+            "created": cocoa_timestamp_to_datetime(created),
+            "loc_text": loc_text,
+            "chapter": chapter_from_location(loc_text),
+        }
+        for (_, key), value in zip(optional, extra):
+            annotation[key] = cocoa_timestamp_to_datetime(value) if key == "modified" else value
+        rows.append(annotation)
+
+    conn.close()
+    return rows
+
+
+def merge_annotation_rows(row_sets) -> list:
+    """
+    Merge rows from several databases by annotation UUID, keeping the
+    most recently modified copy. Rows without a UUID are keyed by content.
+    """
+    merged = {}
 
+    for rows in row_sets:
+        for row in rows:
+            key = row.get("uuid") or (row["asset_id"], row["highlight"], row["note"], row["created"])
+            stamp = row.get("modified") or row["created"] or datetime.min
+            current = merged.get(key)
+            if current is None or stamp > current[0]:
+                merged[key] = (stamp, row)
 
-# -----------------------------
-# Export JSONs (FOCUSED ONLY)
-# -----------------------------
-exported = 0
-skipped = 0
+    return [row for _, row in merged.values()]
 
-for book in books.values():
-    title = book["title"]
-    title_norm = normalize_string(title)
 
-    # 🔒 Focus filter
-    if title_norm not in FOCUS_TITLES_NORMALIZED:
-        skipped += 1
-        continue
+def load_annotations(books: dict, db_paths: list = None, max_workers: int = None) -> int:
+    """
+    Attach annotations from every database in ``db_paths`` (default: all
+    AEAnnotation files in data/raw) to ``books`` (in place). Databases are
+    read in parallel worker processes. Returns the number attached.
+    """
+    if db_paths is None:
+        db_paths = discover_annotation_dbs() or [ANNOT_DB_PATH]
 
-    if not book["annotations"]:
-        log_error(f"No annotations found for focused book: {title}")
-        continue
+    if len(db_paths) == 1:
+        row_sets = [read_annotation_db(db_paths[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers or min(len(db_paths), os.cpu_count() or 1)) as pool:
+            row_sets = list(pool.map(read_annotation_db, db_paths))
+
+    attached = 0
+    for annotation in merge_annotation_rows(row_sets):
+        asset_id = annotation.pop("asset_id")
+        # deleted in Books but kept as a tombstone; dropping it here makes the
+        # warehouse soft-delete the row and the Notion sync archive its block
+        if annotation.pop("deleted", 0) or asset_id not in books:
+            continue
+
+        books[asset_id]["annotations"].append(annotation)
+        attached += 1
+
+    return attached
 
-    author = book["author"]
 
-    title_fn = normalize_filename(title)
-    author_fn = normalize_filename(author)
+def chapter_from_location(loc_text) -> str:
+    if loc_text and "[" in loc_text:
+        return loc_text.split("[")[1].split("]")[0]
+    return "Unknown Chapter"
 
-    filename = f"{title_fn}__{author_fn}.json"
-    out_path = CLEAN_DIR / filename
+
+# -----------------------------
+# Export JSONs (FOCUSED ONLY)
+# -----------------------------
+def build_book_json(book: dict) -> dict:
+    title = book["title"]
+    author = book["author"]
 
     chapter_map = defaultdict(list)
 
     for a in book["annotations"]:
-        chapter = "Unknown Chapter"
-        if a["loc_text"] and "[" in a["loc_text"]:
-            chapter = a["loc_text"].split("[")[1].split("]")[0]
-
-        chapter_map[chapter].append({
+        chapter_map[a["chapter"]].append({
             "highlight": a["highlight"],
             "note": a["note"],
             "created": a["created"].isoformat() if a["created"] else None
@@ -199,8 +279,8 @@ for book in books.values():
         "meta": {
             "source_title": title,
             "source_author": author,
-            "normalized_title": title_fn,
-            "normalized_author": author_fn
+            "normalized_title": normalize_filename(title),
+            "normalized_author": normalize_filename(author)
         },
         "annotations": []
     }
@@ -211,15 +291,107 @@ for book in books.values():
             "entries": sorted(entries, key=lambda x: x["created"] or "")
         })
 
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(json_data, f, ensure_ascii=False, indent=2)
+    return json_data
+
+
+def export_books(books: dict, clean_dir: Path = CLEAN_DIR) -> dict:
+    exported = 0
+    skipped = 0
+    index_batch = []
+
+    for book in books.values():
+        title = book["title"]
+        title_norm = normalize_string(title)
+
+        # 🔒 Focus filter
+        if title_norm not in FOCUS_TITLES_NORMALIZED:
+            skipped += 1
+            continue
+
+        if not book["annotations"]:
+            log_error(f"No annotations found for focused book: {title}")
+            continue
+
+        json_data = build_book_json(book)
+        out_path = clean_dir / f"{export_name(title, book['author'])}.json"
+
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump(json_data, f, ensure_ascii=False, indent=2)
+        instrumentation.incr("ibooks.json.bytes", out_path.stat().st_size)
+
+        print(f"✅ JSON written: {out_path.name}")
+        exported += 1
+        index_batch.extend(ibooks_records(json_data))
+
+    return {"exported": exported, "skipped": skipped, "index_batch": index_batch}
+
+
+# -----------------------------
+# Main
+# -----------------------------
+def run_extraction(warehouse_conn=None, index_conn=None, copy: bool = True) -> dict:
+    """
+    One full iBooks extraction: copy DBs, read, export JSON, refresh the
+    search index, Parquet store and warehouse. Open connections can be
+    passed in to keep them warm between runs (watch mode); ``copy=False``
+    works on the copies already in data/raw (pipeline.py copies first).
+    """
+    if copy:
+        with span("ibooks.copy_dbs"):
+            sync_raw_dbs()
+
+    db_paths = discover_annotation_dbs()
+    with span("ibooks.sqlite.read_books"):
+        books = load_books()
+    with span("ibooks.sqlite.read_annotations"):
+        attached = load_annotations(books, db_paths)
+    instrumentation.incr("ibooks.books", len(books))
+    instrumentation.incr("ibooks.annotations", attached)
+
+    with span("ibooks.json.export"):
+        result = export_books(books)
+    with span("ibooks.search_index"):
+        index_stats = index_records(result["index_batch"], conn=index_conn)
+    with span("ibooks.parquet.write"):
+        stored = write_store(books)
+    with span("ibooks.warehouse.upsert"):
+        loaded = warehouse.load_ibooks(books, conn=warehouse_conn)
+
+    return {
+        "db_paths": db_paths,
+        "attached": attached,
+        "exported": result["exported"],
+        "skipped": result["skipped"],
+        "index": index_stats,
+        "stored": stored,
+        "warehouse": loaded,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export iBooks annotations.")
+    instrumentation.add_profile_args(parser)
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.enable("epub_parser", trace_memory=args.trace_memory)
+
+    result = run_extraction()
+    index_stats = result["index"]
+    loaded = result["warehouse"]
+
+    print("\n──────── SUMMARY ────────")
+    print(f"Annotation DBs      : {len(result['db_paths'])} ({result['attached']} annotations after merge)")
+    print(f"Focused titles      : {len(FOCUS_BOOK_TITLES)}")
+    print(f"Exported JSONs      : {result['exported']}")
+    print(f"Skipped (not focus) : {result['skipped']}")
+    print(f"Search index        : +{index_stats['inserted']} / -{index_stats['deleted']}")
+    print(f"Parquet store       : {result['stored']} annotations")
+    print(f"Warehouse           : +{loaded.get('inserted', 0)} ~{loaded.get('updated', 0)} -{loaded.get('deleted', 0)}")
+    print(f"Error log           : {ERROR_LOG_FILE}")
 
-    print(f"✅ JSON written: {out_path.name}")
-    exported += 1
+    instrumentation.finish()
 
 
-print("\n──────── SUMMARY ────────")
-print(f"Focused titles      : {len(FOCUS_BOOK_TITLES)}")
-print(f"Exported JSONs      : {exported}")
-print(f"Skipped (not focus) : {skipped}")
-print(f"Error log           : {ERROR_LOG_FILE}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import argparse
+import json
+from bisect import bisect_right
+from collections import deque
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from epub_content import read_spine
+
+
+# -----------------------------
+# Text normalisation (with offset map)
+# -----------------------------
+def normalize_with_offsets(text: str) -> Tuple[str, List[int]]:
+    """
+    Lowercase, turn every run of non-alphanumerics into one space.
+    Returns the normalised text and, per normalised character, the index
+    of the original character it came from.
+    """
+    chars: List[str] = []
+    offsets: List[int] = []
+    pending_space = False
+
+    for i, ch in enumerate(text):
+        if ch.isalnum():
+            if pending_space and chars:
+                chars.append(" ")
+                offsets.append(i)
+            pending_space = False
+            chars.append(ch.lower())
+            offsets.append(i)
+        else:
+            pending_space = True
+
+    return "".join(chars), offsets
+
+
+def normalize_text(text: str) -> str:
+    return normalize_with_offsets(text or "")[0]
+
+
+# -----------------------------
+# Aho-Corasick automaton
+# -----------------------------
+class AhoCorasick:
+    """
+    Multi-pattern matcher: one pass over the text finds every occurrence
+    of every pattern, in O(len(text) + matches).
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        self._dict_link: List[int] = [0]
+
+        for pattern in patterns:
+            self._add(pattern)
+        self._build()
+
+    def _add(self, pattern: str) -> None:
+        index = len(self.patterns)
+        self.patterns.append(pattern)
+        if not pattern:
+            return
+
+        state = 0
+        for ch in pattern:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._dict_link.append(0)
+            state = nxt
+        self._out[state].append(index)
+
+    def _build(self) -> None:
+        queue = deque(self._goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+
+                # nearest suffix state that completes a pattern
+                link = self._fail[nxt]
+                self._dict_link[nxt] = link if self._out[link] else self._dict_link[link]
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int]]:
+        """
+        Yield ``(start, pattern_index)`` for every occurrence, ordered by
+        end position.
+        """
+        goto, fail, out, dict_link = self._goto, self._fail, self._out, self._dict_link
+        patterns = self.patterns
+        state = 0
+
+        for pos, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+
+            hit = state if out[state] else dict_link[state]
+            while hit:
+                for index in out[hit]:
+                    yield pos - len(patterns[index]) + 1, index
+                hit = dict_link[hit]
+
+
+# -----------------------------
+# Locating highlights
+# -----------------------------
+def locate_highlights(
+    spine: List[Dict[str, str]],
+    highlights: List[str],
+) -> List[Optional[Dict[str, object]]]:
+    """
+    Find the first occurrence of every highlight in the book text.
+
+    Returns one entry per highlight (``None`` if not found):
+
+        {"chapter", "href", "spine_index", "offset"}
+
+    ``offset`` is the character offset inside the spine document's text.
+    """
+    # Build one normalised text for the whole book, remembering where
+    # each spine document starts.
+    parts: List[str] = []
+    doc_offsets: List[List[int]] = []
+    starts: List[int] = []
+    cursor = 0
+
+    for doc in spine:
+        norm, offsets = normalize_with_offsets(doc["text"])
+        starts.append(cursor)
+        parts.append(norm)
+        doc_offsets.append(offsets)
+        cursor += len(norm) + 1  # separator space
+
+    book_text = " ".join(parts)
+
+    patterns = [normalize_text(h) for h in highlights]
+    automaton = AhoCorasick(set(p for p in patterns if p))
+
+    first_hit: Dict[str, int] = {}
+    for start, index in automaton.iter_matches(book_text):
+        pattern = automaton.patterns[index]
+        if pattern not in first_hit or start < first_hit[pattern]:
+            first_hit[pattern] = start
+        if len(first_hit) == len(automaton.patterns):
+            break
+
+    results: List[Optional[Dict[str, object]]] = []
+    for pattern in patterns:
+        start = first_hit.get(pattern)
+        if start is None:
+            results.append(None)
+            continue
+
+        spine_index = bisect_right(starts, start) - 1
+        local = start - starts[spine_index]
+        offsets = doc_offsets[spine_index]
+        doc = spine[spine_index]
+
+        results.append({
+            "chapter": doc["title"],
+            "href": doc["href"],
+            "spine_index": spine_index,
+            "offset": offsets[local] if local < len(offsets) else len(doc["text"]),
+        })
+
+    return results
+
+
+# -----------------------------
+# Clean JSON rewriting
+# -----------------------------
+def relocate_ibooks_json(data: dict, spine: List[Dict[str, str]]) -> Tuple[dict, int]:
+    """
+    Regroup an ``epub_parser`` JSON by the chapters found in the EPUB.
+    Entries that cannot be located keep their original chapter.
+    """
+    flat = [
+        (chapter["chapter"], entry)
+        for chapter in data.get("annotations", [])
+        for entry in chapter.get("entries", [])
+    ]
+    locations = locate_highlights(spine, [entry.get("highlight") or "" for _, entry in flat])
+
+    grouped: Dict[str, List[dict]] = {}
+    order: Dict[str, Tuple[int, int]] = {}
+    located = 0
+
+    for (old_chapter, entry), loc in zip(flat, locations):
+        if loc is None:
+            chapter = old_chapter
+            key = (len(spine), 0)
+        else:
+            chapter = loc["chapter"]
+            key = (loc["spine_index"], loc["offset"])
+            entry["location"] = {"spine_index": loc["spine_index"], "offset": loc["offset"]}
+            located += 1
+
+        grouped.setdefault(chapter, []).append((key, entry))
+        order[chapter] = min(order.get(chapter, key), key)
+
+    data["annotations"] = [
+        {
+            "chapter": chapter,
+            "entries": [entry for _, entry in sorted(grouped[chapter], key=lambda x: x[0])],
+        }
+        for chapter in sorted(grouped, key=lambda c: order[c])
+    ]
+    return data, located
+
+
+def relocate_kindle_items(items: List[dict], spine: List[Dict[str, str]]) -> int:
+    locations = locate_highlights(spine, [item.get("text") or "" for item in items])
+    located = 0
+
+    for item, loc in zip(items, locations):
+        if loc is None:
+            continue
+        item["chapter"] = loc["chapter"]
+        item["location"] = {"spine_index": loc["spine_index"], "offset": loc["offset"]}
+        located += 1
+
+    items.sort(key=lambda a: (
+        a["location"]["spine_index"], a["location"]["offset"]
+    ) if "location" in a else (len(spine), 0))
+    return located
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Resolve exact chapter + offset for highlights using the book's EPUB."
+    )
+    parser.add_argument("epub", type=Path)
+    parser.add_argument("clean_json", type=Path, help="epub_parser or kindle_cleaner output")
+    parser.add_argument("--kindle-title", help="book title inside a Kindle clean JSON")
+    parser.add_argument("--no-cache", action="store_true", help="re-parse the EPUB instead of using the content cache")
+    args = parser.parse_args()
+
+    # locating only needs the plain text
+    spine = read_spine(args.epub, use_cache=not args.no_cache, fields=("text",))
+
+    with args.clean_json.open("r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    if "annotations" in data and "meta" in data:
+        data, located = relocate_ibooks_json(data, spine)
+        total = sum(len(c["entries"]) for c in data["annotations"])
+    else:
+        if not args.kindle_title or args.kindle_title not in data:
+            raise ValueError("Kindle JSON needs --kindle-title matching one of its books")
+        items = data[args.kindle_title]
+        located = relocate_kindle_items(items, spine)
+        total = len(items)
+
+    with args.clean_json.open("w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+    print(f"✔ Located {located} / {total} highlights in {args.epub.name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from paths import DERIVED_DATA_DIR
+
+
+CACHE_PATH = DERIVED_DATA_DIR / "notion_http_cache.sqlite"
+MAX_BYTES = 64 * 1024 * 1024
+
+# Notion rounds last_edited_time down to the minute, so an edit made in the
+# same minute as the fetch does not move it. Responses fetched that close
+# to the version stamp are not trusted.
+VERSION_GRANULARITY_S = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key         TEXT PRIMARY KEY,
+    scope       TEXT NOT NULL,
+    version     TEXT NOT NULL,
+    body        BLOB NOT NULL,
+    size        INTEGER NOT NULL,
+    fetched_at  REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_scope ON responses(scope);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed_at);
+"""
+
+
+def request_key(method: str, path: str, payload: Optional[dict] = None) -> str:
+    raw = json.dumps([method, path.strip("/"), payload or {}], sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _version_epoch(version: str) -> float:
+    # "2024-05-01T10:12:00.000Z|..." -> epoch of the first stamp
+    stamp = version.split("|", 1)[0]
+    try:
+        return datetime.fromisoformat(stamp.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return 0.0
+
+
+class ResponseCache:
+    """
+    Read-through store for Notion GET/query responses: zlib-compressed JSON
+    in SQLite, each entry tagged with the scope object it depends on (a
+    page or database id) and that object's last_edited_time. Least
+    recently used entries are evicted past ``max_bytes``.
+    """
+
+    def __init__(self, path: Path = CACHE_PATH, max_bytes: int = MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def get(self, key: str, version: str, max_age: Optional[float] = None) -> Optional[dict]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT version, body, fetched_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[0] != version:
+                return None
+            if row[2] < _version_epoch(version) + VERSION_GRANULARITY_S:
+                return None
+            if max_age is not None and row[2] < time.time() - max_age:
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return json.loads(zlib.decompress(row[1]))
+
+    def peek(self, key: str) -> Optional[dict]:
+        """
+        Last stored answer for ``key`` whatever its version; only good for
+        hints such as whether a query needed more than one page.
+        """
+        with self._lock:
+            row = self.conn.execute("SELECT body FROM responses WHERE key = ?", (key,)).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row else None
+
+    def put(self, key: str, scope: str, version: str, data: dict) -> None:
+        body = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, scope, version, body, size, fetched_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, scope, version, body, len(body), now, now),
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ).fetchall():
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def invalidate(self, scope: str) -> None:
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM responses WHERE scope = ?", (scope,))
+
+    def clear(self) -> None:
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM responses")
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def add_cache_args(parser) -> None:
+    parser.add_argument("--no-cache", action="store_true",
+                        help="bypass the on-disk Notion response cache")
@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import json
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from paths import LOG_DIR
+
+
+REPORT_DIR = LOG_DIR / "run_reports"
+HISTORY_FILE = LOG_DIR / "run_history.jsonl"
+
+
+class Profiler:
+    """
+    Lightweight run instrumentation: named spans (count / total / max
+    seconds, optional tracemalloc peak) and integer counters. Spans with
+    the same name are aggregated, so wrapping a per-request call is cheap.
+
+    The tracemalloc peak is process-wide, so it is only measured for spans
+    entered while no other span is open (on any thread): their peak is the
+    growth above the memory traced at entry, including nested spans.
+    """
+
+    def __init__(self, run_name: str = "run", trace_memory: bool = False):
+        self.run_name = run_name
+        self.trace_memory = trace_memory
+        self.started = datetime.now()
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._open = 0
+        self.spans: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {"count": 0, "total_s": 0.0, "max_s": 0.0, "peak_bytes": 0}
+        )
+        self.counters: Dict[str, int] = defaultdict(int)
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        with self._lock:
+            outermost = self._open == 0
+            self._open += 1
+            if self.trace_memory and outermost:
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._open -= 1
+                peak = tracemalloc.get_traced_memory()[1] - baseline if self.trace_memory and outermost else 0
+                s = self.spans[name]
+                s["count"] += 1
+                s["total_s"] += elapsed
+                s["max_s"] = max(s["max_s"], elapsed)
+                s["peak_bytes"] = max(s["peak_bytes"], peak)
+
+    def incr(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += n
+
+    # -----------------------------
+    # Reporting
+    # -----------------------------
+    def report(self) -> dict:
+        return {
+            "run": self.run_name,
+            "started": self.started.isoformat(timespec="seconds"),
+            "duration_s": round(time.perf_counter() - self._t0, 4),
+            "spans": {k: {**v, "total_s": round(v["total_s"], 4), "max_s": round(v["max_s"], 4)}
+                      for k, v in sorted(self.spans.items())},
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def write_report(self) -> Path:
+        """
+        Write the JSON report and append a line to the run history.
+        """
+        report = self.report()
+        REPORT_DIR.mkdir(parents=True, exist_ok=True)
+
+        path = REPORT_DIR / f"{self.run_name}_{self.started.strftime('%Y%m%d_%H%M%S')}.json"
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+        with open(HISTORY_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(report, ensure_ascii=False) + "\n")
+
+        return path
+
+    def print_summary(self, previous: Optional[dict] = None) -> None:
+        report = self.report()
+        prev_spans = (previous or {}).get("spans", {})
+
+        print(f"\n──────── PROFILE: {self.run_name} ({report['duration_s']:.2f}s) ────────")
+        print(f"{'span':<32} {'n':>6} {'total s':>9} {'max s':>8} {'peak MB':>8} {'Δ total':>9}")
+        for name, s in report["spans"].items():
+            delta = ""
+            if name in prev_spans:
+                delta = f"{s['total_s'] - prev_spans[name]['total_s']:+.2f}"
+            print(f"{name:<32} {s['count']:>6} {s['total_s']:>9.3f} {s['max_s']:>8.3f} "
+                  f"{s['peak_bytes'] / 1e6:>8.1f} {delta:>9}")
+
+        if report["counters"]:
+            print("counters: " + ", ".join(f"{k}={v}" for k, v in report["counters"].items()))
+
+
+# -----------------------------
+# Process-wide profiler
+# -----------------------------
+_active: Optional[Profiler] = None
+
+
+def enable(run_name: str, trace_memory: bool = False) -> Profiler:
+    global _active
+    _active = Profiler(run_name, trace_memory)
+    return _active
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    Time a block on the active profiler; a no-op when profiling is off.
+    """
+    if _active is None:
+        yield
+        return
+    with _active.span(name):
+        yield
+
+
+def incr(name: str, n: int = 1) -> None:
+    if _active is not None:
+        _active.incr(name, n)
+
+
+def last_report(run_name: str) -> Optional[dict]:
+    if not HISTORY_FILE.exists():
+        return None
+
+    previous = None
+    with open(HISTORY_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry.get("run") == run_name:
+                previous = entry
+    return previous
+
+
+def finish() -> Optional[Path]:
+    """
+    Write the report for the active profiler and print the summary table
+    (with deltas against the previous run of the same name).
+    """
+    if _active is None:
+        return None
+
+    previous = last_report(_active.run_name)
+    _active.print_summary(previous)
+    path = _active.write_report()
+    print(f"📄 Profile written to {path}")
+    return path
+
+
+def add_profile_args(parser) -> None:
+    parser.add_argument("--profile", action="store_true",
+                        help="record stage timings/counters and write a run report to data/log")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="with --profile: also record tracemalloc peaks (slower)")
@@ -1,13 +1,16 @@
-import os
+import argparse
 import json
+from itertools import islice
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 
-import requests
-from dotenv import load_dotenv
 from tqdm import tqdm
 
-from utils_books import normalize_title
+from http_cache import add_cache_args
+import instrumentation
+from instrumentation import span
+from notion_client import NotionClient
+import warehouse
 
 # -----------------------------
 # Paths
@@ -18,23 +21,6 @@ CLEAN_DIR = ROOT / "data" / "clean"
 if not CLEAN_DIR.exists():
     raise RuntimeError(f"Clean directory not found: {CLEAN_DIR}")
 
-# -----------------------------
-# Environment
-# -----------------------------
-load_dotenv(ROOT / ".env")
-
-NOTION_API_KEY = os.getenv("NOTION_API_KEY")
-NOTION_DATABASE_ID = os.getenv("NOTION_DATABASE_ID")
-
-if not NOTION_API_KEY or not NOTION_DATABASE_ID:
-    raise ValueError("Missing NOTION_API_KEY or NOTION_DATABASE_ID")
-
-HEADERS = {
-    "Authorization": f"Bearer {NOTION_API_KEY}",
-    "Notion-Version": "2022-06-28",
-    "Content-Type": "application/json",
-}
-
 # -----------------------------
 # Explicit JSON → Notion mapping
 # -----------------------------
@@ -46,129 +32,201 @@ BOOK_TO_NOTION_MAP = {
 
 }
 
+BATCH_SIZE = 100          # children per PATCH (Notion limit)
+TEXT_LIMIT = 2000         # characters per rich_text item (Notion limit)
+
 # -----------------------------
 # Notion-safe rich text
 # -----------------------------
 def rt(text: str) -> dict:
-    return {
-        "type": "text",
-        "text": {"content": text},
-        "annotations": {
-            "bold": False,
-            "italic": False,
-            "strikethrough": False,
-            "underline": False,
-            "code": False,
-            "color": "default",
-        },
-    }
+    # Notion fills in default annotations; sending them only bloats the payload
+    return {"type": "text", "text": {"content": text}}
+
+
+def rich_text(text: str) -> list[dict]:
+    """
+    ``text`` as rich_text items of at most 2000 characters each.
+    """
+    return [rt(text[i:i + TEXT_LIMIT]) for i in range(0, len(text), TEXT_LIMIT)] or [rt("")]
 
 # -----------------------------
 # Notion helpers
 # -----------------------------
-def find_notion_page_id(page_title: str) -> Optional[str]:
-    start_cursor = None
-    normalized_target = normalize_title(page_title)
-
-    while True:
-        payload = {"page_size": 100}
-        if start_cursor:
-            payload["start_cursor"] = start_cursor
-
-        res = requests.post(
-            f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query",
-            headers=HEADERS,
-            json=payload,
-        )
-        res.raise_for_status()
-        data = res.json()
-
-        for page in data.get("results", []):
-            title_prop = page["properties"].get("Title", {}).get("title", [])
-            if not title_prop:
-                continue
-
-            notion_title = title_prop[0]["plain_text"]
-            if normalize_title(notion_title) == normalized_target:
-                return page["id"]
-
-        if not data.get("has_more"):
-            break
-
-        start_cursor = data.get("next_cursor")
-
-    return None
-
-
-def append_blocks(parent_block_id: str, blocks: list[dict], label: str):
-    batches = [blocks[i:i + 100] for i in range(0, len(blocks), 100)]
-
-    for batch in tqdm(batches, desc=f"Appending blocks for '{label}'", unit="batch"):
-        while True:
-            res = requests.patch(
-                f"https://api.notion.com/v1/blocks/{parent_block_id}/children",
-                headers=HEADERS,
-                json={"children": batch},
-            )
-            if res.status_code == 429:
-                import time
-                time.sleep(int(res.headers.get("Retry-After", 1)))
-                continue
-            res.raise_for_status()
-            break
+def find_notion_page_id(client: NotionClient, page_title: str) -> Optional[str]:
+    return client.find_page_id(page_title)
+
+
+def batched(items: Iterable, size: int = BATCH_SIZE) -> Iterator[list]:
+    it = iter(items)
+    while batch := list(islice(it, size)):
+        yield batch
+
+
+def append_blocks(client: NotionClient, parent_block_id: str, blocks: Iterable[dict], label: str) -> list[str]:
+    """
+    Append ``blocks`` in batches of 100; returns the ids of the created blocks.
+    ``blocks`` may be a generator: each batch is sent as soon as it is rendered.
+    """
+    created = []
+
+    for batch in tqdm(batched(blocks), desc=f"Appending blocks for '{label}'", unit="batch"):
+        created.extend(block["id"] for block in client.append_children(parent_block_id, batch))
+
+    return created
 
 # -----------------------------
-# Main
+# Book loading
 # -----------------------------
-json_files = list(BOOK_TO_NOTION_MAP.keys())
-print(f"📚 Processing {len(json_files)} book(s).")
+def load_book(json_name: str) -> dict:
+    """
+    Book document in the epub_parser JSON shape: from the warehouse if the
+    book is there (indexed lookup by export name), else from data/clean.
+    """
+    conn = warehouse.connect()
+    try:
+        row = warehouse.find_book_by_export_name(conn, Path(json_name).stem)
+        if row is not None:
+            return warehouse.book_document(conn, row)
+    finally:
+        conn.close()
 
-for json_name in tqdm(json_files, desc="Books", unit="book"):
     json_path = CLEAN_DIR / json_name
     if not json_path.exists():
         raise RuntimeError(f"JSON not found: {json_name}")
 
     with open(json_path, "r", encoding="utf-8") as f:
-        book = json.load(f)
-
-    notion_page_title = BOOK_TO_NOTION_MAP[json_name]
-    print(f"🔎 Looking for Notion page: {notion_page_title}")
-
-    page_id = find_notion_page_id(notion_page_title)
-    if not page_id:
-        raise RuntimeError(
-            f"❌ No Notion page found for '{notion_page_title}'. "
-            f"Check database ID and Title property."
-        )
-
-    blocks = []
-
+        return json.load(f)
+
+
+def library_books(conn) -> list[tuple[dict, str]]:
+    """
+    Every book with live highlights, from the warehouse (or, before the
+    first load, every JSON in data/clean), with its display title: the
+    Notion title for mapped books, else the book title. A title shared by
+    several books (iBooks and Kindle copies) gets the source appended.
+    """
+    books = []
+    for row in warehouse.iter_books(conn):
+        document = warehouse.book_document(conn, row)
+        if document["annotations"]:
+            title = BOOK_TO_NOTION_MAP.get(f"{row['export_name']}.json", row["title"])
+            books.append((document, title, row["source"]))
+
+    if not books:
+        for json_path in sorted(CLEAN_DIR.glob("*.json")):
+            with open(json_path, "r", encoding="utf-8") as f:
+                document = json.load(f)
+            if isinstance(document, dict) and "annotations" in document:
+                title = BOOK_TO_NOTION_MAP.get(json_path.name, document.get("meta", {}).get("source_title") or json_path.stem)
+                books.append((document, title, "ibooks"))
+
+    seen: set[str] = set()
+    result = []
+    for document, title, source in books:
+        if title in seen:
+            title = f"{title} ({source})"
+        seen.add(title)
+        result.append((document, title))
+    return result
+
+
+def chapter_heading(chapter: dict) -> str:
+    # iBooks chapter ids like "bm12" / "xhtml/ch03" are not worth showing
+    raw = (chapter.get("chapter") or "").strip()
+    return raw if raw and not raw.lower().startswith(("bm", "cfi", "xhtml", "unknown")) else "Chapter"
+
+
+def entry_text(entry: dict) -> str:
+    text = entry.get("highlight") or ""
+    if entry.get("note"):
+        text += f"\nNote: {entry['note']}"
+    return text
+
+
+def build_blocks(book: dict) -> list[dict]:
+    return [block for block, _ in iter_keyed_blocks(book)]
+
+
+def iter_keyed_blocks(book: dict, headings: bool = True) -> Iterator[tuple[dict, Optional[str]]]:
+    """
+    Lazily yield the blocks for ``book`` with, per block, the fingerprint of
+    the annotation it renders (None for headings or entries without one).
+    Without ``headings`` only the entry paragraphs are rendered.
+    """
     for chapter in book.get("annotations", []):
-        raw = (chapter.get("chapter") or "").strip()
-        chapter_title = raw if raw and not raw.lower().startswith(("bm", "cfi", "xhtml", "unknown")) else "Chapter"
-
-        blocks.append({
-            "type": "heading_2",
-            "heading_2": {"rich_text": [rt(chapter_title)]}
-        })
+        if headings:
+            yield {"type": "heading_2", "heading_2": {"rich_text": rich_text(chapter_heading(chapter))}}, None
 
         for entry in chapter.get("entries", []):
-            text = entry.get("highlight") or ""
-            if entry.get("note"):
-                text += f"\nNote: {entry['note']}"
-
+            text = entry_text(entry)
             if text.strip():
-                blocks.append({
-                    "type": "paragraph",
-                    "paragraph": {"rich_text": [rt(text)]}
-                })
+                yield {"type": "paragraph", "paragraph": {"rich_text": rich_text(text)}}, entry.get("fingerprint")
 
-    if not blocks:
-        print(f"⚠️ No blocks generated for '{notion_page_title}'")
-        continue
 
-    append_blocks(page_id, blocks, notion_page_title)
+def record_synced(conn, book_id: Optional[int], page_id: str, keys: list[Optional[str]],
+                  block_ids: list[str]) -> None:
+    # documents read from JSON exports carry no book id (and no fingerprints)
+    if book_id is None:
+        return
+    with conn:
+        warehouse.mark_synced(conn, [
+            (book_id, key, page_id, block_id) for key, block_id in zip(keys, block_ids) if key
+        ])
 
-    print(f"✅ Updated Notion page: {notion_page_title}")
 
-print("🎉 All done.")
+# -----------------------------
+# Main
+# -----------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Write book highlights to Notion pages and/or a Markdown vault.")
+    parser.add_argument("--sink", action="append", choices=("notion", "markdown"),
+                        help="destination(s); repeat for several (default: notion)")
+    parser.add_argument("--vault", type=Path, default=None, help="Markdown vault directory")
+    parser.add_argument("--layout", choices=("page", "chapters"), default="page",
+                        help="Notion: all highlights on the book page, or one sub-page per chapter")
+    parser.add_argument("--chapter-blocks", type=int, default=0,
+                        help="with --layout chapters: pack chapters into pages of at most N blocks")
+    add_cache_args(parser)
+    instrumentation.add_profile_args(parser)
+    args = parser.parse_args()
+
+    # sinks builds on the renderer in this module
+    from sinks import VAULT_DIR, MarkdownSink, NotionSink
+
+    if args.profile:
+        instrumentation.enable("json_to_notion_page", trace_memory=args.trace_memory)
+
+    targets = args.sink or ["notion"]
+    conn = warehouse.connect()
+
+    sinks = []
+    if "notion" in targets:
+        sinks.append(NotionSink(NotionClient(use_cache=not args.no_cache), conn,
+                                layout=args.layout, max_blocks=args.chapter_blocks))
+    if "markdown" in targets:
+        sinks.append(MarkdownSink(args.vault or VAULT_DIR))
+
+    for sink in sinks:
+        if sink.name == "notion":
+            # only books with a page in the Notion database
+            books = []
+            for json_name in BOOK_TO_NOTION_MAP:
+                with span("notion.load_book"):
+                    books.append((load_book(json_name), BOOK_TO_NOTION_MAP[json_name]))
+        else:
+            # local sinks need no network: export the whole library
+            with span("sinks.load_library"):
+                books = library_books(conn)
+        print(f"📚 {sink.name}: processing {len(books)} book(s).")
+
+        written = sink.write_books(tqdm(books, desc=f"Books → {sink.name}", unit="book"))
+        print(f"✔ {sink.name}: {sum(written.values())} item(s) written for {len(written)} book(s)")
+
+    conn.close()
+    print("🎉 All done.")
+
+    instrumentation.finish()
+
+
+if __name__ == "__main__":
+    main()
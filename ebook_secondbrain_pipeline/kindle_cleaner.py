@@ -1,22 +1,39 @@
 from __future__ import annotations
 
+import argparse
+import hashlib
 import json
+import os
 import re
 from collections import defaultdict
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
+
+import instrumentation
+from instrumentation import span
+from search_index import index_records, kindle_records
+from utils_books import export_name
+from warehouse import load_kindle
 
 
 ROOT = Path(__file__).resolve().parents[1]
 CLEAN_DIR = ROOT / "data" / "clean"
 RAW_DIR = ROOT / "data" / "raw"
+SHARD_DIR = CLEAN_DIR / "kindle_shards"
+SHARD_INDEX_NAME = "index.json"
+
+OUTPUT_FORMATS = ("json", "ndjson", "both")
 
+TITLE_AUTHOR_PATTERN = re.compile(r"^(?P<title>.*?)\s*\((?P<author>[^()]*)\)\s*$")
 FILENAME_DATE_PATTERN = re.compile(r"^(?P<date>\d{8})_kindle_annotations_raw\.txt$")
-PAGE_PATTERN = re.compile(r"Seite\s+([\d\-]+)")
-TIMESTAMP_PATTERN = re.compile(r"Hinzugefügt am (.+)$")
-META_PREFIX = "- Deine Markierung"
+# German and English Kindle firmware
+PAGE_PATTERN = re.compile(r"(?:Seite|page)\s+([\d\-]+)")
+TIMESTAMP_PATTERN = re.compile(r"(?:Hinzugefügt am|Added on) (.+)$")
+META_PREFIXES = ("- Deine Markierung", "- Your Highlight")
 SEPARATOR = "=========="
+# "Wednesday, January 3, 2024 10:00:00 [PM]" (US) / "Wednesday, 3 January 2024 10:00:00" (UK)
+ENGLISH_TIMESTAMP_FORMATS = ("%A, %B %d, %Y %I:%M:%S %p", "%A, %B %d, %Y %H:%M:%S", "%A, %d %B %Y %H:%M:%S")
 
 
 def extract_date_from_filename(path: Path) -> datetime:
@@ -56,11 +73,28 @@ def normalize_title(title: str) -> str:
     return title.lstrip("\ufeff").strip()
 
 
+def split_title_author(title: str) -> tuple:
+    """
+    "Essentialism (McKeown, Greg)" -> ("Essentialism", "McKeown, Greg")
+    """
+    match = TITLE_AUTHOR_PATTERN.match(title)
+    if not match or not match.group("title"):
+        return title, None
+    return match.group("title"), match.group("author").strip() or None
+
+
 def normalize_timestamp(raw: str) -> str:
     """
     Donnerstag, 25. Dezember 2025 12:01:07
     -> 2025-12-25T12:01:07
+    (English stamps: see ``ENGLISH_TIMESTAMP_FORMATS``)
     """
+    for fmt in ENGLISH_TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(raw.strip(), fmt).isoformat()
+        except ValueError:
+            continue
+
     _, rest = raw.split(",", 1)
     rest = rest.strip()
 
@@ -82,7 +116,7 @@ def normalize_timestamp(raw: str) -> str:
         "Dezember": "12",
     }
 
-    iso = f"{year}-{months[month]}-{day.zfill(2)}T{time}"
+    iso = f"{year}-{months[month]}-{day.rstrip('.').zfill(2)}T{time}"
     return iso
 
 
@@ -104,7 +138,7 @@ def parse_kindle_annotations(text: str) -> Dict[str, List[Dict[str, str]]]:
         title = normalize_title(lines[i])
         meta = lines[i + 1].strip()
 
-        if not title or not meta.startswith(META_PREFIX):
+        if not title or not meta.startswith(META_PREFIXES):
             i += 1
             continue
 
@@ -114,20 +148,15 @@ def parse_kindle_annotations(text: str) -> Dict[str, List[Dict[str, str]]]:
         page = page_match.group(1) if page_match else None
         timestamp = normalize_timestamp(ts_match.group(1)) if ts_match else None
 
-        # annotation text starts after empty line
+        # annotation text starts after empty line and runs up to the
+        # separator; the next entry (maybe of another book) starts after it
         j = i + 3
         annotation_lines = []
 
-        while j < len(lines) and lines[j].strip():
+        while j < len(lines) and lines[j].strip() != SEPARATOR:
             line = lines[j].strip()
-            if (
-                line == SEPARATOR
-                or line == title
-                or line.startswith(META_PREFIX)
-            ):
-                j += 1
-                continue
-            annotation_lines.append(line)
+            if line:
+                annotation_lines.append(line)
             j += 1
 
         annotation_text = "\n".join(annotation_lines).strip()
@@ -149,21 +178,161 @@ def parse_kindle_annotations(text: str) -> Dict[str, List[Dict[str, str]]]:
     return grouped
 
 
-def main() -> None:
-    raw_file = select_and_cleanup_raw_files(delete_old=True)
+# -----------------------------
+# Per-book NDJSON shards
+# -----------------------------
+def shard_lines(items: List[Dict[str, str]]) -> bytes:
+    return b"".join(
+        json.dumps(item, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+        for item in items
+    )
+
+
+def read_shard_index(shard_dir: Path = SHARD_DIR) -> dict:
+    """
+    ``{"source": raw file, "books": {title: {"shard", "records", "hash"}}}``
+    """
+    path = shard_dir / SHARD_INDEX_NAME
+    if not path.exists():
+        return {"source": None, "books": {}}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_shards(grouped: Dict[str, List[Dict[str, str]]], source: str,
+                 shard_dir: Path = SHARD_DIR) -> Dict[str, int]:
+    """
+    One ``<title>__<author>.ndjson`` per book plus ``index.json``. Shards
+    whose content hash matches the index are left alone; shards of books
+    no longer in the export are removed.
+    """
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    previous = read_shard_index(shard_dir)["books"]
+
+    books = {}
+    used = set()
+    written = 0
+    for raw_title, items in grouped.items():
+        data = shard_lines(items)
+        digest = hashlib.sha1(data).hexdigest()
+
+        name = export_name(*split_title_author(raw_title)) or "untitled"
+        if name in used:
+            # two raw titles normalising to the same name
+            name = f"{name}_{hashlib.sha1(raw_title.encode('utf-8')).hexdigest()[:8]}"
+        used.add(name)
+        shard = f"{name}.ndjson"
+
+        known = previous.get(raw_title)
+        if not (known and known["hash"] == digest and known["shard"] == shard and (shard_dir / shard).exists()):
+            tmp = shard_dir / f".{shard}.tmp"
+            tmp.write_bytes(data)
+            os.replace(tmp, shard_dir / shard)
+            written += 1
+            instrumentation.incr("kindle.shards.bytes", len(data))
+
+        books[raw_title] = {"shard": shard, "records": len(items), "hash": digest}
+
+    wanted = {entry["shard"] for entry in books.values()}
+    removed = 0
+    for entry in previous.values():
+        if entry["shard"] not in wanted and (shard_dir / entry["shard"]).exists():
+            (shard_dir / entry["shard"]).unlink()
+            removed += 1
+
+    index_path = shard_dir / SHARD_INDEX_NAME
+    tmp = index_path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"source": source, "books": books}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, index_path)
+
+    return {"books": len(books), "written": written, "removed": removed}
+
+
+def iter_book(title: str, shard_dir: Path = SHARD_DIR) -> Iterator[Dict[str, str]]:
+    """
+    Lazily yield the clippings of one book (raw Kindle title, or title
+    without the author) from its shard; nothing else is read.
+    """
+    books = read_shard_index(shard_dir)["books"]
+    entry = books.get(title)
+    if entry is None:
+        entry = next((e for raw, e in books.items() if split_title_author(raw)[0] == title), None)
+    if entry is None:
+        raise KeyError(title)
+
+    with open(shard_dir / entry["shard"], "r", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def load_book(title: str, shard_dir: Path = SHARD_DIR) -> List[Dict[str, str]]:
+    return list(iter_book(title, shard_dir))
+
+
+def clean_raw_file(raw_file: Path, warehouse_conn=None, index_conn=None, output: str = "json") -> dict:
+    """
+    Parse one raw clippings file, write the clean JSON (and/or per-book
+    NDJSON shards, see ``output``) and load the result into the warehouse
+    and search index (optionally on open connections).
+    """
+    if output not in OUTPUT_FORMATS:
+        raise ValueError(f"output must be one of {OUTPUT_FORMATS}, got {output!r}")
 
-    raw_text = raw_file.read_text(encoding="utf-8")
-    grouped = parse_kindle_annotations(raw_text)
+    with span("kindle.read_raw"):
+        raw_text = raw_file.read_text(encoding="utf-8")
+    with span("kindle.parse"):
+        grouped = parse_kindle_annotations(raw_text)
+    instrumentation.incr("kindle.raw_bytes", len(raw_text.encode("utf-8")))
+    instrumentation.incr("kindle.books", len(grouped))
+    instrumentation.incr("kindle.annotations", sum(len(v) for v in grouped.values()))
 
     output_date = raw_file.name[:8]
     output_path = CLEAN_DIR / f"{output_date}_kindle_annotations_clean.json"
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
-    with output_path.open("w", encoding="utf-8") as f:
-        json.dump(grouped, f, ensure_ascii=False, indent=2)
+    if output in ("json", "both"):
+        with span("kindle.json.write"), output_path.open("w", encoding="utf-8") as f:
+            json.dump(grouped, f, ensure_ascii=False, indent=2)
+
+    shards = None
+    if output in ("ndjson", "both"):
+        with span("kindle.shards.write"):
+            shards = write_shards(grouped, raw_file.name)
+
+    with span("kindle.warehouse.upsert"):
+        loaded = load_kindle(grouped, conn=warehouse_conn)
+    with span("kindle.search_index"):
+        stats = index_records(kindle_records(grouped), conn=index_conn)
+
+    return {"output_path": output_path, "shards": shards, "warehouse": loaded, "index": stats}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Clean the newest Kindle clippings export.")
+    parser.add_argument("--output", choices=OUTPUT_FORMATS, default="json",
+                        help="one clean JSON, per-book NDJSON shards with an index, or both")
+    instrumentation.add_profile_args(parser)
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.enable("kindle_cleaner", trace_memory=args.trace_memory)
+
+    raw_file = select_and_cleanup_raw_files(delete_old=True)
+    result = clean_raw_file(raw_file, output=args.output)
+    loaded = result["warehouse"]
+    stats = result["index"]
 
     print(f"✔ Selected raw file: {raw_file.name}")
-    print(f"✔ Clean JSON written to: {output_path}")
+    if args.output != "ndjson":
+        print(f"✔ Clean JSON written to: {result['output_path']}")
+    if result["shards"]:
+        shards = result["shards"]
+        print(f"✔ Shards in {SHARD_DIR}: {shards['books']} book(s), {shards['written']} rewritten, {shards['removed']} removed")
+    print(f"✔ Warehouse: {loaded.get('inserted', 0)} new, {loaded.get('updated', 0)} changed, {loaded.get('deleted', 0)} removed")
+    print(f"✔ Search index: {stats['inserted']} new, {stats['deleted']} removed")
+
+    instrumentation.finish()
 
 
 if __name__ == "__main__":
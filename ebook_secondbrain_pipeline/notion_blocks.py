@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterator, List, Optional, Tuple
+
+from instrumentation import span
+
+
+DEFAULT_WORKERS = 8
+
+# Blocks whose children live on another page; not descended by default
+PAGE_TYPES = ("child_page", "child_database")
+
+
+def plain_text(block: dict) -> str:
+    data = block.get(block["type"]) or {}
+    return "".join(item.get("plain_text", "") for item in data.get("rich_text", []))
+
+
+def compact(block: dict) -> dict:
+    """
+    Keep only what diffs need: id, type, plain text, children.
+    """
+    return {
+        "id": block["id"],
+        "type": block["type"],
+        "text": plain_text(block),
+        "has_children": block.get("has_children", False),
+        "children": [],
+    }
+
+
+def list_children(client, block_id: str, scope: Optional[str] = None) -> List[dict]:
+    """
+    Every direct child of ``block_id``, following ``next_cursor``. With a
+    ``scope`` (the page the block lives on) answers come from the response
+    cache while that page is unchanged.
+    """
+    children = []
+    params = {"page_size": 100}
+
+    while True:
+        path = f"blocks/{block_id}/children"
+        if scope:
+            data = client.cached_request("GET", path, scope=scope, params=dict(params))
+        else:
+            data = client.get(path, params=params)
+        children.extend(data.get("results", []))
+
+        if not data.get("has_more"):
+            return children
+        params["start_cursor"] = data["next_cursor"]
+
+
+def fetch_tree(client, block_id: str, workers: int = DEFAULT_WORKERS,
+               descend_pages: bool = False) -> List[dict]:
+    """
+    Full block tree below ``block_id`` as compact nodes. Pagination within
+    one parent is sequential; different parents are fetched concurrently,
+    all under the client's shared rate limit. Every level is cached under
+    the last_edited_time of the page it belongs to (edits anywhere on a
+    page move it): the root, or with ``descend_pages`` the child page.
+    """
+    roots: List[dict] = []
+
+    with span("notion.fetch_tree"), ThreadPoolExecutor(max_workers=workers) as pool:
+        # future -> (list to fill, page the children belong to)
+        pending = {pool.submit(list_children, client, block_id, block_id): (roots, block_id)}
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                target, page = pending.pop(future)
+                for block in future.result():
+                    node = compact(block)
+                    target.append(node)
+                    if node["has_children"] and (descend_pages or node["type"] not in PAGE_TYPES):
+                        # a child page's edits do not move its parent's timestamp
+                        scope = node["id"] if node["type"] in PAGE_TYPES else page
+                        pending[pool.submit(list_children, client, node["id"], scope)] = (node["children"], scope)
+
+    return roots
+
+
+def walk(nodes: List[dict], depth: int = 0) -> Iterator[Tuple[int, dict]]:
+    """
+    Depth-first ``(depth, node)`` in page order.
+    """
+    for node in nodes:
+        yield depth, node
+        yield from walk(node["children"], depth + 1)
+
+
+def count_blocks(nodes: List[dict]) -> int:
+    return sum(1 for _ in walk(nodes))
@@ -0,0 +1,360 @@
+from __future__ import annotations
+
+import json as jsonlib
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterator, Optional, Tuple
+
+import requests
+from dotenv import load_dotenv
+
+try:
+    import orjson
+except ImportError:  # optional: stdlib json is ~5x slower on big payloads
+    orjson = None
+
+from http_cache import ResponseCache, request_key
+import instrumentation
+import notion_schema
+from paths import ROOT
+from utils_books import normalize_title
+
+
+# -----------------------------
+# Environment
+# -----------------------------
+load_dotenv(ROOT / ".env")
+
+NOTION_API_KEY = os.getenv("NOTION_API_KEY")
+NOTION_DATABASE_ID = os.getenv("NOTION_DATABASE_ID")
+
+API_URL = "https://api.notion.com/v1"
+NOTION_VERSION = "2022-06-28"
+
+# Notion allows an average of ~3 requests per second per integration
+DEFAULT_RATE = 3.0
+MAX_RETRIES = 5
+# (connect, read) seconds; a stalled connection is retried like a 5xx
+TIMEOUT = (10.0, 60.0)
+
+# A version probe is trusted this long, so long-lived clients (watch,
+# outbox workers) see edits made elsewhere within a minute.
+VERSION_TTL_S = 60.0
+# Archiving a page moves no timestamp a probe can see (archived pages leave
+# the query results), so cached database queries also expire by age.
+DATABASE_MAX_AGE_S = 15 * 60
+
+ID_SEGMENT = re.compile(r"^[0-9a-fA-F]{8}-?([0-9a-fA-F]{4}-?){3}[0-9a-fA-F]{12}$")
+
+
+def encode_json(payload) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return jsonlib.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def decode_json(content: bytes):
+    return orjson.loads(content) if orjson is not None else jsonlib.loads(content)
+
+
+def endpoint_name(method: str, path: str) -> str:
+    """
+    "PATCH", "blocks/<uuid>/children" -> "http.PATCH blocks/{id}/children"
+    """
+    parts = ["{id}" if ID_SEGMENT.match(p) else p for p in path.strip("/").split("/")]
+    return f"http.{method} {'/'.join(parts)}"
+
+
+class RateLimiter:
+    """
+    Thread-safe spacing of requests to at most ``rate`` per second.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE):
+        self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def backoff(self, seconds: float) -> None:
+        """
+        Push every caller back after a 429.
+        """
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+class NotionClient:
+    """
+    Small wrapper around one ``requests.Session``: keeps the connection
+    warm, shares one rate limit across threads and retries 429/5xx and
+    dropped or timed-out connections.
+    Database queries and block children are served from the on-disk
+    response cache while their page/database is unchanged.
+    """
+
+    def __init__(self, api_key: Optional[str] = None, database_id: Optional[str] = None,
+                 rate: float = DEFAULT_RATE, use_cache: bool = True):
+        self.api_key = api_key or NOTION_API_KEY
+        self.database_id = database_id or NOTION_DATABASE_ID
+
+        if not self.api_key or not self.database_id:
+            raise ValueError("Missing NOTION_API_KEY or NOTION_DATABASE_ID")
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {self.api_key}",
+            "Notion-Version": NOTION_VERSION,
+            "Content-Type": "application/json",
+        })
+        self.limiter = RateLimiter(rate)
+        self._schema: Optional[dict] = None
+        self.cache = ResponseCache() if use_cache else None
+        self._versions: Dict[str, Tuple[str, float]] = {}
+        self._versions_lock = threading.Lock()
+
+    # -----------------------------
+    # Raw requests
+    # -----------------------------
+    def request(self, method: str, path: str, json: Optional[dict] = None,
+                params: Optional[dict] = None) -> dict:
+        url = f"{API_URL}/{path.lstrip('/')}"
+        name = endpoint_name(method, path)
+        body = encode_json(json) if json is not None else None
+
+        for attempt in range(MAX_RETRIES + 1):
+            if attempt:
+                instrumentation.incr("http.retries")
+
+            self.limiter.wait()
+            try:
+                with instrumentation.span(name):
+                    res = self.session.request(method, url, data=body, params=params, timeout=TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout):
+                instrumentation.incr("http.connection_errors")
+                if attempt == MAX_RETRIES:
+                    raise
+                time.sleep(2 ** attempt)
+                continue
+
+            instrumentation.incr("http.requests")
+            instrumentation.incr("http.bytes_sent", len(res.request.body or b""))
+            instrumentation.incr("http.bytes_received", len(res.content))
+
+            if res.status_code == 429:
+                instrumentation.incr("http.429")
+                self.limiter.backoff(float(res.headers.get("Retry-After", 1)))
+                continue
+            if res.status_code >= 500 and attempt < MAX_RETRIES:
+                time.sleep(2 ** attempt)
+                continue
+
+            res.raise_for_status()
+            return decode_json(res.content)
+
+        res.raise_for_status()
+        return decode_json(res.content)
+
+    def get(self, path: str, params: Optional[dict] = None) -> dict:
+        return self.request("GET", path, params=params)
+
+    def post(self, path: str, json: Optional[dict] = None) -> dict:
+        return self.request("POST", path, json=json)
+
+    def patch(self, path: str, json: Optional[dict] = None) -> dict:
+        return self.request("PATCH", path, json=json)
+
+    def delete(self, path: str) -> dict:
+        return self.request("DELETE", path)
+
+    # -----------------------------
+    # Cached reads
+    # -----------------------------
+    def object_version(self, object_id: str, kind: str = "block") -> str:
+        """
+        last_edited_time of a page/block, or for a database that of its
+        most recently edited page (one ``page_size=1`` query). Probes are
+        reused for VERSION_TTL_S.
+        """
+        now = time.monotonic()
+        with self._versions_lock:
+            cached = self._versions.get(object_id)
+            if cached is not None and now - cached[1] < VERSION_TTL_S:
+                return cached[0]
+
+        if kind == "database":
+            newest = self.post(f"databases/{object_id}/query", json={
+                "page_size": 1,
+                "sorts": [{"timestamp": "last_edited_time", "direction": "descending"}],
+            }).get("results", [])
+            version = newest[0]["last_edited_time"] if newest else ""
+        else:
+            version = self.get(f"blocks/{object_id}")["last_edited_time"]
+
+        with self._versions_lock:
+            self._versions[object_id] = (version, now)
+        return version
+
+    def cached_request(self, method: str, path: str, scope: str, kind: str = "block",
+                       json: Optional[dict] = None, params: Optional[dict] = None,
+                       max_age: Optional[float] = None) -> dict:
+        """
+        ``request`` through the response cache; entries are valid while
+        ``scope`` (the page or database the answer depends on) is unchanged
+        and, with ``max_age``, younger than that many seconds.
+        """
+        if self.cache is None:
+            return self.request(method, path, json=json, params=params)
+
+        version = self.object_version(scope, kind)
+        key = request_key(method, path, json if json is not None else params)
+
+        data = self.cache.get(key, version, max_age)
+        if data is not None:
+            instrumentation.incr("http.cache_hits")
+            return data
+
+        instrumentation.incr("http.cache_misses")
+        data = self.request(method, path, json=json, params=params)
+        self.cache.put(key, scope, version, data)
+        return data
+
+    def invalidate(self, scope: str) -> None:
+        """
+        Forget cached answers for ``scope`` after writing to it.
+        """
+        with self._versions_lock:
+            # nested blocks are cached under their page, so drop every probe
+            self._versions.clear()
+        if self.cache is not None:
+            self.cache.invalidate(scope)
+
+    # -----------------------------
+    # Schema
+    # -----------------------------
+    def schema(self, refresh: bool = False) -> dict:
+        """
+        Database schema, from data/derived/notion_schema.json when current.
+        """
+        if self._schema is None or refresh:
+            self._schema = notion_schema.get_schema(self, refresh=refresh)
+        return self._schema
+
+    def update_page_properties(self, page_id: str, properties: dict) -> dict:
+        """
+        PATCH page properties after checking them against the schema, so a
+        drifted property name fails locally instead of costing a request.
+        """
+        notion_schema.validate_properties(self.schema(), properties)
+        try:
+            result = self.patch(f"pages/{page_id}", json={"properties": properties})
+            self.invalidate(self.database_id)
+            return result
+        except requests.HTTPError as exc:
+            if exc.response is not None and exc.response.status_code == 400:
+                # the cached schema let a bad payload through: re-read next time
+                notion_schema.invalidate()
+                self._schema = None
+            raise
+
+    # -----------------------------
+    # Helpers
+    # -----------------------------
+    def query_database(self, payload: Optional[dict] = None) -> Iterator[dict]:
+        """
+        Yield every page of the database query, following ``next_cursor``.
+
+        The version probe costs a request, as much as a one-page answer, so
+        the cache is only used for queries that needed several pages last
+        time (remembered from the stored first page).
+        """
+        payload = dict(payload or {})
+        payload.setdefault("page_size", 100)
+        path = f"databases/{self.database_id}/query"
+
+        key = request_key("POST", path, payload)
+        first = self.cache.peek(key) if self.cache is not None else None
+        use_cache = bool(first and first.get("has_more"))
+
+        while True:
+            if use_cache:
+                data = self.cached_request("POST", path, scope=self.database_id, kind="database",
+                                           json=payload, max_age=DATABASE_MAX_AGE_S)
+            else:
+                data = self.request("POST", path, json=payload)
+                if self.cache is not None and "start_cursor" not in payload:
+                    # no version: never served, only read back by peek()
+                    self.cache.put(key, self.database_id, "", data)
+            yield from data.get("results", [])
+
+            if not data.get("has_more"):
+                break
+            payload["start_cursor"] = data.get("next_cursor")
+
+    def find_page_id(self, page_title: str, title_property: Optional[str] = None) -> Optional[str]:
+        schema = self.schema()
+        if title_property is None:
+            title_property = notion_schema.title_property(schema)
+        else:
+            notion_schema.validate_filter_property(schema, title_property, "title")
+
+        normalized_target = normalize_title(page_title)
+
+        for page in self.query_database():
+            title_prop = page["properties"].get(title_property, {}).get("title", [])
+            if title_prop and normalize_title(title_prop[0]["plain_text"]) == normalized_target:
+                return page["id"]
+
+        return None
+
+    def update_block(self, block_id: str, payload: dict, scope: Optional[str] = None) -> dict:
+        """
+        PATCH one block (e.g. ``{"paragraph": {"rich_text": [...]}}``).
+        """
+        data = self.patch(f"blocks/{block_id}", json=payload)
+        self.invalidate(scope or block_id)
+        return data
+
+    def archive_block(self, block_id: str, scope: Optional[str] = None) -> None:
+        """
+        Move a block to the trash; one that is already gone counts as archived.
+        """
+        try:
+            self.delete(f"blocks/{block_id}")
+        except requests.HTTPError as exc:
+            if exc.response is None or exc.response.status_code not in (400, 404):
+                raise
+        self.invalidate(scope or block_id)
+
+    def create_child_page(self, parent_id: str, title: str, children: list = ()) -> dict:
+        """
+        Create a page below ``parent_id`` with up to 100 initial blocks.
+        """
+        data = self.post("pages", json={
+            "parent": {"page_id": parent_id},
+            "properties": {"title": {"title": [{"type": "text", "text": {"content": title[:2000]}}]}},
+            "children": list(children),
+        })
+        self.invalidate(parent_id)
+        return data
+
+    def append_children(self, block_id: str, children: list, after: Optional[str] = None) -> list:
+        """
+        Append up to 100 blocks, or insert them below the child ``after``;
+        returns the created blocks (with ids).
+        """
+        payload = {"children": children}
+        if after:
+            payload["after"] = after
+        data = self.patch(f"blocks/{block_id}/children", json=payload)
+        self.invalidate(block_id)
+        return data.get("results", [])
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from paths import DERIVED_DATA_DIR
+
+
+SCHEMA_PATH = DERIVED_DATA_DIR / "notion_schema.json"
+
+# Within this window the cached schema is trusted without asking Notion;
+# afterwards the database is re-read and the cache only replaced when its
+# last_edited_time moved.
+MAX_AGE_SECONDS = 15 * 60
+
+# Computed properties Notion rejects in a page update
+READ_ONLY_TYPES = {
+    "formula", "rollup", "created_time", "created_by",
+    "last_edited_time", "last_edited_by", "unique_id", "verification",
+}
+
+RICH_TEXT_LIMIT = 2000
+
+
+# -----------------------------
+# Cache
+# -----------------------------
+def load_cached(database_id: str, path: Path = SCHEMA_PATH) -> Optional[dict]:
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        cached = json.load(f)
+    return cached if cached.get("database_id") == database_id else None
+
+
+def save_cached(schema: dict, path: Path = SCHEMA_PATH) -> None:
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(schema, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def schema_from_database(database: dict) -> dict:
+    return {
+        "database_id": database["id"].replace("-", ""),
+        "last_edited_time": database.get("last_edited_time"),
+        "checked_at": time.time(),
+        "properties": {
+            name: {"id": prop.get("id"), "type": prop["type"], prop["type"]: prop.get(prop["type"])}
+            for name, prop in database.get("properties", {}).items()
+        },
+    }
+
+
+def get_schema(client, refresh: bool = False, max_age: float = MAX_AGE_SECONDS,
+               path: Path = SCHEMA_PATH) -> dict:
+    """
+    Schema of ``client.database_id`` from the local cache; the database is
+    only fetched once the cache is older than ``max_age`` (or on ``refresh``).
+    """
+    database_id = client.database_id.replace("-", "")
+    cached = load_cached(database_id, path)
+
+    if cached and not refresh and time.time() - cached.get("checked_at", 0) < max_age:
+        return cached
+
+    database = client.get(f"databases/{client.database_id}")
+
+    if cached and cached.get("last_edited_time") == database.get("last_edited_time"):
+        cached["checked_at"] = time.time()
+        save_cached(cached, path)
+        return cached
+
+    schema = schema_from_database(database)
+    save_cached(schema, path)
+    return schema
+
+
+def invalidate(path: Path = SCHEMA_PATH) -> None:
+    path.unlink(missing_ok=True)
+
+
+# -----------------------------
+# Lookups & validation
+# -----------------------------
+def title_property(schema: dict) -> str:
+    for name, prop in schema["properties"].items():
+        if prop["type"] == "title":
+            return name
+    raise ValueError("Notion database has no title property")
+
+
+def property_errors(schema: dict, properties: Dict[str, dict]) -> List[str]:
+    errors = []
+    known = schema["properties"]
+
+    for name, value in properties.items():
+        prop = known.get(name)
+        if prop is None:
+            errors.append(f"unknown property '{name}' (have: {', '.join(sorted(known))})")
+            continue
+
+        prop_type = prop["type"]
+        if prop_type in READ_ONLY_TYPES:
+            errors.append(f"property '{name}' is a read-only {prop_type}")
+            continue
+
+        payload_types = [k for k in value if k != "type"]
+        if payload_types != [prop_type]:
+            errors.append(f"property '{name}' is {prop_type}, payload has {payload_types}")
+            continue
+
+        if prop_type in ("rich_text", "title"):
+            for item in value[prop_type] or []:
+                content = item.get("text", {}).get("content", "")
+                if len(content) > RICH_TEXT_LIMIT:
+                    errors.append(f"property '{name}': text item longer than {RICH_TEXT_LIMIT} chars")
+
+    return errors
+
+
+def validate_properties(schema: dict, properties: Dict[str, dict]) -> None:
+    """
+    Raise ValueError for a properties payload Notion would reject with 400.
+    """
+    errors = property_errors(schema, properties)
+    if errors:
+        raise ValueError("Invalid Notion properties: " + "; ".join(errors))
+
+
+def validate_filter_property(schema: dict, name: str, prop_type: str) -> None:
+    prop = schema["properties"].get(name)
+    if prop is None or prop["type"] != prop_type:
+        raise ValueError(f"Notion database has no {prop_type} property '{name}'")
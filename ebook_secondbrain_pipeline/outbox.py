@@ -0,0 +1,468 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import time
+from multiprocessing import Process
+from typing import Dict, List, Optional
+
+import chapter_pages
+from http_cache import add_cache_args
+import instrumentation
+from instrumentation import span
+from json_to_notion_page import (
+    BOOK_TO_NOTION_MAP,
+    entry_text,
+    find_notion_page_id,
+    rich_text,
+)
+import warehouse
+
+
+# -----------------------------
+# Outbox table (in the warehouse database)
+# -----------------------------
+# Pending Notion operations. Living next to notion_blocks means a worker
+# can mark a batch done and record its block ids in one transaction, so a
+# crash loses at most the batch in flight. ``op_key`` is unique among open
+# (pending, leased or failed) operations only: it keeps an operation from
+# being queued twice, while the same key can come back once the earlier
+# one is done (a highlight deleted and made again, an A→B→A edit).
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id           INTEGER PRIMARY KEY,
+    op_key       TEXT NOT NULL,
+    page_key     TEXT NOT NULL,
+    book_id      INTEGER NOT NULL,
+    kind         TEXT NOT NULL,
+    payload      TEXT NOT NULL,
+    status       TEXT NOT NULL DEFAULT 'pending',
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_until  REAL,
+    worker       TEXT,
+    error        TEXT,
+    created_at   TEXT NOT NULL,
+    done_at      TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_status_page ON outbox(status, page_key, id);
+CREATE UNIQUE INDEX IF NOT EXISTS outbox_open_op ON outbox(op_key)
+    WHERE status IN ('pending', 'leased', 'failed');
+"""
+
+LEASE_SECONDS = 120
+LEASE_OPS = 100
+MAX_ATTEMPTS = 8
+MAX_BACKOFF_SECONDS = 300
+IDLE_POLL_SECONDS = 2.0
+DONE_RETENTION_DAYS = 7
+
+
+def connect(path=warehouse.WAREHOUSE_PATH) -> sqlite3.Connection:
+    conn = warehouse.connect(path)
+    _drop_global_unique(conn)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _drop_global_unique(conn: sqlite3.Connection) -> None:
+    """
+    Outboxes created with ``op_key ... UNIQUE`` (over done rows too) are
+    copied into the current table once; SQLite cannot drop the constraint.
+    """
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'outbox'").fetchone()
+    if row is None or not re.search(r"op_key\s+TEXT\s+NOT\s+NULL\s+UNIQUE", row[0]):
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("ALTER TABLE outbox RENAME TO outbox_old")
+        conn.execute(SCHEMA.split("CREATE INDEX")[0])
+        conn.execute("INSERT INTO outbox SELECT * FROM outbox_old")
+        conn.execute("DROP TABLE outbox_old")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+# -----------------------------
+# Producer side (no network)
+# -----------------------------
+def _insert(conn: sqlite3.Connection, rows: List[tuple]) -> int:
+    before = conn.total_changes
+    conn.executemany(
+        "INSERT OR IGNORE INTO outbox (op_key, page_key, book_id, kind, payload, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    return conn.total_changes - before
+
+
+def enqueue_book(conn: sqlite3.Connection, json_name: str) -> int:
+    """
+    Queue the Notion operations one book needs: rewrites of edited
+    highlights, archives of deleted ones, then appends of new ones (in
+    that order, which workers preserve per page). Returns the number queued.
+    """
+    book = warehouse.find_book_by_export_name(conn, json_name.rsplit(".json", 1)[0])
+    if book is None:
+        return 0
+
+    stamp = warehouse.now_iso()
+    rows = []
+    updates = warehouse.synced_updates(conn, book["id"])
+    for row in updates:
+        rows.append((f"update:{row['fingerprint']}", json_name, book["id"], "update", json.dumps({
+            "block_id": row["block_id"], "old_fingerprint": row["old_fingerprint"],
+            "fingerprint": row["fingerprint"], "text": entry_text(dict(row)),
+        }), stamp))
+    for row in warehouse.synced_deletions(conn, book["id"]):
+        rows.append((f"archive:{row['fingerprint']}", json_name, book["id"], "archive", json.dumps({
+            "block_id": row["block_id"], "fingerprint": row["fingerprint"],
+        }), stamp))
+    # an edited highlight has no block under its new fingerprint yet, but
+    # the update above takes over the old one
+    rewritten = {row["fingerprint"] for row in updates}
+    for row in warehouse.unsynced_annotations(conn, book["id"]):
+        if row["fingerprint"] in rewritten:
+            continue
+        rows.append((f"append:{row['fingerprint']}", json_name, book["id"], "append", json.dumps({
+            "fingerprint": row["fingerprint"], "chapter": row["chapter"], "highlight": row["highlight"],
+            "note": row["note"], "created": row["created"], "updated_at": row["updated_at"],
+        }, ensure_ascii=False), stamp))
+
+    with conn:
+        return _insert(conn, rows)
+
+
+def enqueue_all(conn: sqlite3.Connection) -> int:
+    queued = sum(enqueue_book(conn, json_name) for json_name in BOOK_TO_NOTION_MAP)
+    instrumentation.incr("outbox.enqueued", queued)
+    return queued
+
+
+# -----------------------------
+# Leases
+# -----------------------------
+def lease(conn: sqlite3.Connection, worker: str, limit: int = LEASE_OPS) -> List[sqlite3.Row]:
+    """
+    Claim the oldest pending operations of one page that no other worker
+    holds. Expired leases (a crashed worker) become pending again first.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("UPDATE outbox SET status = 'pending', worker = NULL "
+                     "WHERE status = 'leased' AND lease_until <= ?", (now,))
+        head = conn.execute(
+            """
+            SELECT o.page_key FROM outbox o
+            WHERE o.status = 'pending' AND o.available_at <= ?
+              AND NOT EXISTS (SELECT 1 FROM outbox l WHERE l.page_key = o.page_key AND l.status = 'leased')
+              AND NOT EXISTS (SELECT 1 FROM outbox w WHERE w.page_key = o.page_key AND w.status = 'pending'
+                              AND w.id < o.id AND w.available_at > ?)
+            ORDER BY o.id LIMIT 1
+            """,
+            (now, now),
+        ).fetchone()
+        if head is None:
+            conn.commit()
+            return []
+
+        ops = conn.execute(
+            "SELECT * FROM outbox WHERE page_key = ? AND status = 'pending' ORDER BY id LIMIT ?",
+            (head["page_key"], limit),
+        ).fetchall()
+        # stop before an operation that is still backing off, to keep page order
+        ops = ops[:next((i for i, op in enumerate(ops) if op["available_at"] > now), len(ops))]
+        conn.executemany(
+            "UPDATE outbox SET status = 'leased', lease_until = ?, worker = ? WHERE id = ?",
+            [(now + LEASE_SECONDS, worker, op["id"]) for op in ops],
+        )
+        conn.commit()
+        return ops
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def next_due(conn: sqlite3.Connection) -> Optional[float]:
+    """
+    When the next open operation can be leased: the end of its backoff or
+    of another worker's lease. ``None`` if nothing is pending or leased.
+    """
+    return conn.execute(
+        "SELECT MIN(CASE status WHEN 'pending' THEN available_at ELSE lease_until END) "
+        "FROM outbox WHERE status IN ('pending', 'leased')"
+    ).fetchone()[0]
+
+
+def complete(conn: sqlite3.Connection, ops: List[sqlite3.Row], synced: List[tuple] = (),
+             moved: List[tuple] = (), forgotten: List[tuple] = ()) -> None:
+    """
+    Mark ``ops`` done together with their warehouse bookkeeping.
+    """
+    stamp = warehouse.now_iso()
+    with conn:
+        warehouse.mark_synced(conn, list(synced))
+        warehouse.move_synced(conn, list(moved))
+        warehouse.forget_synced(conn, list(forgotten))
+        conn.executemany("UPDATE outbox SET status = 'done', done_at = ?, lease_until = NULL, error = NULL "
+                         "WHERE id = ?", [(stamp, op["id"]) for op in ops])
+
+        appended = [json.loads(op["payload"])["updated_at"] for op in ops if op["kind"] == "append"]
+        if appended:
+            book_id = ops[0]["book_id"]
+            watermark = max(warehouse.get_watermark(conn, book_id), max(appended))
+            warehouse.set_watermark(conn, book_id, watermark)
+
+
+def release(conn: sqlite3.Connection, ops: List[sqlite3.Row], error: str) -> None:
+    """
+    Give a lease back after an error. The first of ``ops`` not yet done is
+    the one that failed: it backs off (or fails for good after
+    MAX_ATTEMPTS); the others are simply pending again.
+    """
+    now = time.time()
+    with conn:
+        leased = {
+            row[0] for row in conn.execute(
+                f"SELECT id FROM outbox WHERE status = 'leased' AND id IN ({','.join('?' * len(ops))})",
+                [op["id"] for op in ops],
+            )
+        }
+        remaining = [op for op in ops if op["id"] in leased]
+        if not remaining:
+            return
+
+        failed = remaining[0]
+        attempts = failed["attempts"] + 1
+        conn.execute(
+            "UPDATE outbox SET status = ?, attempts = ?, available_at = ?, error = ?, "
+            "lease_until = NULL, worker = NULL WHERE id = ?",
+            ("failed" if attempts >= MAX_ATTEMPTS else "pending", attempts,
+             now + min(2 ** attempts, MAX_BACKOFF_SECONDS), error[:500], failed["id"]),
+        )
+        conn.executemany("UPDATE outbox SET status = 'pending', lease_until = NULL, worker = NULL WHERE id = ?",
+                         [(op["id"],) for op in remaining[1:]])
+
+
+# -----------------------------
+# Consumer side
+# -----------------------------
+class Worker:
+    """
+    Drains the outbox: one page at a time, its operations in queue order,
+    each Notion request committed locally as soon as it succeeded.
+    """
+
+    def __init__(self, client, conn: sqlite3.Connection, name: Optional[str] = None):
+        self.client = client
+        self.conn = conn
+        self.name = name or f"{os.uname().nodename}:{os.getpid()}"
+        self.page_ids: Dict[str, Optional[str]] = {}
+        self.done = 0
+
+    def page_id(self, json_name: str) -> Optional[str]:
+        if json_name not in self.page_ids:
+            title = BOOK_TO_NOTION_MAP.get(json_name)
+            self.page_ids[json_name] = find_notion_page_id(self.client, title) if title else None
+        return self.page_ids[json_name]
+
+    def process(self, ops: List[sqlite3.Row]) -> int:
+        """
+        Run one lease; returns the number of operations completed.
+        """
+        page_id = self.page_id(ops[0]["page_key"])
+        if page_id is None:
+            for op in ops:
+                release(self.conn, [op], f"No Notion page for {op['page_key']}")
+            return 0
+
+        before = self.done
+        i = 0
+        while i < len(ops):
+            op = ops[i]
+            payload = json.loads(op["payload"])
+            try:
+                if op["kind"] == "update":
+                    self.client.update_block(payload["block_id"], {"paragraph": {"rich_text": rich_text(payload["text"])}},
+                                             scope=page_id)
+                    self.complete([op], moved=[(op["book_id"], payload["old_fingerprint"], payload["fingerprint"])])
+                    i += 1
+                elif op["kind"] == "archive":
+                    self.client.archive_block(payload["block_id"], scope=page_id)
+                    self.complete([op], forgotten=[(op["book_id"], payload["fingerprint"])])
+                    i += 1
+                else:
+                    # consecutive appends render into chapter headings + paragraphs
+                    run = [op]
+                    while i + len(run) < len(ops) and ops[i + len(run)]["kind"] == "append":
+                        run.append(ops[i + len(run)])
+                    self.append(page_id, run)
+                    i += len(run)
+            except Exception as exc:
+                # ops[i:] may start with appends committed before the error
+                release(self.conn, ops[i:], f"{type(exc).__name__}: {exc}")
+                print(f"❌ {op['page_key']} ({op['kind']}): {exc}")
+                break
+        return self.done - before
+
+    def complete(self, ops: List[sqlite3.Row], **bookkeeping) -> None:
+        complete(self.conn, ops, **bookkeeping)
+        self.done += len(ops)
+
+    def append(self, page_id: str, run: List[sqlite3.Row]) -> None:
+        """
+        Render consecutive append operations and send them 100 blocks at a
+        time, committing each batch as soon as Notion accepted it.
+        """
+        by_fingerprint = {json.loads(op["payload"])["fingerprint"]: op for op in run}
+        document = {"annotations": []}
+        for op in run:
+            entry = json.loads(op["payload"])
+            chapter = entry["chapter"] or "Unknown Chapter"
+            if not document["annotations"] or document["annotations"][-1]["chapter"] != chapter:
+                document["annotations"].append({"chapter": chapter, "entries": []})
+            document["annotations"][-1]["entries"].append(entry)
+
+        pending = set(by_fingerprint)
+        # in chapter layout the entries are spread over the chapter sub-pages
+        for target_id, target, headings in chapter_pages.route(self.client, self.conn, page_id, document):
+            if target_id == page_id:
+                # a book page filled before block ids were recorded: adopt
+                # the paragraphs already there instead of appending copies
+                seeded = chapter_pages.existing_blocks(self.client, self.conn, page_id, target)
+                if seeded:
+                    self.complete([by_fingerprint[key] for key in seeded], synced=[
+                        (by_fingerprint[key]["book_id"], key, page_id, block_id) for key, block_id in seeded.items()
+                    ])
+                    pending -= set(seeded)
+                    target = chapter_pages.drop_entries(target, seeded)
+
+            for keys, created in chapter_pages.append_entries(self.client, self.conn, target_id, target, headings):
+                batch_ops = [by_fingerprint[key] for key in keys if key]
+                self.complete(batch_ops, synced=[
+                    (by_fingerprint[key]["book_id"], key, target_id, block["id"])
+                    for key, block in zip(keys, created) if key
+                ])
+                pending -= {key for key in keys if key}
+                instrumentation.incr("outbox.blocks", len(created))
+
+        # entries that rendered to nothing (empty text) need no block
+        if pending:
+            self.complete([by_fingerprint[key] for key in pending])
+
+    def run(self, stop_when_empty: bool = True, wait_for_backoff: bool = True) -> int:
+        """
+        Process leases until the queue is empty. Operations still backing
+        off (or leased by a worker that may have died) count as not empty
+        unless ``wait_for_backoff`` is off.
+        """
+        total = 0
+        while True:
+            ops = lease(self.conn, self.name)
+            if not ops:
+                due = next_due(self.conn)
+                if stop_when_empty and (due is None or not wait_for_backoff):
+                    return total
+                wait = IDLE_POLL_SECONDS if due is None else due - time.time()
+                time.sleep(min(max(wait, 0.05), IDLE_POLL_SECONDS))
+                continue
+            with span("outbox.lease"):
+                done = self.process(ops)
+            instrumentation.incr("outbox.done", done)
+            total += done
+
+
+def worker_main(rate: float, use_cache: bool, stop_when_empty: bool) -> None:
+    from notion_client import NotionClient
+
+    conn = connect()
+    try:
+        done = Worker(NotionClient(rate=rate, use_cache=use_cache), conn).run(stop_when_empty)
+        print(f"✔ Worker {os.getpid()}: {done} operation(s) done")
+    finally:
+        conn.close()
+
+
+def drain(workers: int = 1, use_cache: bool = True, stop_when_empty: bool = True) -> Dict[str, int]:
+    """
+    Run ``workers`` processes against the outbox until nothing is pending
+    (backoffs included). They share Notion's rate limit, so each gets an
+    equal slice of it. Returns the outbox ``status`` afterwards.
+    """
+    from notion_client import DEFAULT_RATE
+
+    rate = DEFAULT_RATE / workers
+    if workers == 1:
+        worker_main(rate, use_cache, stop_when_empty)
+    else:
+        processes = [Process(target=worker_main, args=(rate, use_cache, stop_when_empty)) for _ in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+    conn = connect()
+    try:
+        return status(conn)
+    finally:
+        conn.close()
+
+
+# -----------------------------
+# Maintenance
+# -----------------------------
+def status(conn: sqlite3.Connection) -> Dict[str, int]:
+    return {row[0]: row[1] for row in conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")}
+
+
+def retry_failed(conn: sqlite3.Connection) -> int:
+    with conn:
+        return conn.execute("UPDATE outbox SET status = 'pending', attempts = 0, available_at = 0 "
+                            "WHERE status = 'failed'").rowcount
+
+
+def purge_done(conn: sqlite3.Connection, days: int = DONE_RETENTION_DAYS) -> int:
+    cutoff = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - days * 86400))
+    with conn:
+        return conn.execute("DELETE FROM outbox WHERE status = 'done' AND done_at < ?", (cutoff,)).rowcount
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Durable queue of Notion operations.")
+    parser.add_argument("command", choices=("enqueue", "work", "status", "retry-failed", "purge"))
+    parser.add_argument("--workers", type=int, default=1, help="worker processes (work)")
+    parser.add_argument("--follow", action="store_true", help="keep polling when the queue is empty (work)")
+    add_cache_args(parser)
+    instrumentation.add_profile_args(parser)
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.enable("outbox", trace_memory=args.trace_memory)
+
+    conn = connect()
+    try:
+        if args.command == "enqueue":
+            print(f"✔ {enqueue_all(conn)} operation(s) queued")
+        elif args.command == "work":
+            drain(args.workers, not args.no_cache, stop_when_empty=not args.follow)
+        elif args.command == "retry-failed":
+            print(f"✔ {retry_failed(conn)} failed operation(s) queued again")
+        elif args.command == "purge":
+            print(f"✔ {purge_done(conn)} done operation(s) removed")
+
+        counts = status(conn)
+        print("Outbox: " + (", ".join(f"{n} {s}" for s, n in sorted(counts.items())) or "empty"))
+    finally:
+        conn.close()
+
+    instrumentation.finish()
+
+
+if __name__ == "__main__":
+    main()
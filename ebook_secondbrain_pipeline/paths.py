@@ -1,3 +1,4 @@
+import sys
 from pathlib import Path
 
 # -------------------------
@@ -10,13 +11,28 @@ ROOT = Path(__file__).resolve().parents[1]
 # -------------------------
 DATA_DIR = ROOT / "data"
 RAW_DATA_DIR = DATA_DIR / "raw"
+CLEAN_DIR = DATA_DIR / "clean"
 DERIVED_DATA_DIR = DATA_DIR / "derived"
 EXPORTS_DIR = DATA_DIR / "exports"
+LOG_DIR = DATA_DIR / "log"
+
+# -------------------------
+# Original iBooks DB paths (copied into RAW_DATA_DIR by epub_parser)
+# -------------------------
+if sys.platform == "win32":
+    ORIG_BOOK_DB_PATH = Path("C:/path/to/BKLibrary.sqlite")
+    ORIG_ANNOT_DB_PATH = Path("C:/path/to/AEAnnotation.sqlite")
+else:
+    ORIG_BOOK_DB_PATH = Path.home() / "Library/Containers/com.apple.iBooksX/Data/Documents/BKLibrary/BKLibrary-1-091020131601.sqlite"
+    ORIG_ANNOT_DB_PATH = Path.home() / "Library/Containers/com.apple.iBooksX/Data/Documents/AEAnnotation/AEAnnotation_v10312011_1727_local.sqlite"
+
+# every AEAnnotation database collected into RAW_DATA_DIR (one per Mac / user)
+ANNOT_DB_PATTERN = "AEAnnotation*.sqlite"
 
 # -------------------------
 # Ensure directories exist
 # -------------------------
-for p in (DATA_DIR, RAW_DATA_DIR, DERIVED_DATA_DIR, EXPORTS_DIR):
+for p in (DATA_DIR, RAW_DATA_DIR, CLEAN_DIR, DERIVED_DATA_DIR, EXPORTS_DIR, LOG_DIR):
     p.mkdir(parents=True, exist_ok=True)
 
 if __name__ == "__main__":
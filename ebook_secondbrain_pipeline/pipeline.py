@@ -0,0 +1,408 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+import instrumentation
+from instrumentation import span
+from paths import (
+    CLEAN_DIR,
+    DATA_DIR,
+    DERIVED_DATA_DIR,
+    ORIG_ANNOT_DB_PATH,
+    ORIG_BOOK_DB_PATH,
+    RAW_DATA_DIR,
+    ROOT,
+)
+
+# Stage modules (epub_parser pulls in pyarrow/pandas) are imported inside
+# the stage functions, so a run where everything is up to date only stats
+# files.
+
+STATE_PATH = DERIVED_DATA_DIR / "pipeline_state.json"
+PACKAGE_DIR = Path(__file__).resolve().parent
+
+STORE_DIR = DERIVED_DATA_DIR / "parquet"
+SUMMARY_PATH = DATA_DIR / "ibooks_summary" / "books_summary.json"
+
+
+# -----------------------------
+# Fingerprints
+# -----------------------------
+def expand(paths: Iterable[Path]) -> List[Path]:
+    """
+    Files behind ``paths``: directories are walked, globs in the last
+    component are expanded, missing paths are kept (and fingerprint as such).
+    """
+    files = []
+    for path in paths:
+        if any(ch in path.name for ch in "*?["):
+            files.extend(sorted(path.parent.glob(path.name)))
+        elif path.is_dir():
+            files.extend(sorted(p for p in path.rglob("*") if p.is_file()))
+        else:
+            files.append(path)
+    return files
+
+
+def file_digest(path: Path) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fingerprint(paths: Iterable[Path], content: bool = False) -> str:
+    """
+    mtime+size of every file (or its sha1 with ``content``), hashed.
+    """
+    h = hashlib.sha1()
+    for path in expand(paths):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            h.update(f"{path}\0missing\n".encode())
+            continue
+        mark = file_digest(path) if content else f"{stat.st_mtime_ns}:{stat.st_size}"
+        h.update(f"{path}\0{mark}\n".encode())
+    return h.hexdigest()
+
+
+def with_sidecars(path: Path) -> List[Path]:
+    return [path, path.with_name(path.name + "-wal")]
+
+
+# -----------------------------
+# Stages
+# -----------------------------
+class Stage:
+    """
+    One pipeline step: ``inputs``/``outputs`` return the paths it reads and
+    writes (evaluated when the stage is considered, after its deps ran).
+    A stage without outputs is up to date when its inputs are unchanged.
+    """
+
+    def __init__(self, name: str, run: Callable[[], None], inputs: Callable[[], List[Path]],
+                 outputs: Callable[[], List[Path]] = lambda: [], deps: Iterable[str] = ()):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.deps = list(deps)
+
+
+def module_file(name: str) -> Path:
+    return PACKAGE_DIR / f"{name}.py"
+
+
+def module_files(*names: str) -> List[Path]:
+    """
+    A stage's own module and the pipeline modules it imports: a change to
+    any of them can change its outputs.
+    """
+    return [module_file(name) for name in names]
+
+
+def copy_dbs() -> None:
+    import epub_parser
+
+    if not ORIG_BOOK_DB_PATH.exists() or not ORIG_ANNOT_DB_PATH.exists():
+        print("⚠️ iBooks databases not found, using the copies in data/raw")
+        return
+    epub_parser.sync_raw_dbs()
+
+
+def extract_ibooks() -> None:
+    import epub_parser
+
+    result = epub_parser.run_extraction(copy=False)
+    print(f"📚 iBooks: {result['attached']} annotations, {result['exported']} JSON exported")
+
+
+def clean_kindle() -> None:
+    import kindle_cleaner
+
+    try:
+        raw_file = kindle_cleaner.select_and_cleanup_raw_files(delete_old=True)
+    except FileNotFoundError:
+        print("⚠️ No Kindle export in data/raw")
+        return
+    result = kindle_cleaner.clean_raw_file(raw_file, output="both")
+    print(f"📱 Kindle: {result['output_path'].name}")
+
+
+def sync_notion() -> None:
+    import outbox
+
+    conn = outbox.connect()
+    try:
+        queued = outbox.enqueue_all(conn)
+    finally:
+        conn.close()
+    print(f"📮 Outbox: {queued} Notion operation(s) queued")
+
+    # workers commit per batch, so an interrupted run resumes where it stopped
+    counts = outbox.drain(workers=1)
+    # fail the stage (its fingerprint is not recorded) while anything is left
+    left = {state: n for state, n in counts.items() if state != "done" and n}
+    if left:
+        raise RuntimeError(f"Outbox not drained: {left} (see `outbox status`, `outbox retry-failed`)")
+
+
+def merge_sources() -> None:
+    import dedupe
+
+    result = dedupe.run_merge()
+    print(f"🔗 Merged {result['books']} book(s), {result['duplicates']} duplicate(s) marked")
+
+
+def refresh_analytics() -> None:
+    import analytics
+
+    conn = analytics.connect()
+    try:
+        refreshed = analytics.refresh(conn)
+    finally:
+        conn.close()
+    print(f"📊 Analytics: {refreshed} book(s) refreshed")
+
+
+def tag_highlights() -> None:
+    import tagging
+
+    conn = tagging.connect()
+    try:
+        # retags everything by itself once the corpus drifted enough
+        result = tagging.refresh(conn)
+    finally:
+        conn.close()
+    print(f"🏷️ Tags: +{result['added']} -{result['removed']} highlight(s), {result['books']} book(s) retagged"
+          + (" (full retag)" if result["full"] else ""))
+
+
+def summarize_ibooks() -> None:
+    # scripts/ is not a package; load inspect_ibooks.py by path
+    spec = importlib.util.spec_from_file_location("inspect_ibooks", ROOT / "scripts" / "inspect_ibooks.py")
+    inspect_ibooks = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(inspect_ibooks)
+
+    summary = inspect_ibooks.summarize_annotations(
+        inspect_ibooks.load_annotations_from_store(),
+        inspect_ibooks.load_books_from_store(),
+    )
+    inspect_ibooks.save_summary_json(summary)
+
+
+def kindle_raw_files() -> List[Path]:
+    return [RAW_DATA_DIR / "*_kindle_annotations_raw.txt"]
+
+
+STAGES = [
+    Stage(
+        "copy_dbs", copy_dbs,
+        inputs=lambda: with_sidecars(ORIG_BOOK_DB_PATH) + with_sidecars(ORIG_ANNOT_DB_PATH),
+        outputs=lambda: [RAW_DATA_DIR / ORIG_BOOK_DB_PATH.name, RAW_DATA_DIR / ORIG_ANNOT_DB_PATH.name],
+    ),
+    Stage(
+        "ibooks", extract_ibooks,
+        # -shm changes on every read, so only the database and its WAL count
+        inputs=lambda: [RAW_DATA_DIR / "BKLibrary*.sqlite", RAW_DATA_DIR / "BKLibrary*.sqlite-wal",
+                        RAW_DATA_DIR / "AEAnnotation*.sqlite", RAW_DATA_DIR / "AEAnnotation*.sqlite-wal",
+                        *module_files("epub_parser", "annotation_store", "search_index", "warehouse", "utils_books")],
+        outputs=lambda: [STORE_DIR],
+        deps=["copy_dbs"],
+    ),
+    Stage(
+        "kindle", clean_kindle,
+        inputs=lambda: kindle_raw_files() + module_files("kindle_cleaner", "search_index", "warehouse", "utils_books"),
+        outputs=lambda: [CLEAN_DIR / "*_kindle_annotations_clean.json", CLEAN_DIR / "kindle_shards"],
+    ),
+    Stage(
+        "dedupe", merge_sources,
+        inputs=lambda: [CLEAN_DIR, STORE_DIR, *module_files("dedupe", "warehouse", "utils_books")],
+        outputs=lambda: [DERIVED_DATA_DIR / "merged"],
+        deps=["ibooks", "kindle"],
+    ),
+    Stage(
+        "notion", sync_notion,
+        # duplicates are marked in the warehouse before new highlights are sent
+        inputs=lambda: [CLEAN_DIR, STORE_DIR,
+                        *module_files("outbox", "json_to_notion_page", "chapter_pages", "notion_client",
+                                      "notion_schema", "http_cache", "warehouse", "utils_books")],
+        deps=["dedupe"],
+    ),
+    Stage(
+        "analytics", refresh_analytics,
+        inputs=lambda: [CLEAN_DIR, STORE_DIR, *module_files("analytics", "warehouse")],
+        deps=["ibooks", "kindle"],
+    ),
+    Stage(
+        "tagging", tag_highlights,
+        inputs=lambda: [CLEAN_DIR, STORE_DIR, *module_files("tagging", "summaries", "warehouse")],
+        deps=["dedupe"],
+    ),
+    Stage(
+        "summary", summarize_ibooks,
+        inputs=lambda: [STORE_DIR, ROOT / "scripts" / "inspect_ibooks.py", *module_files("annotation_store", "warehouse")],
+        outputs=lambda: [SUMMARY_PATH],
+        deps=["ibooks"],
+    ),
+]
+
+
+# -----------------------------
+# State
+# -----------------------------
+def load_state(path: Path = STATE_PATH) -> Dict[str, dict]:
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(state: Dict[str, dict], path: Path = STATE_PATH) -> None:
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+
+# -----------------------------
+# Runner
+# -----------------------------
+class Pipeline:
+    """
+    make-style runner: a stage runs when the fingerprint of its inputs or
+    outputs differs from the one recorded after its last successful run.
+    Stages whose deps are done are started together on a thread pool, so
+    independent branches (iBooks / Kindle) run concurrently.
+    """
+
+    def __init__(self, stages: List[Stage] = STAGES, content_hash: bool = False,
+                 force: bool = False, jobs: int = 4, state_path: Path = STATE_PATH):
+        self.stages = {stage.name: stage for stage in stages}
+        self.content_hash = content_hash
+        self.force = force
+        self.jobs = jobs
+        self.state_path = state_path
+        self.state = load_state(state_path)
+
+    def select(self, targets: Optional[List[str]]) -> List[str]:
+        """
+        ``targets`` plus everything they depend on, in declaration order.
+        """
+        if not targets:
+            return list(self.stages)
+
+        unknown = [t for t in targets if t not in self.stages]
+        if unknown:
+            raise ValueError(f"Unknown stage(s): {', '.join(unknown)} (have: {', '.join(self.stages)})")
+
+        wanted = set()
+        todo = list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in wanted:
+                wanted.add(name)
+                todo.extend(self.stages[name].deps)
+        return [name for name in self.stages if name in wanted]
+
+    def fingerprints(self, stage: Stage) -> dict:
+        return {
+            "inputs": fingerprint(stage.inputs(), self.content_hash),
+            "outputs": fingerprint(stage.outputs(), self.content_hash),
+        }
+
+    def up_to_date(self, stage: Stage) -> bool:
+        recorded = self.state.get(stage.name)
+        return not self.force and recorded is not None and {
+            k: recorded.get(k) for k in ("inputs", "outputs")
+        } == self.fingerprints(stage)
+
+    def execute(self, name: str) -> str:
+        stage = self.stages[name]
+        if self.up_to_date(stage):
+            return "up to date"
+
+        start = time.perf_counter()
+        with span(f"pipeline.{name}"):
+            stage.run()
+        # recorded after the run: the stage's own writes are part of its state
+        self.state[name] = {**self.fingerprints(stage), "seconds": round(time.perf_counter() - start, 3)}
+        return "ran"
+
+    def run(self, targets: Optional[List[str]] = None, dry_run: bool = False) -> Dict[str, str]:
+        names = self.select(targets)
+
+        if dry_run:
+            return {name: "up to date" if self.up_to_date(self.stages[name]) else "would run" for name in names}
+
+        results: Dict[str, str] = {}
+        remaining = list(names)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while remaining or running:
+                for name in list(remaining):
+                    deps = [d for d in self.stages[name].deps if d in names]
+                    if any(results.get(d) in ("failed", "blocked") for d in deps):
+                        results[name] = "blocked"
+                        remaining.remove(name)
+                    elif all(d in results for d in deps):
+                        running[pool.submit(self.execute, name)] = name
+                        remaining.remove(name)
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as exc:
+                        results[name] = "failed"
+                        print(f"❌ {name}: {exc}")
+                    if results[name] == "ran":
+                        save_state(self.state, self.state_path)
+
+        return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the pipeline stages that are out of date.")
+    parser.add_argument("targets", nargs="*", help=f"stages to bring up to date ({', '.join(s.name for s in STAGES)})")
+    parser.add_argument("--force", action="store_true", help="run the selected stages even if up to date")
+    parser.add_argument("--dry-run", action="store_true", help="only show what would run")
+    parser.add_argument("--hash", action="store_true", help="fingerprint file contents instead of mtime+size")
+    parser.add_argument("--jobs", type=int, default=4, help="stages run concurrently")
+    instrumentation.add_profile_args(parser)
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.enable("pipeline", trace_memory=args.trace_memory)
+
+    start = time.perf_counter()
+    pipeline = Pipeline(content_hash=args.hash, force=args.force, jobs=args.jobs)
+    results = pipeline.run(args.targets, dry_run=args.dry_run)
+
+    for name, status in results.items():
+        print(f"{name:<10} {status}")
+    print(f"✔ Pipeline finished in {time.perf_counter() - start:.2f}s")
+
+    instrumentation.finish()
+
+    if any(status in ("failed", "blocked") for status in results.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+from __future__ import annotations
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+from http_cache import add_cache_args
+import instrumentation
+from instrumentation import span
+from json_to_notion_page import BOOK_TO_NOTION_MAP
+from notion_client import NotionClient
+import notion_schema
+from utils_books import normalize_title
+import warehouse
+
+
+# -----------------------------
+# Maintained page properties
+# -----------------------------
+# value key -> Notion property name. Properties missing from the database
+# schema are skipped (with a warning) instead of failing every PATCH.
+PROPERTY_NAMES = {
+    "highlights": "Highlights",
+    "first_highlight": "First Highlight",
+    "last_highlight": "Last Highlight",
+    "date_finished": "Date Finished",
+    "summary": "Summary",
+    "tags": "Tags",
+}
+
+DEFAULT_WORKERS = 4
+
+
+# -----------------------------
+# Desired values (from the warehouse)
+# -----------------------------
+def _date(value: Optional[str]) -> Optional[str]:
+    return value[:10] if value else None
+
+
+def stats_summary(values: dict) -> str:
+    if not values["highlights"]:
+        return ""
+    return (f"{values['highlights']} highlights across {values['chapters']} chapters, "
+            f"{values['first_highlight']} – {values['last_highlight']}")
+
+
+def page_key_for(book) -> str:
+    """
+    Normalized Notion title a warehouse book is synced to.
+    """
+    mapped = BOOK_TO_NOTION_MAP.get(f"{book['export_name']}.json")
+    return normalize_title(mapped) if mapped else book["title_key"]
+
+
+def desired_values(conn, summaries: Optional[Dict[str, str]] = None,
+                   tags: Optional[Dict[str, List[str]]] = None) -> Dict[str, dict]:
+    """
+    Property values per normalized page title. iBooks and Kindle copies of
+    the same book are merged into one page. ``summaries`` (page key ->
+    text, falling back to a generated stats line) and ``tags`` (page key
+    -> names) are only maintained when given, so a plain sync never
+    overwrites a hand-written Summary.
+    """
+    desired: Dict[str, dict] = {}
+
+    for row in warehouse.book_stats(conn):
+        key = page_key_for(row)
+        values = desired.setdefault(key, {
+            "highlights": 0, "chapters": 0,
+            "first_highlight": None, "last_highlight": None, "date_finished": None,
+        })
+        values["highlights"] += row["highlights"]
+        values["chapters"] += row["chapters"]
+        for name, pick in (("first_highlight", min), ("last_highlight", max), ("date_finished", max)):
+            candidates = [v for v in (values[name], _date(row[name])) if v]
+            values[name] = pick(candidates) if candidates else None
+
+    for key, values in desired.items():
+        if summaries is not None:
+            values["summary"] = summaries.get(key) or stats_summary(values)
+        if tags is not None:
+            values["tags"] = sorted(tags.get(key, []))
+        del values["chapters"]
+
+    return desired
+
+
+# -----------------------------
+# Notion property encoding
+# -----------------------------
+def encode(prop_type: str, value) -> dict:
+    if prop_type == "number":
+        return {"number": value}
+    if prop_type == "date":
+        return {"date": {"start": value} if value else None}
+    if prop_type == "rich_text":
+        text = (value or "")[:notion_schema.RICH_TEXT_LIMIT]
+        return {"rich_text": [{"type": "text", "text": {"content": text}}] if text else []}
+    if prop_type == "multi_select":
+        return {"multi_select": [{"name": name} for name in value or []]}
+    raise ValueError(f"Unsupported property type for sync: {prop_type}")
+
+
+def decode(prop: dict):
+    """
+    Current page value in the same shape ``encode`` takes.
+    """
+    prop_type = prop["type"]
+    if prop_type == "number":
+        return prop["number"]
+    if prop_type == "date":
+        return _date((prop["date"] or {}).get("start"))
+    if prop_type == "rich_text":
+        return "".join(item["plain_text"] for item in prop["rich_text"])
+    if prop_type == "multi_select":
+        return sorted(option["name"] for option in prop["multi_select"])
+    return None
+
+
+def page_title(page: dict) -> str:
+    for prop in page["properties"].values():
+        if prop["type"] == "title":
+            return "".join(item["plain_text"] for item in prop["title"])
+    return ""
+
+
+# -----------------------------
+# Diff & push
+# -----------------------------
+def plan_updates(pages: List[dict], desired: Dict[str, dict], schema: dict) -> List[tuple]:
+    """
+    ``(page_id, title, properties)`` for every page whose maintained
+    properties differ from the desired values.
+    """
+    maintained = set().union(*desired.values()) if desired else set()
+    writable = {}
+    for key, name in PROPERTY_NAMES.items():
+        if key not in maintained:
+            continue
+        prop = schema["properties"].get(name)
+        if prop is None:
+            print(f"⚠️ Property '{name}' not in the Notion database, skipping")
+            continue
+        writable[key] = (name, prop["type"])
+
+    updates = []
+    for page in pages:
+        title = page_title(page)
+        values = desired.get(normalize_title(title))
+        if values is None:
+            continue
+
+        changed = {}
+        for key, (name, prop_type) in writable.items():
+            if key not in values:
+                continue
+            current = decode(page["properties"][name]) if name in page["properties"] else None
+            wanted = values[key]
+            if prop_type == "rich_text":
+                wanted = (wanted or "")[:notion_schema.RICH_TEXT_LIMIT]
+            if current != wanted:
+                changed[name] = encode(prop_type, wanted)
+
+        if changed:
+            updates.append((page["id"], title, changed))
+
+    return updates
+
+
+def push_updates(client: NotionClient, updates: List[tuple], workers: int = DEFAULT_WORKERS) -> int:
+    """
+    PATCH the pages concurrently; the client's limiter keeps the overall
+    request rate within Notion's limit. Returns the number updated.
+    """
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(client.update_page_properties, page_id, properties): title
+            for page_id, title, properties in updates
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+                done += 1
+            except Exception as exc:
+                print(f"❌ {futures[future]}: {exc}")
+    return done
+
+
+def sync_properties(client: NotionClient, conn, workers: int = DEFAULT_WORKERS,
+                    dry_run: bool = False, summaries: Optional[Dict[str, str]] = None,
+                    tags: Optional[Dict[str, List[str]]] = None) -> dict:
+    with span("properties.desired"):
+        desired = desired_values(conn, summaries, tags)
+    with span("properties.query_pages"):
+        pages = list(client.query_database())
+    with span("properties.diff"):
+        updates = plan_updates(pages, desired, client.schema())
+
+    instrumentation.incr("properties.pages", len(pages))
+    instrumentation.incr("properties.changed", len(updates))
+
+    if dry_run:
+        for _, title, properties in updates:
+            print(f"~ {title}: {', '.join(properties)}")
+        return {"pages": len(pages), "changed": len(updates), "updated": 0}
+
+    with span("properties.patch"):
+        updated = push_updates(client, updates, workers)
+    return {"pages": len(pages), "changed": len(updates), "updated": updated}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sync per-book properties (counts, dates; summary and tags on request) to Notion.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="concurrent PATCH requests")
+    parser.add_argument("--dry-run", action="store_true", help="only list the pages that would change")
+    parser.add_argument("--summaries", action="store_true",
+                        help="fill Summary with extractive summaries of the highlights (summaries.py)")
+    parser.add_argument("--tags", action="store_true",
+                        help="fill the Tags multi-select with keyword tags (run tagging.py first)")
+    add_cache_args(parser)
+    instrumentation.add_profile_args(parser)
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.enable("property_sync", trace_memory=args.trace_memory)
+
+    conn = warehouse.connect()
+    try:
+        summaries = None
+        if args.summaries:
+            # numpy/scipy are only needed for this
+            from summaries import book_summaries
+            with span("properties.summaries"):
+                summaries = book_summaries(conn)
+        tags = None
+        if args.tags:
+            from tagging import page_tags
+            tags = page_tags(conn)
+        result = sync_properties(NotionClient(use_cache=not args.no_cache), conn, args.workers,
+                                 args.dry_run, summaries, tags)
+    finally:
+        conn.close()
+
+    print(f"✔ {result['pages']} pages checked, {result['changed']} differ, {result['updated']} updated")
+    instrumentation.finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Iterable, Optional
+
+from paths import DERIVED_DATA_DIR
+
+
+# -----------------------------
+# Defaults
+# -----------------------------
+DEFAULT_CACHE_DIR = DERIVED_DATA_DIR / "pdf_chapters"
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class RenderCache:
+    """
+    Content-addressed store for rendered chapter PDFs.
+
+    Keys are the SHA-256 of the stylesheet plus the cleaned chapter HTML,
+    so a CSS change invalidates every chapter while a re-downloaded book
+    only re-renders the chapters whose markup actually changed.
+    Entries are evicted least-recently-used first once the total size
+    exceeds ``max_bytes`` (recency = file mtime, refreshed on every hit).
+    """
+
+    def __init__(self, cache_dir: Path = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(html: str, stylesheet: str) -> str:
+        digest = hashlib.sha256()
+        digest.update(stylesheet.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(html.encode("utf-8"))
+        return digest.hexdigest()
+
+    def path_for(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.pdf"
+
+    def get(self, key: str) -> Optional[Path]:
+        path = self.path_for(key)
+        if not path.exists():
+            return None
+        os.utime(path)  # mark as recently used
+        return path
+
+    def put(self, key: str, data: bytes) -> Path:
+        path = self.path_for(key)
+        fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_name, path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        return path
+
+    def evict(self, keep: Iterable[str] = ()) -> int:
+        """
+        Drop least-recently-used entries until the cache fits ``max_bytes``.
+        Keys in ``keep`` (e.g. the chapters of the book being merged) are
+        never removed. Returns the number of evicted entries.
+        """
+        keep = set(keep)
+        entries = []
+        total = 0
+
+        for path in self.cache_dir.glob("*.pdf"):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        if total <= self.max_bytes:
+            return 0
+
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path.stem in keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+            evicted += 1
+
+        return evicted
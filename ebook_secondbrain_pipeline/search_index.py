@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import argparse
+import json
+import sqlite3
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from paths import CLEAN_DIR, DERIVED_DATA_DIR
+from utils_books import annotation_fingerprint
+
+
+INDEX_PATH = DERIVED_DATA_DIR / "search_index.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS highlights (
+    id          INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL UNIQUE,
+    source      TEXT NOT NULL,
+    book        TEXT NOT NULL,
+    author      TEXT,
+    chapter     TEXT,
+    created     TEXT,
+    highlight   TEXT,
+    note        TEXT
+);
+CREATE INDEX IF NOT EXISTS highlights_source_book ON highlights(source, book);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS highlights_fts USING fts5(
+    highlight, note, book, author, chapter,
+    content='highlights', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS highlights_ai AFTER INSERT ON highlights BEGIN
+    INSERT INTO highlights_fts(rowid, highlight, note, book, author, chapter)
+    VALUES (new.id, new.highlight, new.note, new.book, new.author, new.chapter);
+END;
+CREATE TRIGGER IF NOT EXISTS highlights_ad AFTER DELETE ON highlights BEGIN
+    INSERT INTO highlights_fts(highlights_fts, rowid, highlight, note, book, author, chapter)
+    VALUES ('delete', old.id, old.highlight, old.note, old.book, old.author, old.chapter);
+END;
+CREATE TRIGGER IF NOT EXISTS highlights_au AFTER UPDATE ON highlights BEGIN
+    INSERT INTO highlights_fts(highlights_fts, rowid, highlight, note, book, author, chapter)
+    VALUES ('delete', old.id, old.highlight, old.note, old.book, old.author, old.chapter);
+    INSERT INTO highlights_fts(rowid, highlight, note, book, author, chapter)
+    VALUES (new.id, new.highlight, new.note, new.book, new.author, new.chapter);
+END;
+"""
+
+
+def connect(path: Path = INDEX_PATH) -> sqlite3.Connection:
+    # stages may write concurrently (pipeline.py); wait for the lock instead of failing
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# -----------------------------
+# Records from clean JSON
+# -----------------------------
+def ibooks_records(book: dict) -> Iterator[Dict[str, Optional[str]]]:
+    """
+    Flatten one ``epub_parser`` JSON into index records.
+    """
+    title = book["meta"]["source_title"]
+    author = book["meta"]["source_author"]
+
+    for chapter in book.get("annotations", []):
+        for entry in chapter.get("entries", []):
+            if not (entry.get("highlight") or entry.get("note")):
+                continue
+            yield {
+                "fingerprint": annotation_fingerprint("ibooks", title, entry.get("highlight"), entry.get("note")),
+                "source": "ibooks",
+                "book": title,
+                "author": author,
+                "chapter": chapter.get("chapter"),
+                "created": entry.get("created"),
+                "highlight": entry.get("highlight"),
+                "note": entry.get("note"),
+            }
+
+
+def kindle_records(grouped: Dict[str, List[dict]]) -> Iterator[Dict[str, Optional[str]]]:
+    """
+    Flatten the ``kindle_cleaner`` output (title -> items) into index records.
+    """
+    from kindle_cleaner import split_title_author
+
+    for raw_title, items in grouped.items():
+        title, author = split_title_author(raw_title)
+        for item in items:
+            yield {
+                "fingerprint": annotation_fingerprint("kindle", raw_title, item.get("text")),
+                "source": "kindle",
+                "book": title,
+                "author": author,
+                "chapter": item.get("chapter") or (f"Seite {item['page']}" if item.get("page") else None),
+                "created": item.get("timestamp"),
+                "highlight": item.get("text"),
+                "note": None,
+            }
+
+
+def clean_dir_records(clean_dir: Path = CLEAN_DIR) -> Iterator[Dict[str, Optional[str]]]:
+    """
+    All records currently exported to ``data/clean`` (newest Kindle file only).
+    """
+    kindle_files = sorted(clean_dir.glob("*_kindle_annotations_clean.json"))
+
+    for path in sorted(clean_dir.glob("*__*.json")):
+        with path.open("r", encoding="utf-8") as f:
+            yield from ibooks_records(json.load(f))
+
+    if kindle_files:
+        with kindle_files[-1].open("r", encoding="utf-8") as f:
+            yield from kindle_records(json.load(f))
+
+
+# -----------------------------
+# Incremental update
+# -----------------------------
+def index_records(records: Iterable[Dict[str, Optional[str]]], path: Path = INDEX_PATH,
+                  conn: Optional[sqlite3.Connection] = None) -> Dict[str, int]:
+    """
+    Sync the index with ``records``, book by book.
+
+    For every (source, book) present in ``records`` the index ends up
+    holding exactly those fingerprints: new ones are inserted, changed
+    metadata is updated in place and vanished ones are deleted. Books not
+    mentioned are left untouched.
+    """
+    by_book: Dict[tuple, Dict[str, dict]] = defaultdict(dict)
+    for record in records:
+        by_book[(record["source"], record["book"])][record["fingerprint"]] = record
+
+    stats = {"inserted": 0, "updated": 0, "deleted": 0}
+    own_conn = conn is None
+    conn = conn or connect(path)
+
+    with conn:
+        for (source, book), wanted in by_book.items():
+            existing = {
+                fp for (fp,) in conn.execute(
+                    "SELECT fingerprint FROM highlights WHERE source = ? AND book = ?",
+                    (source, book),
+                )
+            }
+
+            stale = existing - wanted.keys()
+            conn.executemany(
+                "DELETE FROM highlights WHERE fingerprint = ?",
+                [(fp,) for fp in stale],
+            )
+            stats["deleted"] += len(stale)
+
+            cur = conn.executemany(
+                """
+                INSERT INTO highlights
+                    (fingerprint, source, book, author, chapter, created, highlight, note)
+                VALUES
+                    (:fingerprint, :source, :book, :author, :chapter, :created, :highlight, :note)
+                ON CONFLICT(fingerprint) DO UPDATE SET
+                    author = excluded.author,
+                    chapter = excluded.chapter,
+                    created = excluded.created
+                WHERE highlights.author IS NOT excluded.author
+                   OR highlights.chapter IS NOT excluded.chapter
+                   OR highlights.created IS NOT excluded.created
+                """,
+                list(wanted.values()),
+            )
+            inserted = len(wanted.keys() - existing)
+            stats["inserted"] += inserted
+            stats["updated"] += cur.rowcount - inserted
+
+    if own_conn:
+        conn.close()
+    return stats
+
+
+# -----------------------------
+# Search
+# -----------------------------
+def fts_query(text: str) -> str:
+    """
+    Quote every term so user input never trips FTS5 syntax.
+    """
+    terms = text.split()
+    return " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+
+def search(
+    query: str,
+    limit: int = 20,
+    book: Optional[str] = None,
+    raw: bool = False,
+    path: Path = INDEX_PATH,
+) -> List[Dict[str, object]]:
+    conn = connect(path)
+    conn.row_factory = sqlite3.Row
+
+    sql = """
+        SELECT h.source, h.book, h.author, h.chapter, h.created,
+               snippet(highlights_fts, -1, '[', ']', '…', 24) AS snippet,
+               bm25(highlights_fts, 1.0, 1.0, 0.3, 0.3, 0.3) AS rank
+        FROM highlights_fts
+        JOIN highlights h ON h.id = highlights_fts.rowid
+        WHERE highlights_fts MATCH ?
+    """
+    params: list = [query if raw else fts_query(query)]
+
+    if book:
+        sql += " AND h.book LIKE ?"
+        params.append(f"%{book}%")
+
+    sql += " ORDER BY rank LIMIT ?"
+    params.append(limit)
+
+    rows = [dict(r) for r in conn.execute(sql, params)]
+    conn.close()
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local full-text search over all highlights.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_update = sub.add_parser("update", help="(re)index everything in the warehouse")
+    p_update.add_argument("--from-clean", action="store_true", help="read data/clean JSON instead")
+
+    p_search = sub.add_parser("search", help="ranked search with snippets")
+    p_search.add_argument("query")
+    p_search.add_argument("-n", "--limit", type=int, default=20)
+    p_search.add_argument("--book", help="restrict to books whose title contains this")
+    p_search.add_argument("--raw", action="store_true", help="pass the query as FTS5 syntax")
+
+    args = parser.parse_args()
+
+    if args.command == "update":
+        if args.from_clean:
+            stats = index_records(clean_dir_records())
+        else:
+            import warehouse
+
+            conn = warehouse.connect()
+            stats = index_records(warehouse.search_records(conn))
+            conn.close()
+        print(f"✔ Index updated: {stats['inserted']} new, {stats['updated']} changed, {stats['deleted']} removed")
+        return
+
+    results = search(args.query, limit=args.limit, book=args.book, raw=args.raw)
+    if not results:
+        print("No matches.")
+        return
+
+    for r in results:
+        where = " · ".join(x for x in (r["author"], r["chapter"], r["created"]) if x)
+        print(f"\n📖 {r['book']} [{r['source']}]")
+        if where:
+            print(f"   {where}")
+        print(f"   {r['snippet']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import chapter_pages
+import instrumentation
+from instrumentation import span
+from json_to_notion_page import (
+    chapter_heading,
+    entry_text,
+    find_notion_page_id,
+    record_synced,
+)
+from paths import EXPORTS_DIR
+from utils_books import make_safe_filename
+import warehouse
+
+
+VAULT_DIR = EXPORTS_DIR / "markdown_vault"
+
+
+class Sink(ABC):
+    """
+    Destination for rendered books. ``write_book`` gets the document in the
+    epub_parser JSON shape plus the display title and returns the number
+    of items written (blocks, changed sections, ...).
+    """
+
+    name = "sink"
+
+    @abstractmethod
+    def write_book(self, book: dict, title: str) -> int:
+        ...
+
+    def write_books(self, items: Iterable[Tuple[dict, str]]) -> Dict[str, int]:
+        return {title: self.write_book(book, title) for book, title in items}
+
+    def close(self) -> None:
+        pass
+
+
+# -----------------------------
+# Notion
+# -----------------------------
+class NotionSink(Sink):
+    """
+    Append the highlights of a book that its Notion page does not show yet
+    and record the created block ids in the warehouse. With
+    ``layout="chapters"`` the highlights go to per-chapter sub-pages
+    instead (see ``chapter_pages``).
+    """
+
+    name = "notion"
+
+    def __init__(self, client, conn, layout: str = "page", max_blocks: int = 0):
+        self.client = client
+        self.conn = conn
+        self.layout = layout
+        self.max_blocks = max_blocks
+
+    def write_book(self, book: dict, title: str) -> int:
+        print(f"🔎 Looking for Notion page: {title}")
+        page_id = find_notion_page_id(self.client, title)
+        if not page_id:
+            raise RuntimeError(
+                f"❌ No Notion page found for '{title}'. "
+                f"Check database ID and Title property."
+            )
+
+        if self.layout == "chapters":
+            written = chapter_pages.write_book(self.client, self.conn, page_id, book, self.max_blocks)
+            instrumentation.incr("notion.blocks", written)
+            print(f"✅ Updated Notion chapter pages: {title} ({written} blocks)")
+            return written
+
+        book_id = book.get("meta", {}).get("book_id")
+        if book_id is not None:
+            # adopt blocks of a page filled before ids were recorded, then
+            # skip everything already sent (by earlier runs or the outbox)
+            seeded = chapter_pages.existing_blocks(self.client, self.conn, page_id, book)
+            record_synced(self.conn, book_id, page_id, list(seeded), list(seeded.values()))
+            book = chapter_pages.drop_entries(book, warehouse.synced_fingerprints(self.conn, book_id))
+
+        # rendered lazily: the first batch is sent before later chapters are built
+        written = 0
+        with span("notion.render_and_append"):
+            for keys, created in chapter_pages.append_entries(self.client, self.conn, page_id, book):
+                record_synced(self.conn, book_id, page_id, keys, [block["id"] for block in created])
+                written += len(created)
+        instrumentation.incr("notion.blocks", written)
+
+        if not written:
+            print(f"✔ Notion page up to date: {title}")
+            return 0
+
+        print(f"✅ Updated Notion page: {title}")
+        return written
+
+
+# -----------------------------
+# Markdown vault (Obsidian)
+# -----------------------------
+SECTION_PATTERN = re.compile(
+    r"<!-- section (?P<hash>[0-9a-f]{16}) -->\n(?P<body>.*?)<!-- /section -->\n",
+    re.DOTALL,
+)
+
+
+def section_hash(chapter: dict) -> str:
+    h = hashlib.sha1()
+    h.update(chapter_heading(chapter).encode("utf-8"))
+    for entry in chapter.get("entries", []):
+        h.update(b"\x1e" + entry_text(entry).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def render_section(chapter: dict) -> str:
+    lines = [f"## {chapter_heading(chapter)}", ""]
+    for entry in chapter.get("entries", []):
+        highlight = (entry.get("highlight") or "").strip()
+        if not highlight and not entry.get("note"):
+            continue
+        lines.extend(f"> {line}" if line else ">" for line in highlight.splitlines())
+        if entry.get("note"):
+            lines.append(f"\n**Note:** {entry['note'].strip()}")
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def render_front_matter(book: dict, title: str) -> str:
+    meta = book.get("meta", {})
+    author = (meta.get("source_author") or "").replace('"', "'")
+    return (
+        "---\n"
+        f'title: "{title.replace(chr(34), chr(39))}"\n'
+        f'author: "{author}"\n'
+        "tags: [highlights]\n"
+        "---\n\n"
+        f"# {title}\n\n"
+    )
+
+
+def write_atomic(path: Path, text: str) -> None:
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
+
+class MarkdownSink(Sink):
+    """
+    One Markdown file per book in a local vault. Chapters are wrapped in
+    hash-tagged sections; sections whose hash is already in the file are
+    kept as they are, and a file whose sections are all unchanged is not
+    touched at all. Books are written in parallel, each atomically.
+    """
+
+    name = "markdown"
+
+    def __init__(self, vault_dir: Path = VAULT_DIR, workers: Optional[int] = None):
+        self.vault_dir = vault_dir
+        self.workers = workers or min(8, (os.cpu_count() or 1) * 2)
+        self.vault_dir.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, title: str) -> Path:
+        return self.vault_dir / (make_safe_filename(title)[:-len(".json")] + ".md")
+
+    def write_book(self, book: dict, title: str) -> int:
+        path = self.path_for(title)
+        existing: Dict[str, str] = {}
+        header_old = None
+        if path.exists():
+            text = path.read_text(encoding="utf-8")
+            existing = {m.group("hash"): m.group(0) for m in SECTION_PATTERN.finditer(text)}
+            first = SECTION_PATTERN.search(text)
+            header_old = text[:first.start()] if first else text
+
+        header = render_front_matter(book, title)
+        digests: List[str] = []
+        sections: List[str] = []
+        changed = 0
+        for chapter in book.get("annotations", []):
+            digest = section_hash(chapter)
+            section = existing.get(digest)
+            if section is None:
+                section = f"<!-- section {digest} -->\n{render_section(chapter)}<!-- /section -->\n"
+                changed += 1
+            digests.append(digest)
+            sections.append(section)
+
+        # removed or reordered chapters also need a rewrite
+        if changed or digests != list(existing) or header != header_old:
+            write_atomic(path, header + "\n".join(sections))
+            instrumentation.incr("markdown.files_written")
+        instrumentation.incr("markdown.sections_rewritten", changed)
+        return changed
+
+    def write_books(self, items: Iterable[Tuple[dict, str]]) -> Dict[str, int]:
+        items = list(items)
+        with span("markdown.write_books"), ThreadPoolExecutor(max_workers=self.workers) as pool:
+            counts = pool.map(lambda item: self.write_book(*item), items)
+            return {title: n for (_, title), n in zip(items, counts)}
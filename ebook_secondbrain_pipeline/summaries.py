@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+from scipy import sparse
+
+import instrumentation
+from instrumentation import span
+from notion_schema import RICH_TEXT_LIMIT
+from paths import DERIVED_DATA_DIR
+import warehouse
+
+
+CACHE_PATH = DERIVED_DATA_DIR / "summaries.json"
+
+METHODS = ("textrank", "centroid")
+SUMMARY_HIGHLIGHTS = 5
+DAMPING = 0.85
+MAX_ITERATIONS = 100
+TOLERANCE = 1e-6
+# a candidate this similar to an already chosen highlight adds nothing
+REDUNDANCY_THRESHOLD = 0.5
+MIN_TOKENS = 4
+
+# bump when the ranking changes, so cached summaries are recomputed
+VERSION = 1
+
+TOKEN_PATTERN = re.compile(r"[^\W\d_]{3,}")
+
+STOPWORDS = frozenset("""
+the and for are but not you all any can had her was one our out his has him how its
+may new now old see two who did get let put say she too use that with have this will
+your from they know want been good much some time very when come here just like long
+make many more only over such take than them well were what where which while would
+there their these those into also about after other could should because being then
+und der die das den dem des ein eine einer eines einem einen ist sind war auch auf aus
+bei mit nach von vor zum zur sich nicht noch nur oder aber wenn dass wie was wir ihr
+sie ich man hat haben wird werden kann können durch über unter dies diese dieser
+""".split())
+
+
+# -----------------------------
+# TF-IDF
+# -----------------------------
+def tokenize(text: str) -> List[str]:
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS]
+
+
+def tfidf_matrix(texts: List[str]) -> sparse.csr_matrix:
+    """
+    L2-normalised TF-IDF rows (sublinear tf, smoothed idf) as a CSR matrix.
+    Tokens are mapped to columns with one ``np.unique`` over all of them.
+    """
+    tokens = [tokenize(t) for t in texts]
+    lengths = np.fromiter((len(t) for t in tokens), dtype=np.int64, count=len(tokens))
+    flat = [tok for toks in tokens for tok in toks]
+    if not flat:
+        return sparse.csr_matrix((len(texts), 0))
+
+    vocab, cols = np.unique(np.array(flat), return_inverse=True)
+    rows = np.repeat(np.arange(len(texts)), lengths)
+    # duplicate (row, col) entries are summed into term counts
+    counts = sparse.csr_matrix((np.ones(len(cols)), (rows, cols)), shape=(len(texts), len(vocab)))
+    counts.sum_duplicates()
+
+    df = np.bincount(counts.indices, minlength=len(vocab))
+    idf = np.log((1 + len(texts)) / (1 + df)) + 1.0
+
+    tf = counts.copy()
+    tf.data = 1.0 + np.log(tf.data)
+    weighted = tf.multiply(idf).tocsr()
+
+    norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sparse.diags(1.0 / norms) @ weighted
+
+
+# -----------------------------
+# Ranking
+# -----------------------------
+def centroid_scores(matrix: sparse.csr_matrix) -> np.ndarray:
+    """
+    Cosine of every row with the (normalised) mean vector.
+    """
+    centroid = np.asarray(matrix.mean(axis=0)).ravel()
+    norm = np.linalg.norm(centroid)
+    return matrix @ (centroid / norm) if norm else np.zeros(matrix.shape[0])
+
+
+def textrank_scores(matrix: sparse.csr_matrix) -> np.ndarray:
+    """
+    PageRank over the cosine-similarity graph S = X Xᵀ - I. S is never
+    materialised: every product S·v is evaluated as X (Xᵀ v) - v, so an
+    iteration costs O(nnz(X)) instead of O(n²).
+    """
+    n = matrix.shape[0]
+    transposed = matrix.T.tocsr()
+    # rows are unit length (or empty), so the diagonal of X Xᵀ is 1 or 0
+    diagonal = (np.diff(matrix.indptr) > 0).astype(float)
+
+    def similarity_dot(v: np.ndarray) -> np.ndarray:
+        return matrix @ (transposed @ v) - diagonal * v
+
+    degree = similarity_dot(np.ones(n))
+    degree[degree <= 0] = np.inf          # isolated highlights only get the teleport share
+
+    scores = np.full(n, 1.0 / n)
+    for _ in range(MAX_ITERATIONS):
+        updated = (1 - DAMPING) / n + DAMPING * similarity_dot(scores / degree)
+        if np.abs(updated - scores).sum() < TOLERANCE:
+            return updated
+        scores = updated
+    return scores
+
+
+def select(matrix: sparse.csr_matrix, scores: np.ndarray, count: int) -> List[int]:
+    """
+    Best-scoring rows, skipping ones too similar to a row already chosen;
+    returned in their original order.
+    """
+    chosen: List[int] = []
+    # near-copies cluster at the top; looking further down is not worth it
+    for i in np.argsort(-scores, kind="stable")[:count * 20]:
+        if len(chosen) == count:
+            break
+        if chosen and (matrix[chosen] @ matrix[i].T).max() > REDUNDANCY_THRESHOLD:
+            continue
+        chosen.append(int(i))
+    return sorted(chosen)
+
+
+def summarize(texts: List[str], method: str = "textrank", count: int = SUMMARY_HIGHLIGHTS,
+              limit: int = RICH_TEXT_LIMIT) -> str:
+    """
+    Extractive summary: the ``count`` most central highlights, in reading
+    order, joined and cut to ``limit`` characters.
+    """
+    candidates = [t.strip() for t in texts if t and len(tokenize(t)) >= MIN_TOKENS]
+    if not candidates:
+        return ""
+
+    matrix = tfidf_matrix(candidates)
+    scores = textrank_scores(matrix) if method == "textrank" else centroid_scores(matrix)
+    picked = [candidates[i] for i in select(matrix, scores, count)]
+
+    summary = "\n\n".join(f"• {text}" for text in picked)
+    return summary if len(summary) <= limit else summary[:limit - 1].rstrip() + "…"
+
+
+# -----------------------------
+# Per-book summaries (cached by content hash)
+# -----------------------------
+def book_highlights(conn) -> Dict[str, List[str]]:
+    """
+    Live, non-duplicate highlights per Notion page key (iBooks and Kindle
+    copies of a book are merged, as in ``property_sync``).
+    """
+    from property_sync import page_key_for
+
+    grouped: Dict[str, List[str]] = {}
+    for book in warehouse.iter_books(conn):
+        rows = conn.execute(
+            """
+            SELECT a.highlight FROM annotations a
+            WHERE a.book_id = ? AND a.deleted = 0 AND a.highlight IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM duplicates d WHERE d.book_id = a.book_id AND d.fingerprint = a.fingerprint)
+            ORDER BY a.position, a.created
+            """,
+            (book["id"],),
+        )
+        grouped.setdefault(page_key_for(book), []).extend(row[0] for row in rows)
+    return grouped
+
+
+def content_hash(texts: List[str], method: str, count: int) -> str:
+    h = hashlib.sha1(f"{VERSION}\0{method}\0{count}".encode())
+    for text in texts:
+        h.update(b"\x1e" + text.encode("utf-8"))
+    return h.hexdigest()
+
+
+def load_cache(path: Path = CACHE_PATH) -> Dict[str, dict]:
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_cache(cache: Dict[str, dict], path: Path = CACHE_PATH) -> None:
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def book_summaries(conn, method: str = "textrank", count: int = SUMMARY_HIGHLIGHTS,
+                   refresh: bool = False, cache_path: Path = CACHE_PATH) -> Dict[str, str]:
+    """
+    Summary per page key. Books whose highlights (and settings) hash to the
+    cached value are not recomputed.
+    """
+    cache = {} if refresh else load_cache(cache_path)
+    result = {}
+    computed = 0
+
+    for key, texts in book_highlights(conn).items():
+        digest = content_hash(texts, method, count)
+        entry = cache.get(key)
+        if entry is None or entry["hash"] != digest:
+            with span("summaries.book"):
+                entry = {"hash": digest, "summary": summarize(texts, method, count)}
+            cache[key] = entry
+            computed += 1
+        result[key] = entry["summary"]
+
+    instrumentation.incr("summaries.computed", computed)
+    instrumentation.incr("summaries.cached", len(result) - computed)
+    if computed:
+        save_cache({key: cache[key] for key in result}, cache_path)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline extractive summaries of each book's highlights.")
+    parser.add_argument("--method", choices=METHODS, default="textrank", help="ranking over TF-IDF vectors")
+    parser.add_argument("--count", type=int, default=SUMMARY_HIGHLIGHTS, help="highlights per summary")
+    parser.add_argument("--refresh", action="store_true", help="ignore cached summaries")
+    parser.add_argument("--push", action="store_true", help="write them to the Notion Summary property")
+    parser.add_argument("--dry-run", action="store_true", help="with --push: only list the pages that would change")
+    instrumentation.add_profile_args(parser)
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.enable("summaries", trace_memory=args.trace_memory)
+
+    conn = warehouse.connect()
+    try:
+        summaries = book_summaries(conn, args.method, args.count, args.refresh)
+
+        if args.push:
+            from notion_client import NotionClient
+            from property_sync import sync_properties
+
+            result = sync_properties(NotionClient(), conn, dry_run=args.dry_run, summaries=summaries)
+            print(f"✔ {result['pages']} pages checked, {result['changed']} differ, {result['updated']} updated")
+        else:
+            for key, summary in summaries.items():
+                print(f"\n📖 {key}\n{summary or '(no highlights)'}")
+    finally:
+        conn.close()
+
+    instrumentation.finish()
+
+
+if __name__ == "__main__":
+    main()
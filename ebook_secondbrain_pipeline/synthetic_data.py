@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+import argparse
+import random
+import sqlite3
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+
+# -----------------------------
+# Vocabulary
+# -----------------------------
+WORDS_EN = (
+    "discipline focus habit market risk trade system learning note idea "
+    "essential attention practice process decision money time value "
+    "progress emotion confidence growth thinking writing reading strategy"
+).split()
+
+WORDS_DE = (
+    "disziplin fokus gewohnheit markt risiko handel system lernen notiz idee "
+    "wesentlich aufmerksamkeit übung prozess entscheidung geld zeit wert "
+    "fortschritt gefühl vertrauen wachstum denken schreiben lesen strategie"
+).split()
+
+WEEKDAYS_DE = ["Montag", "Dienstag", "Mittwoch", "Donnerstag", "Freitag", "Samstag", "Sonntag"]
+MONTHS_DE = ["Januar", "Februar", "März", "April", "Mai", "Juni", "Juli",
+             "August", "September", "Oktober", "November", "Dezember"]
+
+
+def sentence(rng: random.Random, words: List[str], low: int = 8, high: int = 40) -> str:
+    text = " ".join(rng.choices(words, k=rng.randint(low, high)))
+    return text[0].upper() + text[1:] + "."
+
+
+def book_titles(n_books: int, rng: random.Random) -> List[Tuple[str, str, str]]:
+    """
+    ``(asset_id, title, author)`` triples.
+    """
+    books = []
+    for i in range(n_books):
+        title = " ".join(w.capitalize() for w in rng.choices(WORDS_EN, k=rng.randint(2, 6)))
+        author = f"{rng.choice(WORDS_EN).capitalize()} {rng.choice(WORDS_EN).capitalize()}"
+        books.append((f"{i:08X}{rng.getrandbits(32):08X}", f"{title} {i}", author))
+    return books
+
+
+# -----------------------------
+# Apple Books databases
+# -----------------------------
+def make_library_db(path: Path, books: List[Tuple[str, str, str]], seed: int = 0) -> Path:
+    """
+    BKLibrary-style database with a ZBKLIBRARYASSET table.
+    """
+    rng = random.Random(seed)
+    path.unlink(missing_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE ZBKLIBRARYASSET (
+            Z_PK INTEGER PRIMARY KEY,
+            ZASSETID VARCHAR,
+            ZTITLE VARCHAR,
+            ZAUTHOR VARCHAR,
+            ZDATEADDED TIMESTAMP,
+            ZDATEFINISHED TIMESTAMP
+        )
+    """)
+
+    rows = []
+    for asset_id, title, author in books:
+        added = rng.uniform(5e8, 7.5e8)
+        finished = added + rng.uniform(1e5, 3e7) if rng.random() < 0.5 else None
+        rows.append((asset_id, title, author, added, finished))
+
+    with conn:
+        conn.executemany(
+            "INSERT INTO ZBKLIBRARYASSET (ZASSETID, ZTITLE, ZAUTHOR, ZDATEADDED, ZDATEFINISHED) "
+            "VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+    conn.close()
+    return path
+
+
+def annotation_rows(books: List[Tuple[str, str, str]], n_annotations: int,
+                    seed: int = 0) -> Iterator[tuple]:
+    rng = random.Random(seed)
+    asset_ids = [b[0] for b in books]
+
+    for _ in range(n_annotations):
+        asset_id = rng.choice(asset_ids)
+        spine = rng.randint(1, 40)
+        para = rng.randint(1, 200)
+        start = rng.randint(0, 400)
+        location = f"epubcfi(/6/{spine * 2}[chap{spine:02d}]!/4/{para * 2}/1,:{start},:{start + rng.randint(20, 600)})"
+        created = rng.uniform(5e8, 7.5e8)
+        modified = created + (rng.uniform(0, 1e6) if rng.random() < 0.2 else 0)
+
+        yield (
+            asset_id,
+            str(uuid.UUID(int=rng.getrandbits(128))).upper(),
+            sentence(rng, WORDS_EN),
+            sentence(rng, WORDS_EN, 3, 15) if rng.random() < 0.15 else None,
+            created,
+            modified,
+            location,
+            rng.randint(0, 5),
+            1 if rng.random() < 0.02 else 0,
+            f"chap{spine:02d}",
+            spine * 10_000 + para * 40 + start,
+            spine * 10_000 + para * 40 + start + 20,
+        )
+
+
+def make_annotation_db(path: Path, books: List[Tuple[str, str, str]], n_annotations: int,
+                       seed: int = 0, batch_size: int = 50_000) -> Path:
+    """
+    AEAnnotation-style database with a ZAEANNOTATION table (CFI locations,
+    UUIDs, styles, start/end locations, soft-delete flag).
+    """
+    path.unlink(missing_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE ZAEANNOTATION (
+            Z_PK INTEGER PRIMARY KEY,
+            ZANNOTATIONASSETID VARCHAR,
+            ZANNOTATIONUUID VARCHAR,
+            ZANNOTATIONSELECTEDTEXT VARCHAR,
+            ZANNOTATIONNOTE VARCHAR,
+            ZANNOTATIONCREATIONDATE TIMESTAMP,
+            ZANNOTATIONMODIFICATIONDATE TIMESTAMP,
+            ZANNOTATIONLOCATION VARCHAR,
+            ZANNOTATIONSTYLE INTEGER,
+            ZANNOTATIONDELETED INTEGER,
+            ZFUTUREPROOFING5 VARCHAR,
+            ZANNOTATIONSTARTLOC INTEGER,
+            ZANNOTATIONENDLOC INTEGER
+        )
+    """)
+
+    sql = """
+        INSERT INTO ZAEANNOTATION (
+            ZANNOTATIONASSETID, ZANNOTATIONUUID, ZANNOTATIONSELECTEDTEXT, ZANNOTATIONNOTE,
+            ZANNOTATIONCREATIONDATE, ZANNOTATIONMODIFICATIONDATE, ZANNOTATIONLOCATION,
+            ZANNOTATIONSTYLE, ZANNOTATIONDELETED, ZFUTUREPROOFING5,
+            ZANNOTATIONSTARTLOC, ZANNOTATIONENDLOC
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+
+    batch = []
+    with conn:
+        for row in annotation_rows(books, n_annotations, seed):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                conn.executemany(sql, batch)
+                batch.clear()
+        conn.executemany(sql, batch)
+
+    conn.close()
+    return path
+
+
+# -----------------------------
+# Kindle "My Clippings.txt"
+# -----------------------------
+def clipping_de(rng: random.Random, title: str, when: datetime) -> str:
+    page = rng.randint(1, 400)
+    pos = rng.randint(100, 9000)
+    stamp = (f"{WEEKDAYS_DE[when.weekday()]}, {when.day}. {MONTHS_DE[when.month - 1]} "
+             f"{when.year} {when:%H:%M:%S}")
+    return (
+        f"{title}\n"
+        f"- Deine Markierung auf Seite {page} | Position {pos}-{pos + rng.randint(1, 6)} | Hinzugefügt am {stamp}\n"
+        f"\n"
+        f"{sentence(rng, WORDS_DE)}\n"
+        f"==========\n"
+    )
+
+
+def clipping_en(rng: random.Random, title: str, when: datetime) -> str:
+    page = rng.randint(1, 400)
+    pos = rng.randint(100, 9000)
+    return (
+        f"{title}\n"
+        f"- Your Highlight on page {page} | Location {pos}-{pos + rng.randint(1, 6)} | "
+        f"Added on {when:%A, %B} {when.day}, {when.year} {when:%H:%M:%S}\n"
+        f"\n"
+        f"{sentence(rng, WORDS_EN)}\n"
+        f"==========\n"
+    )
+
+
+def write_clippings(path: Path, n_clippings: int = None, target_bytes: int = None,
+                    language: str = "de", n_books: int = 50, seed: int = 0) -> int:
+    """
+    Stream a synthetic clippings file of ``n_clippings`` entries or of
+    about ``target_bytes`` size. ``language`` is "de", "en" or "mixed".
+    Returns the number of entries written.
+    """
+    if n_clippings is None and target_bytes is None:
+        raise ValueError("Pass n_clippings or target_bytes")
+
+    rng = random.Random(seed)
+    titles = [f"{t} ({a})" for _, t, a in book_titles(n_books, rng)]
+    start = datetime(2020, 1, 1)
+
+    written = 0
+    size = 0
+    with open(path, "w", encoding="utf-8") as f:
+        # Kindle files start with a BOM
+        f.write("\ufeff")
+        while True:
+            if n_clippings is not None and written >= n_clippings:
+                break
+            if target_bytes is not None and size >= target_bytes:
+                break
+
+            title = rng.choice(titles)
+            when = start + timedelta(seconds=rng.randint(0, 6 * 365 * 86400))
+            lang = language if language != "mixed" else rng.choice(("de", "en"))
+            entry = clipping_de(rng, title, when) if lang == "de" else clipping_en(rng, title, when)
+
+            f.write(entry)
+            size += len(entry.encode("utf-8"))
+            written += 1
+
+    return written
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate synthetic iBooks/Kindle source data.")
+    parser.add_argument("out_dir", type=Path)
+    parser.add_argument("--books", type=int, default=200)
+    parser.add_argument("--annotations", type=int, default=10_000)
+    parser.add_argument("--clippings-mb", type=float, default=5.0)
+    parser.add_argument("--language", choices=("de", "en", "mixed"), default="de")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    args.out_dir.mkdir(parents=True, exist_ok=True)
+    books = book_titles(args.books, random.Random(args.seed))
+
+    make_library_db(args.out_dir / "BKLibrary-synthetic.sqlite", books, args.seed)
+    make_annotation_db(args.out_dir / "AEAnnotation_synthetic.sqlite", books, args.annotations, args.seed)
+    n = write_clippings(
+        args.out_dir / f"{datetime.now():%Y%m%d}_kindle_annotations_raw.txt",
+        target_bytes=int(args.clippings_mb * 1024 * 1024),
+        language=args.language,
+        seed=args.seed,
+    )
+
+    print(f"✔ {args.books} books, {args.annotations} iBooks annotations, {n} Kindle clippings in {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+from __future__ import annotations
+
+import argparse
+import re
+import sqlite3
+from collections import Counter
+from itertools import repeat
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+import instrumentation
+from instrumentation import span
+from summaries import tokenize
+import warehouse
+
+
+# -----------------------------
+# Model & tag tables (in the warehouse database)
+# -----------------------------
+# tag_terms/tag_docs are the corpus TF-IDF model: document frequency per
+# term and the highlights counted into it, so new or deleted highlights
+# adjust the counts instead of refitting the whole library.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tag_terms (
+    term TEXT PRIMARY KEY,
+    df   INTEGER NOT NULL
+);
+
+-- highlights are keyed like annotations: the fingerprint within a book
+CREATE TABLE IF NOT EXISTS tag_docs (
+    book_id     INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (book_id, fingerprint)
+);
+
+-- tags of one highlight, space-separated, best first (terms contain no spaces)
+CREATE TABLE IF NOT EXISTS highlight_tags (
+    book_id     INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    tags        TEXT NOT NULL,
+    PRIMARY KEY (book_id, fingerprint)
+);
+
+CREATE TABLE IF NOT EXISTS book_tags (
+    book_id INTEGER NOT NULL,
+    tag     TEXT NOT NULL,
+    weight  REAL NOT NULL,
+    PRIMARY KEY (book_id, tag)
+);
+
+-- corpus size at the last full retag
+CREATE TABLE IF NOT EXISTS tag_state (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+HIGHLIGHT_TAGS = 3
+BOOK_TAGS = 8
+# a tag has to connect highlights, and a word in every other one is no topic
+MIN_DF = 3
+MAX_DF_RATIO = 0.2
+# idf moves with the corpus while only changed books are retagged; once
+# the corpus grew or shrank this much since the last full retag, all
+# books are retagged so their tags match the current model again
+RETAG_DRIFT = 0.1
+
+
+MODEL_TABLES = ("tag_terms", "tag_docs", "highlight_tags", "book_tags", "tag_state")
+
+
+def connect(path=warehouse.WAREHOUSE_PATH) -> sqlite3.Connection:
+    conn = warehouse.connect(path)
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'tag_docs'").fetchone()
+    if row is not None and re.search(r"fingerprint\s+TEXT\s+PRIMARY\s+KEY", row[0]):
+        # keyed by fingerprint alone; the model is derived, so the next refresh rebuilds it
+        with conn:
+            for table in MODEL_TABLES:
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# -----------------------------
+# Incremental model
+# -----------------------------
+def document_frequencies(texts: Iterable[str]) -> Counter:
+    df: Counter = Counter()
+    for text in texts:
+        df.update(set(tokenize(text or "")))
+    return df
+
+
+def update_model(conn: sqlite3.Connection) -> Tuple[List[int], int, int]:
+    """
+    Count highlights new since the last update into the model and take
+    deleted ones out. Returns the ids of the books touched and the number
+    of highlights added/removed.
+    """
+    # cross-source duplicates are left out, as in summaries and the sync
+    added = conn.execute(
+        """
+        SELECT a.fingerprint, a.book_id, a.highlight FROM annotations a
+        WHERE a.deleted = 0 AND a.highlight IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM tag_docs t WHERE t.book_id = a.book_id AND t.fingerprint = a.fingerprint)
+          AND NOT EXISTS (SELECT 1 FROM duplicates d WHERE d.book_id = a.book_id AND d.fingerprint = a.fingerprint)
+        """
+    ).fetchall()
+    # soft-deleted rows keep their text, so their terms can be subtracted
+    removed = conn.execute(
+        """
+        SELECT t.fingerprint, t.book_id, a.highlight FROM tag_docs t
+        LEFT JOIN annotations a ON a.book_id = t.book_id AND a.fingerprint = t.fingerprint
+        WHERE a.id IS NULL OR a.deleted = 1
+           OR EXISTS (SELECT 1 FROM duplicates d WHERE d.book_id = t.book_id AND d.fingerprint = t.fingerprint)
+        """
+    ).fetchall()
+    if not added and not removed:
+        return [], 0, 0
+
+    delta = document_frequencies(row["highlight"] for row in added)
+    delta.subtract(document_frequencies(row["highlight"] for row in removed))
+
+    with conn:
+        conn.executemany(
+            "INSERT INTO tag_terms (term, df) VALUES (?, ?) "
+            "ON CONFLICT(term) DO UPDATE SET df = df + excluded.df",
+            [(term, n) for term, n in delta.items() if n],
+        )
+        conn.execute("DELETE FROM tag_terms WHERE df <= 0")
+        conn.executemany("INSERT INTO tag_docs (fingerprint, book_id) VALUES (?, ?)",
+                         [(row["fingerprint"], row["book_id"]) for row in added])
+        keys = [(row["book_id"], row["fingerprint"]) for row in removed]
+        conn.executemany("DELETE FROM tag_docs WHERE book_id = ? AND fingerprint = ?", keys)
+        conn.executemany("DELETE FROM highlight_tags WHERE book_id = ? AND fingerprint = ?", keys)
+
+    touched = sorted({row["book_id"] for row in added} | {row["book_id"] for row in removed})
+    return touched, len(added), len(removed)
+
+
+def load_model(conn: sqlite3.Connection) -> Tuple[Dict[str, int], np.ndarray]:
+    """
+    term -> column, and the idf per column (0 for terms outside the
+    MIN_DF/MAX_DF_RATIO band, so they are never picked).
+    """
+    n_docs = conn.execute("SELECT COUNT(*) FROM tag_docs").fetchone()[0]
+    terms = conn.execute("SELECT term, df FROM tag_terms").fetchall()
+    index = {row[0]: i for i, row in enumerate(terms)}
+    df = np.fromiter((row[1] for row in terms), dtype=np.float64, count=len(terms))
+
+    idf = np.log((1 + n_docs) / (1 + df)) + 1.0
+    idf[(df < MIN_DF) | (df > MAX_DF_RATIO * max(n_docs, 1))] = 0.0
+    return index, idf
+
+
+# -----------------------------
+# Vectorised tagging
+# -----------------------------
+def tfidf_rows(texts: List[str], index: Dict[str, int], idf: np.ndarray) -> sparse.csr_matrix:
+    """
+    Sublinear-tf × corpus-idf rows of ``texts`` over the model vocabulary.
+    """
+    tokens = [tokenize(text or "") for text in texts]
+    lengths = np.fromiter((len(t) for t in tokens), dtype=np.int64, count=len(tokens))
+    flat = [tok for toks in tokens for tok in toks]
+
+    # one C-level dict lookup per token; unknown terms come back as -1
+    cols = np.fromiter(map(index.get, flat, repeat(-1)), dtype=np.int64, count=len(flat))
+    rows = np.repeat(np.arange(len(texts)), lengths)
+    known = cols >= 0
+    counts = sparse.csr_matrix((np.ones(int(known.sum())), (rows[known], cols[known])),
+                               shape=(len(texts), len(idf)))
+    counts.sum_duplicates()
+    counts.data = (1.0 + np.log(counts.data)) * idf[counts.indices]
+    counts.eliminate_zeros()
+    return counts
+
+
+def top_k(matrix: sparse.csr_matrix, k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    ``(row, column, weight)`` of the k largest entries of every row, without
+    a per-row loop: entries are sorted by (row, -weight) and ranked within
+    their row via ``indptr``.
+    """
+    matrix = matrix.tocsr()
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    # row + 1/(1 + weight) sorts like (row, -weight) for positive weights,
+    # and one float argsort is about 3x faster than lexsort
+    order = np.argsort(rows + 1.0 / (1.0 + matrix.data), kind="stable")
+    rank = np.arange(len(order)) - matrix.indptr[rows[order]]
+    keep = order[rank < k]
+    return rows[keep], matrix.indices[keep], matrix.data[keep]
+
+
+def tag_books(conn: sqlite3.Connection, book_ids: Optional[List[int]] = None,
+              highlight_k: int = HIGHLIGHT_TAGS, book_k: int = BOOK_TAGS) -> Dict[str, int]:
+    """
+    Recompute highlight and book tags for ``book_ids`` (default: all).
+    """
+    index, idf = load_model(conn)
+    vocab = np.empty(len(index), dtype=object)
+    for term, i in index.items():
+        vocab[i] = term
+
+    sql = ("SELECT t.fingerprint, t.book_id, a.highlight FROM tag_docs t "
+           "JOIN annotations a ON a.book_id = t.book_id AND a.fingerprint = t.fingerprint")
+    params: list = []
+    if book_ids is not None:
+        if not book_ids:
+            return {"highlights": 0, "books": 0}
+        sql += f" WHERE t.book_id IN ({','.join('?' * len(book_ids))})"
+        params = list(book_ids)
+    docs = conn.execute(sql, params).fetchall()
+
+    with span("tagging.vectorize"):
+        matrix = tfidf_rows([row["highlight"] for row in docs], index, idf)
+
+    with span("tagging.top_k"):
+        rows, cols, _ = top_k(matrix, highlight_k)
+        grouped: Dict[int, List[str]] = {}
+        for r, tag in zip(rows.tolist(), vocab[cols].tolist()):
+            grouped.setdefault(r, []).append(tag)
+        highlight_rows = [(docs[r]["book_id"], docs[r]["fingerprint"], " ".join(tags)) for r, tags in grouped.items()]
+
+        # book vector: sum of its L2-normalised highlight rows
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        book_of = np.array([row["book_id"] for row in docs], dtype=np.int64)
+        books, book_index = np.unique(book_of, return_inverse=True)
+        membership = sparse.csr_matrix((1.0 / norms, (book_index, np.arange(len(docs)))),
+                                       shape=(len(books), len(docs)))
+        rows, cols, weights = top_k(membership @ matrix, book_k)
+        book_rows = list(zip(books[rows].tolist(), vocab[cols].tolist(), np.round(weights, 4).tolist()))
+
+    with conn, span("tagging.write"):
+        if book_ids is None:
+            conn.execute("DELETE FROM highlight_tags")
+            conn.execute("DELETE FROM book_tags")
+        else:
+            marks = ",".join("?" * len(book_ids))
+            conn.execute(f"DELETE FROM highlight_tags WHERE book_id IN ({marks})", params)
+            conn.execute(f"DELETE FROM book_tags WHERE book_id IN ({marks})", params)
+        conn.executemany("INSERT INTO highlight_tags (book_id, fingerprint, tags) VALUES (?, ?, ?)", highlight_rows)
+        conn.executemany("INSERT INTO book_tags (book_id, tag, weight) VALUES (?, ?, ?)", book_rows)
+
+    instrumentation.incr("tagging.highlights", len(docs))
+    return {"highlights": len(docs), "books": len(books)}
+
+
+def rebuild_model(conn: sqlite3.Connection) -> None:
+    with conn:
+        for table in MODEL_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+
+
+def band_terms(conn: sqlite3.Connection) -> set:
+    """
+    Terms inside the MIN_DF/MAX_DF_RATIO band, i.e. the ones that can be tags.
+    """
+    n_docs = conn.execute("SELECT COUNT(*) FROM tag_docs").fetchone()[0]
+    return {row[0] for row in conn.execute("SELECT term FROM tag_terms WHERE df >= ? AND df <= ?",
+                                           (MIN_DF, MAX_DF_RATIO * max(n_docs, 1)))}
+
+
+def books_tagged_with(conn: sqlite3.Connection, terms: set) -> set:
+    """
+    Books whose book or highlight tags use any of ``terms``.
+    """
+    if not terms:
+        return set()
+    books = {row[0] for row in conn.execute("SELECT book_id, tag FROM book_tags") if row[1] in terms}
+    for row in conn.execute("SELECT book_id, tags FROM highlight_tags"):
+        if row[0] not in books and not terms.isdisjoint(row[1].split()):
+            books.add(row[0])
+    return books
+
+
+def refresh(conn: sqlite3.Connection, retag: bool = False) -> Dict[str, int]:
+    """
+    Update the model, then retag the changed books plus every book tagged
+    with a term that left the band. Everything is retagged with ``retag``
+    or once the corpus drifted RETAG_DRIFT since the last full retag
+    (covering idf shifts and terms entering the band elsewhere).
+    """
+    before = band_terms(conn)
+    with span("tagging.update_model"):
+        touched, added, removed = update_model(conn)
+    left = before - band_terms(conn)
+
+    n_docs = conn.execute("SELECT COUNT(*) FROM tag_docs").fetchone()[0]
+    row = conn.execute("SELECT value FROM tag_state WHERE key = 'full_docs'").fetchone()
+    last_full = int(row[0]) if row else 0
+    full = retag or not last_full or abs(n_docs - last_full) > RETAG_DRIFT * last_full
+
+    if full:
+        result = tag_books(conn)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO tag_state (key, value) VALUES ('full_docs', ?)", (str(n_docs),))
+    else:
+        result = tag_books(conn, sorted(set(touched) | books_tagged_with(conn, left)))
+    return {"added": added, "removed": removed, "touched": len(touched), "full": int(full), **result}
+
+
+# -----------------------------
+# Reads
+# -----------------------------
+def highlight_tags(conn: sqlite3.Connection, book_id: int, fingerprint: str) -> List[str]:
+    row = conn.execute("SELECT tags FROM highlight_tags WHERE book_id = ? AND fingerprint = ?",
+                       (book_id, fingerprint)).fetchone()
+    return row["tags"].split() if row else []
+
+
+def page_tags(conn: sqlite3.Connection, k: int = BOOK_TAGS) -> Dict[str, List[str]]:
+    """
+    Tags per Notion page key; iBooks and Kindle copies of a book are merged
+    by summing their tag weights.
+    """
+    from property_sync import page_key_for
+
+    weights: Dict[str, Counter] = {}
+    for book in warehouse.iter_books(conn):
+        counter = weights.setdefault(page_key_for(book), Counter())
+        for row in conn.execute("SELECT tag, weight FROM book_tags WHERE book_id = ?", (book["id"],)):
+            counter[row["tag"]] += row["weight"]
+    return {key: sorted(tag for tag, _ in counter.most_common(k)) for key, counter in weights.items()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Keyword tags for highlights and books from a corpus TF-IDF model.")
+    parser.add_argument("--retag", action="store_true", help="retag the whole library, not only changed books")
+    parser.add_argument("--rebuild", action="store_true", help="refit the model from zero (implies --retag)")
+    parser.add_argument("--push", action="store_true", help="write book tags to the Notion Tags multi-select")
+    parser.add_argument("--dry-run", action="store_true", help="with --push: only list the pages that would change")
+    instrumentation.add_profile_args(parser)
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.enable("tagging", trace_memory=args.trace_memory)
+
+    conn = connect()
+    try:
+        if args.rebuild:
+            rebuild_model(conn)
+        result = refresh(conn, retag=args.retag or args.rebuild)
+        print(f"✔ Model: +{result['added']} -{result['removed']} highlight(s), {result['touched']} book(s) touched")
+        print(f"✔ Tagged {result['highlights']} highlight(s) in {result['books']} book(s)"
+              + (" (full retag)" if result["full"] else ""))
+
+        if args.push:
+            from notion_client import NotionClient
+            from property_sync import sync_properties
+
+            result = sync_properties(NotionClient(), conn, dry_run=args.dry_run, tags=page_tags(conn))
+            print(f"✔ {result['pages']} pages checked, {result['changed']} differ, {result['updated']} updated")
+    finally:
+        conn.close()
+
+    instrumentation.finish()
+
+
+if __name__ == "__main__":
+    main()
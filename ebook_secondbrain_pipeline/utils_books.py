@@ -1,3 +1,4 @@
+import hashlib
 import re
 from difflib import SequenceMatcher
 
@@ -22,6 +23,38 @@ def normalize_title(title: str) -> str:
     return title
 
 
+# -----------------------------
+# Export-name normalization
+# -----------------------------
+def normalize_string(value: str) -> str:
+    """
+    Strong normalization:
+    - lowercase
+    - remove punctuation
+    - collapse whitespace
+    """
+    if not value:
+        return ""
+    value = value.lower()
+    value = re.sub(r"\([^)]*\)", "", value)  # remove parentheses (ISBNs etc.)
+    value = re.sub(r"[^\w\s]", " ", value)
+    value = re.sub(r"\s+", " ", value)
+    return value.strip()
+
+
+def normalize_filename(value: str) -> str:
+    value = normalize_string(value)
+    value = re.sub(r"\s+", "_", value)
+    return value
+
+
+def export_name(title: str, author: str) -> str:
+    """
+    Stem of the per-book JSON written by epub_parser: ``title__author``.
+    """
+    return f"{normalize_filename(title)}__{normalize_filename(author)}"
+
+
 # -----------------------------
 # Filesystem-safe filenames
 # -----------------------------
@@ -35,6 +68,24 @@ def make_safe_filename(title: str) -> str:
     return f"{name}.json"
 
 
+# -----------------------------
+# Annotation identity
+# -----------------------------
+def annotation_fingerprint(source: str, book_title: str, text: str, note: str = None) -> str:
+    """
+    Stable identity of a highlight across runs and output formats.
+    Chapter and timestamps are deliberately left out so that relocating
+    a highlight does not turn it into a new one.
+    """
+    parts = (
+        source,
+        normalize_title(book_title),
+        re.sub(r"\s+", " ", text or "").strip(),
+        re.sub(r"\s+", " ", note or "").strip(),
+    )
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
 # -----------------------------
 # Fuzzy similarity
 # -----------------------------
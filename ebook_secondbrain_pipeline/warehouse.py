@@ -0,0 +1,755 @@
+from __future__ import annotations
+
+import hashlib
+import math
+import re
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+from paths import DERIVED_DATA_DIR
+from utils_books import annotation_fingerprint, export_name, normalize_title
+
+
+WAREHOUSE_PATH = DERIVED_DATA_DIR / "warehouse.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    id          INTEGER PRIMARY KEY,
+    name        TEXT NOT NULL UNIQUE,
+    last_loaded TEXT
+);
+
+CREATE TABLE IF NOT EXISTS books (
+    id            INTEGER PRIMARY KEY,
+    source_id     INTEGER NOT NULL REFERENCES sources(id),
+    external_id   TEXT NOT NULL,
+    title         TEXT NOT NULL,
+    author        TEXT,
+    title_key     TEXT NOT NULL,
+    export_name   TEXT NOT NULL,
+    date_added    TEXT,
+    date_finished TEXT,
+    UNIQUE (source_id, external_id)
+);
+CREATE INDEX IF NOT EXISTS books_title_key ON books(title_key);
+CREATE INDEX IF NOT EXISTS books_export_name ON books(export_name);
+
+CREATE TABLE IF NOT EXISTS chapters (
+    id      INTEGER PRIMARY KEY,
+    book_id INTEGER NOT NULL REFERENCES books(id),
+    title   TEXT NOT NULL,
+    UNIQUE (book_id, title)
+);
+
+CREATE TABLE IF NOT EXISTS annotations (
+    id           INTEGER PRIMARY KEY,
+    book_id      INTEGER NOT NULL REFERENCES books(id),
+    chapter_id   INTEGER REFERENCES chapters(id),
+    fingerprint  TEXT NOT NULL,
+    uuid         TEXT,
+    highlight    TEXT,
+    note         TEXT,
+    style        INTEGER,
+    position     REAL,
+    location     TEXT,
+    created      TEXT,
+    modified     TEXT,
+    content_hash TEXT NOT NULL,
+    deleted      INTEGER NOT NULL DEFAULT 0,
+    updated_at   TEXT NOT NULL,
+    -- the fingerprint hashes source, title and text: two editions of a
+    -- title share it, so it is only unique within a book
+    UNIQUE (book_id, fingerprint)
+);
+CREATE INDEX IF NOT EXISTS annotations_fingerprint ON annotations(fingerprint);
+CREATE INDEX IF NOT EXISTS annotations_book_updated ON annotations(book_id, updated_at);
+CREATE INDEX IF NOT EXISTS annotations_book_position ON annotations(book_id, position);
+CREATE INDEX IF NOT EXISTS annotations_uuid ON annotations(uuid);
+
+-- keyed like annotations: editions of a title have separate blocks
+CREATE TABLE IF NOT EXISTS notion_blocks (
+    book_id     INTEGER NOT NULL REFERENCES books(id),
+    fingerprint TEXT NOT NULL,
+    page_id     TEXT NOT NULL,
+    block_id    TEXT,
+    synced_at   TEXT NOT NULL,
+    PRIMARY KEY (book_id, fingerprint)
+);
+CREATE INDEX IF NOT EXISTS notion_blocks_page ON notion_blocks(page_id);
+
+-- chapter sub-pages of a book page (chapter layout); grouped chapters share a page
+CREATE TABLE IF NOT EXISTS notion_chapter_pages (
+    parent_id TEXT NOT NULL,
+    chapter   TEXT NOT NULL,
+    page_id   TEXT NOT NULL,
+    position  INTEGER NOT NULL,
+    PRIMARY KEY (parent_id, chapter)
+);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    book_id   INTEGER PRIMARY KEY REFERENCES books(id),
+    synced_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS duplicates (
+    book_id        INTEGER NOT NULL REFERENCES books(id),
+    fingerprint    TEXT NOT NULL,
+    canonical_book INTEGER NOT NULL REFERENCES books(id),
+    canonical      TEXT NOT NULL,
+    similarity     REAL NOT NULL,
+    PRIMARY KEY (book_id, fingerprint)
+);
+CREATE INDEX IF NOT EXISTS duplicates_canonical ON duplicates(canonical_book, canonical);
+"""
+
+
+def connect(path: Path = WAREHOUSE_PATH) -> sqlite3.Connection:
+    # stages may write concurrently (pipeline.py); wait for the lock instead of failing
+    conn = sqlite3.connect(path, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    _scope_fingerprints(conn)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# table -> (pattern of its globally keyed layout, copy from "<table>_old");
+# in order: later copies look up the book of a fingerprint in annotations
+LEGACY_LAYOUTS = {
+    "annotations": (
+        r"fingerprint\s+TEXT\s+NOT\s+NULL\s+UNIQUE",
+        "INSERT INTO annotations SELECT * FROM annotations_old",
+    ),
+    "notion_blocks": (
+        r"fingerprint\s+TEXT\s+PRIMARY\s+KEY",
+        """
+        INSERT INTO notion_blocks (book_id, fingerprint, page_id, block_id, synced_at)
+        SELECT book_id, fingerprint, page_id, block_id, synced_at FROM (
+            SELECT o.*, (SELECT MIN(a.book_id) FROM annotations a WHERE a.fingerprint = o.fingerprint) AS book_id
+            FROM notion_blocks_old o
+        ) WHERE book_id IS NOT NULL
+        """,
+    ),
+    "duplicates": (
+        r"fingerprint\s+TEXT\s+PRIMARY\s+KEY",
+        """
+        INSERT INTO duplicates (book_id, fingerprint, canonical_book, canonical, similarity)
+        SELECT book_id, fingerprint, canonical_book, canonical, similarity FROM (
+            SELECT o.*,
+                   (SELECT MIN(a.book_id) FROM annotations a WHERE a.fingerprint = o.fingerprint) AS book_id,
+                   (SELECT MIN(a.book_id) FROM annotations a WHERE a.fingerprint = o.canonical) AS canonical_book
+            FROM duplicates_old o
+        ) WHERE book_id IS NOT NULL AND canonical_book IS NOT NULL
+        """,
+    ),
+}
+
+
+def _scope_fingerprints(conn: sqlite3.Connection) -> None:
+    """
+    Warehouses created with globally unique fingerprints are copied into
+    the current (book, fingerprint) keyed tables once; SQLite cannot drop
+    the constraints. Blocks and duplicates are assigned to the first book
+    holding their fingerprint.
+    """
+    legacy = []
+    for table, (pattern, copy) in LEGACY_LAYOUTS.items():
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+        if row is not None and re.search(pattern, row[0]):
+            legacy.append((table, copy))
+    if not legacy:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for table, _ in legacy:
+            conn.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+            # the indexes moved with the table and would block their re-creation
+            for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                        "AND tbl_name = ? AND sql IS NOT NULL", (f"{table}_old",)).fetchall():
+                conn.execute(f"DROP INDEX {name}")
+        # statement by statement: executescript would commit the transaction
+        statement = ""
+        for line in SCHEMA.splitlines(keepends=True):
+            statement += line
+            if sqlite3.complete_statement(statement):
+                conn.execute(statement)
+                statement = ""
+        for table, copy in legacy:
+            conn.execute(copy)
+            conn.execute(f"DROP TABLE {table}_old")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def now_iso() -> str:
+    return datetime.now().isoformat(timespec="microseconds")
+
+
+def content_hash(record: dict) -> str:
+    parts = [str(record.get(k) or "") for k in ("highlight", "note", "chapter", "style", "position")]
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def _iso(value) -> Optional[str]:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+# -----------------------------
+# Upserts (call inside one transaction)
+# -----------------------------
+def source_id(conn: sqlite3.Connection, name: str) -> int:
+    conn.execute(
+        "INSERT INTO sources (name, last_loaded) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET last_loaded = excluded.last_loaded",
+        (name, now_iso()),
+    )
+    return conn.execute("SELECT id FROM sources WHERE name = ?", (name,)).fetchone()[0]
+
+
+def upsert_book(conn: sqlite3.Connection, src_id: int, external_id: str, title: str,
+                author: Optional[str], date_added=None, date_finished=None) -> int:
+    conn.execute(
+        """
+        INSERT INTO books
+            (source_id, external_id, title, author, title_key, export_name, date_added, date_finished)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(source_id, external_id) DO UPDATE SET
+            title = excluded.title,
+            author = excluded.author,
+            title_key = excluded.title_key,
+            export_name = excluded.export_name,
+            date_added = excluded.date_added,
+            date_finished = excluded.date_finished
+        """,
+        (src_id, external_id, title, author, normalize_title(title),
+         export_name(title, author or ""), _iso(date_added), _iso(date_finished)),
+    )
+    return conn.execute(
+        "SELECT id FROM books WHERE source_id = ? AND external_id = ?", (src_id, external_id)
+    ).fetchone()[0]
+
+
+def upsert_annotations(conn: sqlite3.Connection, book_id: int, records: List[dict]) -> Dict[str, int]:
+    """
+    Make ``book_id`` hold exactly ``records`` (keyed by fingerprint
+    within the book).
+
+    Rows whose content hash is unchanged are not touched, so their
+    ``updated_at`` stays put; missing rows are soft-deleted. This keeps
+    "what changed since T" an index range scan on (book_id, updated_at).
+    """
+    stamp = now_iso()
+
+    chapter_ids: Dict[str, int] = {}
+    for title in {r.get("chapter") for r in records if r.get("chapter")}:
+        conn.execute("INSERT OR IGNORE INTO chapters (book_id, title) VALUES (?, ?)", (book_id, title))
+    for row in conn.execute("SELECT id, title FROM chapters WHERE book_id = ?", (book_id,)):
+        chapter_ids[row["title"]] = row["id"]
+
+    rows = []
+    for r in records:
+        rows.append({
+            "book_id": book_id,
+            "chapter_id": chapter_ids.get(r.get("chapter")),
+            "fingerprint": r["fingerprint"],
+            "uuid": r.get("uuid"),
+            "highlight": r.get("highlight"),
+            "note": r.get("note"),
+            "style": r.get("style"),
+            "position": r.get("position"),
+            "location": r.get("location"),
+            "created": _iso(r.get("created")),
+            "modified": _iso(r.get("modified")),
+            "content_hash": content_hash(r),
+            "updated_at": stamp,
+        })
+
+    before = {
+        row["fingerprint"] for row in conn.execute(
+            "SELECT fingerprint FROM annotations WHERE book_id = ? AND deleted = 0", (book_id,)
+        )
+    }
+
+    cur = conn.executemany(
+        """
+        INSERT INTO annotations
+            (book_id, chapter_id, fingerprint, uuid, highlight, note, style, position,
+             location, created, modified, content_hash, deleted, updated_at)
+        VALUES
+            (:book_id, :chapter_id, :fingerprint, :uuid, :highlight, :note, :style, :position,
+             :location, :created, :modified, :content_hash, 0, :updated_at)
+        ON CONFLICT(book_id, fingerprint) DO UPDATE SET
+            chapter_id = excluded.chapter_id,
+            uuid = excluded.uuid,
+            highlight = excluded.highlight,
+            note = excluded.note,
+            style = excluded.style,
+            position = excluded.position,
+            location = excluded.location,
+            created = excluded.created,
+            modified = excluded.modified,
+            content_hash = excluded.content_hash,
+            deleted = 0,
+            updated_at = excluded.updated_at
+        WHERE annotations.content_hash != excluded.content_hash OR annotations.deleted = 1
+        """,
+        rows,
+    )
+
+    wanted = {r["fingerprint"] for r in rows}
+    gone = before - wanted
+    conn.executemany(
+        "UPDATE annotations SET deleted = 1, updated_at = ? WHERE book_id = ? AND fingerprint = ?",
+        [(stamp, book_id, fp) for fp in gone],
+    )
+
+    inserted = len(wanted - before)
+    return {"inserted": inserted, "updated": max(cur.rowcount - inserted, 0), "deleted": len(gone)}
+
+
+# -----------------------------
+# Extractor entry points
+# -----------------------------
+def _merge_stats(total: Dict[str, int], stats: Dict[str, int]) -> None:
+    for key, value in stats.items():
+        total[key] = total.get(key, 0) + value
+
+
+def load_ibooks(books: Dict[str, dict], path: Path = WAREHOUSE_PATH,
+                conn: Optional[sqlite3.Connection] = None) -> Dict[str, int]:
+    """
+    Bulk-load ``epub_parser`` books (asset_id -> book dict) in one transaction.
+    Pass ``conn`` to reuse an open handle (e.g. from the watch daemon).
+    """
+    total: Dict[str, int] = {}
+    own_conn = conn is None
+    conn = conn or connect(path)
+
+    with conn:
+        src = source_id(conn, "ibooks")
+        for asset_id, book in books.items():
+            book_id = upsert_book(conn, src, asset_id, book["title"], book["author"],
+                                  book.get("date_added"), book.get("date_finished"))
+            records = [
+                {
+                    "fingerprint": annotation_fingerprint("ibooks", book["title"], a["highlight"], a["note"]),
+                    "uuid": a.get("uuid"),
+                    "highlight": a["highlight"],
+                    "note": a["note"],
+                    "chapter": a.get("chapter"),
+                    "style": a.get("style"),
+                    "position": a.get("start_loc"),
+                    "location": a.get("loc_text"),
+                    "created": a.get("created"),
+                    "modified": a.get("modified"),
+                }
+                for a in book["annotations"]
+                if a["highlight"] or a["note"]
+            ]
+            _merge_stats(total, upsert_annotations(conn, book_id, records))
+
+    if own_conn:
+        conn.close()
+    return total
+
+
+def load_kindle(grouped: Dict[str, List[dict]], path: Path = WAREHOUSE_PATH,
+                conn: Optional[sqlite3.Connection] = None) -> Dict[str, int]:
+    """
+    Bulk-load ``kindle_cleaner`` output (title -> items) in one transaction.
+    """
+    from kindle_cleaner import page_sort_key, split_title_author
+
+    total: Dict[str, int] = {}
+    own_conn = conn is None
+    conn = conn or connect(path)
+
+    with conn:
+        src = source_id(conn, "kindle")
+        for raw_title, items in grouped.items():
+            title, author = split_title_author(raw_title)
+            book_id = upsert_book(conn, src, normalize_title(raw_title), title, author)
+            records = []
+            for item in items:
+                position = page_sort_key(item.get("page"))
+                records.append({
+                    "fingerprint": annotation_fingerprint("kindle", raw_title, item["text"]),
+                    "highlight": item["text"],
+                    "chapter": item.get("chapter") or (f"Seite {item['page']}" if item.get("page") else None),
+                    "position": position if math.isfinite(position) else None,
+                    "location": item.get("page"),
+                    "created": item.get("timestamp"),
+                })
+            _merge_stats(total, upsert_annotations(conn, book_id, records))
+
+    if own_conn:
+        conn.close()
+    return total
+
+
+# -----------------------------
+# Queries
+# -----------------------------
+# A canonical copy without a note takes the note of a live duplicate of
+# it (see dedupe.py), so the Notion sync and the sinks show merged notes.
+ANNOTATION_COLUMNS = """
+    a.id, a.fingerprint, a.uuid, a.highlight,
+    COALESCE(a.note, (
+        SELECT x.note FROM duplicates d
+        JOIN annotations x ON x.book_id = d.book_id AND x.fingerprint = d.fingerprint
+        WHERE d.canonical_book = a.book_id AND d.canonical = a.fingerprint
+          AND x.deleted = 0 AND x.note IS NOT NULL
+        ORDER BY d.similarity DESC LIMIT 1
+    )) AS note,
+    a.style, a.position, a.location, a.created, a.modified, a.deleted, a.updated_at,
+    c.title AS chapter
+"""
+
+
+def find_book(conn: sqlite3.Connection, title: str, source: Optional[str] = None) -> Optional[sqlite3.Row]:
+    sql = """
+        SELECT b.*, s.name AS source FROM books b JOIN sources s ON s.id = b.source_id
+        WHERE b.title_key = ?
+    """
+    params: list = [normalize_title(title)]
+    if source:
+        sql += " AND s.name = ?"
+        params.append(source)
+    return conn.execute(sql, params).fetchone()
+
+
+def find_book_by_export_name(conn: sqlite3.Connection, name: str,
+                             source: str = "ibooks") -> Optional[sqlite3.Row]:
+    """
+    The book exported as ``name``. The iBooks and Kindle copies of a title
+    share the name; ``source`` is preferred (the Notion map holds iBooks
+    export names and dedupe keeps their copies), then the oldest book.
+    """
+    return conn.execute(
+        "SELECT b.*, s.name AS source FROM books b JOIN sources s ON s.id = b.source_id "
+        "WHERE b.export_name = ? ORDER BY s.name = ? DESC, b.id LIMIT 1",
+        (name, source),
+    ).fetchone()
+
+
+def changed_annotations(conn: sqlite3.Connection, book_id: int, since: Optional[str] = None,
+                        include_deleted: bool = True) -> List[sqlite3.Row]:
+    """
+    Annotations of ``book_id`` inserted/updated/deleted after ``since``
+    (indexed range scan on (book_id, updated_at)).
+    """
+    sql = f"""
+        SELECT {ANNOTATION_COLUMNS}
+        FROM annotations a LEFT JOIN chapters c ON c.id = a.chapter_id
+        WHERE a.book_id = ? AND a.updated_at > ?
+    """
+    if not include_deleted:
+        sql += " AND a.deleted = 0"
+    return conn.execute(sql + " ORDER BY a.updated_at", (book_id, since or "")).fetchall()
+
+
+def book_annotations(conn: sqlite3.Connection, book_id: int) -> List[sqlite3.Row]:
+    return conn.execute(
+        f"""
+        SELECT {ANNOTATION_COLUMNS}
+        FROM annotations a LEFT JOIN chapters c ON c.id = a.chapter_id
+        WHERE a.book_id = ? AND a.deleted = 0
+        ORDER BY c.title, a.created
+        """,
+        (book_id,),
+    ).fetchall()
+
+
+def rows_document(book: sqlite3.Row, rows: Iterable[sqlite3.Row]) -> dict:
+    """
+    Build the ``epub_parser`` JSON shape for ``book`` from annotation rows
+    (already ordered by chapter). Entries carry their fingerprint, the
+    meta the warehouse book id.
+    """
+    document = {
+        "meta": {
+            "source_title": book["title"],
+            "source_author": book["author"],
+            "normalized_title": book["export_name"].split("__")[0],
+            "normalized_author": book["export_name"].split("__")[-1],
+            "book_id": book["id"],
+        },
+        "annotations": [],
+    }
+
+    current = None
+    for row in rows:
+        chapter = row["chapter"] or "Unknown Chapter"
+        if current is None or current["chapter"] != chapter:
+            current = {"chapter": chapter, "entries": []}
+            document["annotations"].append(current)
+        current["entries"].append({
+            "highlight": row["highlight"],
+            "note": row["note"],
+            "created": row["created"],
+            "fingerprint": row["fingerprint"],
+        })
+
+    return document
+
+
+def book_document(conn: sqlite3.Connection, book: sqlite3.Row) -> dict:
+    """
+    Rebuild the ``epub_parser`` JSON shape for one book from the warehouse.
+    """
+    return rows_document(book, book_annotations(conn, book["id"]))
+
+
+def search_records(conn: sqlite3.Connection,
+                   book_ids: Optional[Iterable[int]] = None) -> Iterator[Dict[str, Optional[str]]]:
+    """
+    Live annotations in the record shape used by ``search_index``,
+    optionally restricted to ``book_ids``.
+    """
+    sql = """
+        SELECT a.fingerprint, s.name AS source, b.title AS book, b.author,
+               c.title AS chapter, a.created, a.highlight, a.note
+        FROM annotations a
+        JOIN books b ON b.id = a.book_id
+        JOIN sources s ON s.id = b.source_id
+        LEFT JOIN chapters c ON c.id = a.chapter_id
+        WHERE a.deleted = 0
+    """
+    params: list = []
+    if book_ids is not None:
+        book_ids = list(book_ids)
+        sql += f" AND a.book_id IN ({','.join('?' * len(book_ids))})"
+        params = book_ids
+
+    for row in conn.execute(sql, params):
+        yield dict(row)
+
+
+def changed_book_ids(conn: sqlite3.Connection, since: str) -> List[int]:
+    return [
+        row[0] for row in conn.execute(
+            "SELECT DISTINCT book_id FROM annotations WHERE updated_at > ?", (since,)
+        )
+    ]
+
+
+def book_stats(conn: sqlite3.Connection) -> List[sqlite3.Row]:
+    """
+    Per book: live highlight count, chapter count, first/last highlight.
+    """
+    return conn.execute(
+        """
+        SELECT b.id, b.title, b.author, b.title_key, b.export_name, b.date_finished,
+               s.name AS source,
+               COUNT(a.id) AS highlights,
+               COUNT(DISTINCT a.chapter_id) AS chapters,
+               MIN(a.created) AS first_highlight,
+               MAX(a.created) AS last_highlight
+        FROM books b
+        JOIN sources s ON s.id = b.source_id
+        LEFT JOIN annotations a ON a.book_id = b.id AND a.deleted = 0
+        GROUP BY b.id
+        """
+    ).fetchall()
+
+
+def iter_books(conn: sqlite3.Connection, source: Optional[str] = None) -> Iterable[sqlite3.Row]:
+    sql = "SELECT b.*, s.name AS source FROM books b JOIN sources s ON s.id = b.source_id"
+    if source:
+        return conn.execute(sql + " WHERE s.name = ?", (source,))
+    return conn.execute(sql)
+
+
+# -----------------------------
+# Notion sync bookkeeping
+# -----------------------------
+def mark_synced(conn: sqlite3.Connection, rows: List[tuple]) -> None:
+    """
+    Record ``(book_id, fingerprint, page_id, block_id)`` rows as present in Notion.
+    """
+    stamp = now_iso()
+    conn.executemany(
+        "INSERT INTO notion_blocks (book_id, fingerprint, page_id, block_id, synced_at) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(book_id, fingerprint) DO UPDATE SET page_id = excluded.page_id, "
+        "block_id = excluded.block_id, synced_at = excluded.synced_at",
+        [(book_id, fp, page_id, block_id, stamp) for book_id, fp, page_id, block_id in rows],
+    )
+
+
+def synced_updates(conn: sqlite3.Connection, book_id: int) -> List[sqlite3.Row]:
+    """
+    Annotations whose text changed after they were sent to Notion: a live
+    row sharing its iBooks UUID with a soft-deleted row that still owns a
+    block. ``old_fingerprint``/``block_id`` identify the block to rewrite.
+    """
+    return conn.execute(
+        f"""
+        SELECT {ANNOTATION_COLUMNS}, n.fingerprint AS old_fingerprint, n.block_id
+        FROM annotations a
+        LEFT JOIN chapters c ON c.id = a.chapter_id
+        JOIN annotations old ON old.book_id = a.book_id AND old.uuid = a.uuid
+                            AND old.fingerprint != a.fingerprint
+        JOIN notion_blocks n ON n.book_id = old.book_id AND n.fingerprint = old.fingerprint
+        WHERE a.book_id = ? AND a.updated_at > ? AND a.deleted = 0 AND old.deleted = 1
+          AND n.block_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM notion_blocks x
+                          WHERE x.book_id = a.book_id AND x.fingerprint = a.fingerprint)
+        """,
+        (book_id, get_watermark(conn, book_id)),
+    ).fetchall()
+
+
+def synced_deletions(conn: sqlite3.Connection, book_id: int) -> List[sqlite3.Row]:
+    """
+    Soft-deleted annotations that still own a Notion block and were not
+    replaced by an edited copy (same UUID).
+    """
+    return conn.execute(
+        """
+        SELECT a.fingerprint, n.block_id
+        FROM annotations a JOIN notion_blocks n ON n.book_id = a.book_id AND n.fingerprint = a.fingerprint
+        WHERE a.book_id = ? AND a.updated_at > ? AND a.deleted = 1
+          AND n.block_id IS NOT NULL
+          AND NOT (a.uuid IS NOT NULL AND EXISTS (
+              SELECT 1 FROM annotations live
+              WHERE live.book_id = a.book_id AND live.uuid = a.uuid AND live.deleted = 0
+          ))
+        """,
+        (book_id, get_watermark(conn, book_id)),
+    ).fetchall()
+
+
+def move_synced(conn: sqlite3.Connection, rows: List[tuple]) -> None:
+    """
+    Re-key ``(book_id, old_fingerprint, new_fingerprint)`` blocks after an in-place update.
+    """
+    conn.executemany(
+        "UPDATE notion_blocks SET fingerprint = ?, synced_at = ? WHERE book_id = ? AND fingerprint = ?",
+        [(new, now_iso(), book_id, old) for book_id, old, new in rows],
+    )
+
+
+def forget_synced(conn: sqlite3.Connection, rows: List[tuple]) -> None:
+    """
+    Drop the blocks of ``(book_id, fingerprint)`` pairs.
+    """
+    conn.executemany("DELETE FROM notion_blocks WHERE book_id = ? AND fingerprint = ?", rows)
+
+
+def synced_fingerprints(conn: sqlite3.Connection, book_id: int) -> Set[str]:
+    return {row[0] for row in conn.execute("SELECT fingerprint FROM notion_blocks WHERE book_id = ?", (book_id,))}
+
+
+def page_has_blocks(conn: sqlite3.Connection, page_id: str) -> bool:
+    return conn.execute("SELECT 1 FROM notion_blocks WHERE page_id = ? LIMIT 1", (page_id,)).fetchone() is not None
+
+
+def chapter_anchors(conn: sqlite3.Connection, page_id: str) -> Dict[str, str]:
+    """
+    chapter -> the block last synced for it on ``page_id``; the chapter's
+    heading is already on the page, new highlights go below that block.
+    """
+    rows = conn.execute(
+        """
+        SELECT c.title AS chapter, n.block_id FROM notion_blocks n
+        JOIN annotations a ON a.book_id = n.book_id AND a.fingerprint = n.fingerprint
+        LEFT JOIN chapters c ON c.id = a.chapter_id
+        WHERE n.page_id = ? AND n.block_id IS NOT NULL
+        ORDER BY n.synced_at, n.rowid
+        """,
+        (page_id,),
+    )
+    # later rows win
+    return {row["chapter"] or "Unknown Chapter": row["block_id"] for row in rows}
+
+
+def chapter_pages(conn: sqlite3.Connection, parent_id: str) -> Dict[str, str]:
+    """
+    chapter -> sub-page id for a book page in chapter layout (empty otherwise).
+    """
+    rows = conn.execute("SELECT chapter, page_id FROM notion_chapter_pages WHERE parent_id = ? ORDER BY position",
+                        (parent_id,))
+    return {row["chapter"]: row["page_id"] for row in rows}
+
+
+def record_chapter_pages(conn: sqlite3.Connection, parent_id: str, rows: List[tuple]) -> None:
+    """
+    Record ``(chapter, page_id)`` pairs, positioned after the known ones.
+    """
+    start = conn.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM notion_chapter_pages WHERE parent_id = ?",
+                         (parent_id,)).fetchone()[0]
+    conn.executemany(
+        "INSERT OR REPLACE INTO notion_chapter_pages (parent_id, chapter, page_id, position) VALUES (?, ?, ?, ?)",
+        [(parent_id, chapter, page_id, start + i) for i, (chapter, page_id) in enumerate(rows)],
+    )
+
+
+def get_watermark(conn: sqlite3.Connection, book_id: int) -> str:
+    row = conn.execute("SELECT synced_at FROM sync_state WHERE book_id = ?", (book_id,)).fetchone()
+    return row["synced_at"] if row else ""
+
+
+def set_watermark(conn: sqlite3.Connection, book_id: int, stamp: str) -> None:
+    conn.execute(
+        "INSERT INTO sync_state (book_id, synced_at) VALUES (?, ?) "
+        "ON CONFLICT(book_id) DO UPDATE SET synced_at = excluded.synced_at",
+        (book_id, stamp),
+    )
+
+
+def unsynced_annotations(conn: sqlite3.Connection, book_id: int) -> List[sqlite3.Row]:
+    """
+    Live annotations changed since the book's watermark that have no
+    Notion block yet.
+    """
+    return conn.execute(
+        f"""
+        SELECT {ANNOTATION_COLUMNS}
+        FROM annotations a LEFT JOIN chapters c ON c.id = a.chapter_id
+        WHERE a.book_id = ? AND a.updated_at > ? AND a.deleted = 0
+          AND NOT EXISTS (SELECT 1 FROM notion_blocks n WHERE n.book_id = a.book_id AND n.fingerprint = a.fingerprint)
+          AND NOT EXISTS (SELECT 1 FROM duplicates d WHERE d.book_id = a.book_id AND d.fingerprint = a.fingerprint)
+        ORDER BY c.title, a.created
+        """,
+        (book_id, get_watermark(conn, book_id)),
+    ).fetchall()
+
+
+# -----------------------------
+# Cross-source duplicates
+# -----------------------------
+def cross_source_books(conn: sqlite3.Connection) -> Dict[str, List[sqlite3.Row]]:
+    """
+    title_key -> books, for titles present in more than one source.
+    """
+    grouped: Dict[str, List[sqlite3.Row]] = {}
+    for row in conn.execute(
+        """
+        SELECT b.*, s.name AS source FROM books b JOIN sources s ON s.id = b.source_id
+        WHERE b.title_key IN (
+            SELECT title_key FROM books GROUP BY title_key HAVING COUNT(DISTINCT source_id) > 1
+        )
+        ORDER BY b.title_key, s.name
+        """
+    ):
+        grouped.setdefault(row["title_key"], []).append(row)
+    return grouped
+
+
+def replace_duplicates(conn: sqlite3.Connection, book_ids: List[int], rows: List[tuple]) -> None:
+    """
+    Make ``(book_id, fingerprint, canonical_book, canonical, similarity)``
+    rows the duplicate set of ``book_ids``.
+    """
+    conn.execute(f"DELETE FROM duplicates WHERE book_id IN ({','.join('?' * len(book_ids))})", book_ids)
+    conn.executemany(
+        "INSERT OR REPLACE INTO duplicates (book_id, fingerprint, canonical_book, canonical, similarity) "
+        "VALUES (?, ?, ?, ?, ?)",
+        rows,
+    )
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import epub_parser
+import kindle_cleaner
+import outbox
+import search_index
+from notion_client import NotionClient
+
+
+# -----------------------------
+# Defaults
+# -----------------------------
+POLL_INTERVAL = 1.0   # seconds between stat() sweeps
+SETTLE_SECONDS = 3.0  # quiet period before a burst of writes counts as done
+
+Snapshot = Dict[str, Optional[Tuple[int, int]]]
+
+
+# -----------------------------
+# Watched files
+# -----------------------------
+def with_wal(path: Path) -> List[Path]:
+    # iBooks writes through SQLite WAL; the main file may not change for a while
+    return [path, path.with_name(path.name + "-wal")]
+
+
+def ibooks_paths() -> List[Path]:
+    paths = with_wal(epub_parser.ORIG_BOOK_DB_PATH) + with_wal(epub_parser.ORIG_ANNOT_DB_PATH)
+    for db_path in epub_parser.discover_annotation_dbs():
+        paths.extend(with_wal(db_path))
+    return paths
+
+
+def kindle_paths() -> List[Path]:
+    return [
+        path for path in kindle_cleaner.RAW_DIR.iterdir()
+        if path.is_file() and kindle_cleaner.FILENAME_DATE_PATTERN.match(path.name)
+    ]
+
+
+def snapshot(paths: List[Path]) -> Snapshot:
+    state: Snapshot = {}
+    for path in paths:
+        try:
+            stat = path.stat()
+            state[str(path)] = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            state[str(path)] = None
+    return state
+
+
+# -----------------------------
+# Daemon
+# -----------------------------
+class Watcher:
+    """
+    Poll the iBooks databases (incl. -wal) and the Kindle raw directory.
+    After a change has settled, run only the affected extraction and push
+    new highlights to Notion. Connections, the Notion session and resolved
+    page ids stay open between events.
+    """
+
+    def __init__(self, sync: bool = True, interval: float = POLL_INTERVAL, settle: float = SETTLE_SECONDS):
+        self.interval = interval
+        self.settle = settle
+        # the warehouse, with the outbox table the Notion worker drains
+        self.warehouse_conn = outbox.connect()
+        self.index_conn = search_index.connect()
+        self.worker = outbox.Worker(NotionClient(), self.warehouse_conn) if sync else None
+
+        self.sources = {
+            "ibooks": ibooks_paths,
+            "kindle": kindle_paths,
+        }
+        self.state = {name: snapshot(fn()) for name, fn in self.sources.items()}
+        self.pending: Dict[str, float] = {}
+
+    # -----------------------------
+    # Handlers
+    # -----------------------------
+    def handle_ibooks(self) -> None:
+        result = epub_parser.run_extraction(self.warehouse_conn, self.index_conn)
+        loaded = result["warehouse"]
+        print(f"📚 iBooks: +{loaded.get('inserted', 0)} ~{loaded.get('updated', 0)} -{loaded.get('deleted', 0)}")
+
+    def handle_kindle(self) -> None:
+        raw_file = kindle_cleaner.select_and_cleanup_raw_files(delete_old=True)
+        result = kindle_cleaner.clean_raw_file(raw_file, self.warehouse_conn, self.index_conn)
+        loaded = result["warehouse"]
+        print(f"📱 Kindle: +{loaded.get('inserted', 0)} ~{loaded.get('updated', 0)} -{loaded.get('deleted', 0)}")
+
+    def sync_notion(self) -> None:
+        if self.worker is None:
+            return
+
+        queued = outbox.enqueue_all(self.warehouse_conn)
+        if queued:
+            print(f"📮 {queued} Notion operation(s) queued")
+        # backing-off operations are retried on a later tick, see run()
+        done = self.worker.run(stop_when_empty=True, wait_for_backoff=False)
+        if done:
+            print(f"✅ {done} Notion operation(s) done")
+
+    def outbox_due(self) -> bool:
+        if self.worker is None:
+            return False
+        due = outbox.next_due(self.warehouse_conn)
+        return due is not None and due <= time.time()
+
+    # -----------------------------
+    # Loop
+    # -----------------------------
+    def poll(self) -> List[str]:
+        """
+        Return the sources whose changes have settled.
+        """
+        now = time.monotonic()
+
+        for name, fn in self.sources.items():
+            current = snapshot(fn())
+            if current != self.state[name]:
+                self.state[name] = current
+                self.pending[name] = now  # restart the debounce window
+
+        ready = [name for name, seen in self.pending.items() if now - seen >= self.settle]
+        for name in ready:
+            del self.pending[name]
+        return ready
+
+    def run(self) -> None:
+        handlers = {"ibooks": self.handle_ibooks, "kindle": self.handle_kindle}
+        print(f"👀 Watching iBooks + Kindle sources (poll {self.interval}s, settle {self.settle}s). Ctrl+C to stop.")
+
+        try:
+            while True:
+                ready = self.poll()
+                for name in ready:
+                    try:
+                        handlers[name]()
+                    except Exception as exc:  # keep the daemon alive
+                        epub_parser.log_error(f"watch: {name} extraction failed: {exc}")
+                    # our own copies into data/raw must not count as a new change
+                    self.state[name] = snapshot(self.sources[name]())
+                if ready or self.outbox_due():
+                    try:
+                        self.sync_notion()
+                    except Exception as exc:
+                        epub_parser.log_error(f"watch: Notion sync failed: {exc}")
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            print("\n👋 Stopped.")
+        finally:
+            self.warehouse_conn.close()
+            self.index_conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sync iBooks/Kindle highlights to Notion as they change.")
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL, help="poll interval in seconds")
+    parser.add_argument("--settle", type=float, default=SETTLE_SECONDS, help="debounce window in seconds")
+    parser.add_argument("--no-sync", action="store_true", help="only extract, do not push to Notion")
+    args = parser.parse_args()
+
+    Watcher(sync=not args.no_sync, interval=args.interval, settle=args.settle).run()
+
+
+if __name__ == "__main__":
+    main()
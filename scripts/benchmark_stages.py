@@ -0,0 +1,157 @@
+# benchmark_stages.py
+
+import argparse
+import importlib.util
+import json
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT / "ebook_secondbrain_pipeline"))
+
+import epub_parser
+import kindle_cleaner
+import synthetic_data
+from paths import LOG_DIR
+from utils_books import normalize_filename, normalize_string, normalize_title
+
+HISTORY_FILE = LOG_DIR / "benchmark_history.jsonl"
+
+
+def load_inspect_ibooks():
+    # scripts/ is not a package; load inspect_ibooks.py by path
+    spec = importlib.util.spec_from_file_location("inspect_ibooks", PROJECT_ROOT / "scripts" / "inspect_ibooks.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# -------------------------
+# Measuring
+# -------------------------
+def measure(name, fn, trace_memory=True):
+    """
+    Run ``fn`` once; it returns the number of records it processed.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    records = fn()
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        "stage": name,
+        "records": records,
+        "seconds": round(elapsed, 4),
+        "records_per_s": round(records / elapsed, 1) if elapsed else None,
+        "peak_mb": round(peak / 1e6, 2),
+    }
+
+
+# -------------------------
+# Stages
+# -------------------------
+def run_size(n_annotations, work_dir, n_books, language, trace_memory, inspect_ibooks):
+    books_meta = synthetic_data.book_titles(n_books, random.Random(0))
+    library_db = synthetic_data.make_library_db(work_dir / "BKLibrary-bench.sqlite", books_meta)
+    annot_db = synthetic_data.make_annotation_db(work_dir / "AEAnnotation_bench.sqlite", books_meta, n_annotations)
+    clippings = work_dir / "bench_kindle_annotations_raw.txt"
+    synthetic_data.write_clippings(clippings, n_clippings=n_annotations, language=language)
+
+    state = {}
+    results = []
+
+    def ibooks_read():
+        state["books"] = epub_parser.load_books(library_db)
+        return epub_parser.load_annotations(state["books"], [annot_db])
+
+    def ibooks_export():
+        # export_books only writes the focus titles; serialise every book instead
+        n = 0
+        for book in state["books"].values():
+            if book["annotations"]:
+                json.dumps(epub_parser.build_book_json(book), ensure_ascii=False, indent=2)
+                n += len(book["annotations"])
+        return n
+
+    def kindle_parse():
+        state["grouped"] = kindle_cleaner.parse_kindle_annotations(clippings.read_text(encoding="utf-8"))
+        return sum(len(items) for items in state["grouped"].values())
+
+    def normalize():
+        n = 0
+        for book in state["books"].values():
+            normalize_title(book["title"])
+            normalize_filename(book["author"])
+            for a in book["annotations"]:
+                normalize_string(a["highlight"])
+                n += 1
+        for title, items in state["grouped"].items():
+            kindle_cleaner.split_title_author(kindle_cleaner.normalize_title(title))
+            n += len(items)
+        return n
+
+    def assign_chapters():
+        df = inspect_ibooks.load_annotations(annot_db)
+        inspect_ibooks.assign_chapters(df)
+        return len(df)
+
+    for name, fn in [
+        ("ibooks.read", ibooks_read),
+        ("ibooks.export", ibooks_export),
+        ("kindle.parse", kindle_parse),
+        ("normalize", normalize),
+        ("assign_chapters", assign_chapters),
+    ]:
+        results.append({"annotations": n_annotations, **measure(name, fn, trace_memory)})
+
+    return results
+
+
+def print_results(results):
+    print(f"\n{'size':>8} {'stage':<18} {'records':>9} {'seconds':>9} {'records/s':>12} {'peak MB':>9}")
+    for r in results:
+        print(f"{r['annotations']:>8} {r['stage']:<18} {r['records']:>9} {r['seconds']:>9.3f} "
+              f"{r['records_per_s'] or 0:>12.0f} {r['peak_mb']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the extraction/cleaning stages on synthetic data.")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="comma-separated annotation counts (up to 500000)")
+    parser.add_argument("--books", type=int, default=200)
+    parser.add_argument("--language", choices=("de", "en", "mixed"), default="mixed",
+                        help="Kindle clippings language")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc (faster, no peak column)")
+    parser.add_argument("--save", action="store_true", help=f"append the results to {HISTORY_FILE.name}")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    inspect_ibooks = load_inspect_ibooks()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            print(f"⏱  {n} annotations …")
+            results.extend(run_size(n, Path(tmp), args.books, args.language, not args.no_memory, inspect_ibooks))
+
+    print_results(results)
+
+    if args.save:
+        HISTORY_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(HISTORY_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"run": datetime.now().isoformat(timespec="seconds"), "results": results}) + "\n")
+        print(f"📄 Results appended to {HISTORY_FILE}")
+
+
+if __name__ == "__main__":
+    main()
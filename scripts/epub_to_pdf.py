@@ -1,7 +1,13 @@
 from pathlib import Path
-from ebooklib import epub, ITEM_DOCUMENT
-from bs4 import BeautifulSoup
+import sys
 from weasyprint import HTML
+from pypdf import PdfWriter
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT / "ebook_secondbrain_pipeline"))
+
+from epub_content import read_spine
+from render_cache import RenderCache
 
 # -------------------------------------------------
 # Paths
@@ -13,62 +19,69 @@ EPUB_PATH = Path.home() / (
 
 OUTPUT_PDF = Path.home() / "Desktop/Hedge_Fund_Market_Wizards_generated.pdf"
 
+STYLESHEET = """
+    body {
+        font-family: Georgia, serif;
+        font-size: 11pt;
+        line-height: 1.5;
+        margin: 2cm;
+    }
+    h1, h2, h3 {
+        page-break-after: avoid;
+    }
+"""
+
 # -------------------------------------------------
-# Step 1: Read EPUB
+# Step 1 + 2: Read EPUB and extract cleaned spine content
 # -------------------------------------------------
-book = epub.read_epub(str(EPUB_PATH))
-
-html_sections = []
+# Served from data/derived/epub_cache while the EPUB is unchanged.
+html_sections = [doc["html"] for doc in read_spine(EPUB_PATH, fields=("html",))]
 
 # -------------------------------------------------
-# Step 2: Extract spine content
+# Step 3: Render changed chapters only
 # -------------------------------------------------
-for item in book.get_items_of_type(ITEM_DOCUMENT):
-    soup = BeautifulSoup(item.get_content(), "html.parser")
+# Every chapter becomes its own PDF, cached by hash(stylesheet + HTML).
+# Chapters already in the cache are reused as-is, so re-converting an
+# unchanged book only merges existing files.
+cache = RenderCache()
+chapter_keys = []
+rendered = 0
 
-    # Clean junk
-    for tag in soup(["script", "style"]):
-        tag.decompose()
+for section in html_sections:
+    key = RenderCache.key(section, STYLESHEET)
+    chapter_keys.append(key)
 
-    # Ensure page breaks between chapters
-    wrapper = f"""
-    <div style="page-break-before: always;">
-        {str(soup)}
-    </div>
-    """
+    if cache.get(key) is not None:
+        continue
 
-    html_sections.append(wrapper)
-
-# -------------------------------------------------
-# Step 3: Wrap in full HTML document
-# -------------------------------------------------
-full_html = f"""
+    chapter_html = f"""
 <!DOCTYPE html>
 <html>
 <head>
 <meta charset="utf-8">
-<style>
-    body {{
-        font-family: Georgia, serif;
-        font-size: 11pt;
-        line-height: 1.5;
-        margin: 2cm;
-    }}
-    h1, h2, h3 {{
-        page-break-after: avoid;
-    }}
-</style>
+<style>{STYLESHEET}</style>
 </head>
 <body>
-{''.join(html_sections)}
+{section}
 </body>
 </html>
 """
+    cache.put(key, HTML(string=chapter_html).write_pdf())
+    rendered += 1
 
 # -------------------------------------------------
-# Step 4: Render to PDF
+# Step 4: Merge chapter PDFs
 # -------------------------------------------------
-HTML(string=full_html).write_pdf(str(OUTPUT_PDF))
+# Each chapter starts on a new page, like the former page-break wrapper.
+writer = PdfWriter()
+for key in chapter_keys:
+    writer.append(str(cache.path_for(key)))
+
+with open(OUTPUT_PDF, "wb") as f:
+    writer.write(f)
+
+cache.evict(keep=chapter_keys)
 
+print(f"Chapters rendered: {rendered} / {len(chapter_keys)} (rest from cache)")
 print("PDF created at:")
 print(OUTPUT_PDF)
@@ -1,33 +1,31 @@
 from pathlib import Path
-import os
-import json
+import argparse
 import random
-import requests
-from dotenv import load_dotenv
+import sys
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT / "ebook_secondbrain_pipeline"))
+
+from http_cache import add_cache_args
+from notion_client import NotionClient
+import notion_schema
 
 
 # ─────────────────────────────────────────────
-# Environment setup
+# Client & schema (cached in data/derived/notion_schema.json)
 # ─────────────────────────────────────────────
 
-PROJECT_ROOT = Path(__file__).resolve().parents[1]
-ENV_PATH = PROJECT_ROOT / ".env"
-
-if not load_dotenv(ENV_PATH):
-    raise RuntimeError(f"Failed to load env file at {ENV_PATH}")
+parser = argparse.ArgumentParser(description="Read and overwrite the Summary of one page.")
+add_cache_args(parser)
+args = parser.parse_args()
 
-NOTION_API_KEY = os.getenv("NOTION_API_KEY")
-NOTION_DATABASE_ID = os.getenv("NOTION_DATABASE_ID")
+client = NotionClient(use_cache=not args.no_cache)
+schema = client.schema()
 
-if not NOTION_API_KEY or not NOTION_DATABASE_ID:
-    raise ValueError("Missing NOTION_API_KEY or NOTION_DATABASE_ID")
+TITLE_PROPERTY = notion_schema.title_property(schema)
+SUMMARY_PROPERTY = "Summary"
 
-
-HEADERS = {
-    "Authorization": f"Bearer {NOTION_API_KEY}",
-    "Notion-Version": "2022-06-28",
-    "Content-Type": "application/json",
-}
+notion_schema.validate_filter_property(schema, SUMMARY_PROPERTY, "rich_text")
 
 
 # ─────────────────────────────────────────────
@@ -37,24 +35,19 @@ HEADERS = {
 BOOK_TITLE = "Hedge Fund Market Wizards"
 #BOOK_TITLE = "Hedgehogging"
 
-query_url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query"
-
 query_payload = {
     "filter": {
-        "property": "Title",
+        "property": TITLE_PROPERTY,
         "title": {
             "equals": BOOK_TITLE
         }
     }
 }
 
-response = requests.post(query_url, headers=HEADERS, json=query_payload)
-response.raise_for_status()
-
-results = response.json()["results"]
+results = list(client.query_database(query_payload))
 
 if not results:
-    raise RuntimeError(f"No page found with Title == '{BOOK_TITLE}'")
+    raise RuntimeError(f"No page found with {TITLE_PROPERTY} == '{BOOK_TITLE}'")
 
 page = results[0]
 page_id = page["id"]
@@ -66,7 +59,7 @@ print(f"Found page: {page_id}")
 # 2️⃣ Read current Summary value
 # ─────────────────────────────────────────────
 
-summary_property = page["properties"]["Summary"]["rich_text"]
+summary_property = page["properties"][SUMMARY_PROPERTY]["rich_text"]
 
 current_summary = (
     "".join(rt["plain_text"] for rt in summary_property)
@@ -87,29 +80,21 @@ random_summary = random.choice([
     "Automated Notion update successful.",
 ])
 
-update_url = f"https://api.notion.com/v1/pages/{page_id}"
-
-update_payload = {
-    "properties": {
-        "Summary": {
-            "rich_text": [
-                {
-                    "type": "text",
-                    "text": {
-                        "content": random_summary
-                    }
+update_properties = {
+    SUMMARY_PROPERTY: {
+        "rich_text": [
+            {
+                "type": "text",
+                "text": {
+                    "content": random_summary
                 }
-            ]
-        }
+            }
+        ]
     }
 }
 
-update_response = requests.patch(
-    update_url,
-    headers=HEADERS,
-    json=update_payload
-)
-update_response.raise_for_status()
+# validated against the cached schema before the PATCH is sent
+client.update_page_properties(page_id, update_properties)
 
 print("\nUpdated Summary to:")
 print(random_summary)
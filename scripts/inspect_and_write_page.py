@@ -1,66 +1,44 @@
 from pathlib import Path
-import os
-import json
-import random
-import requests
-from dotenv import load_dotenv
+import argparse
+import sys
 
-# ─────────────────────────────────────────────
-# Environment setup
-# ─────────────────────────────────────────────
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
-ENV_PATH = PROJECT_ROOT / ".env"
+sys.path.insert(0, str(PROJECT_ROOT / "ebook_secondbrain_pipeline"))
 
-if not load_dotenv(ENV_PATH):
-    raise RuntimeError(f"Failed to load env file at {ENV_PATH}")
+from notion_blocks import count_blocks, fetch_tree, walk
+from http_cache import add_cache_args
+from notion_client import NotionClient
 
-NOTION_API_KEY = os.getenv("NOTION_API_KEY")
-NOTION_DATABASE_ID = os.getenv("NOTION_DATABASE_ID")
-
-if not NOTION_API_KEY or not NOTION_DATABASE_ID:
-    raise ValueError("Missing NOTION_API_KEY or NOTION_DATABASE_ID")
+# ─────────────────────────────────────────────
+# Client setup
+# ─────────────────────────────────────────────
+parser = argparse.ArgumentParser(description="Print a page's block tree and append a TOC.")
+add_cache_args(parser)
+args = parser.parse_args()
 
-HEADERS = {
-    "Authorization": f"Bearer {NOTION_API_KEY}",
-    "Notion-Version": "2022-06-28",
-    "Content-Type": "application/json",
-}
+client = NotionClient(use_cache=not args.no_cache)
 
 # ─────────────────────────────────────────────
 # 1️⃣ Query page by Title
 # ─────────────────────────────────────────────
 BOOK_TITLE = "Hedge Fund Market Wizards"
 
-query_url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query"
-query_payload = {
-    "filter": {"property": "Title", "title": {"equals": BOOK_TITLE}}
-}
-
-response = requests.post(query_url, headers=HEADERS, json=query_payload)
-response.raise_for_status()
-results = response.json()["results"]
+page_id = client.find_page_id(BOOK_TITLE)
 
-if not results:
+if not page_id:
     raise RuntimeError(f"No page found with Title == '{BOOK_TITLE}'")
 
-page = results[0]
-page_id = page["id"]
 print(f"Found page: {page_id}")
 
 # ─────────────────────────────────────────────
-# 2️⃣ Fetch all page blocks (to detect cover/image block)
+# 2️⃣ Fetch the full block tree (to detect cover/image block)
 # ─────────────────────────────────────────────
-blocks_url = f"https://api.notion.com/v1/blocks/{page_id}/children"
-blocks_response = requests.get(blocks_url, headers=HEADERS)
-blocks_response.raise_for_status()
-blocks = blocks_response.json()["results"]
+blocks = fetch_tree(client, page_id)
 
-print("\nExisting page blocks:")
+print(f"\nExisting page blocks ({count_blocks(blocks)}):")
 print("─" * 40)
-for block in blocks:
-    block_type = block["type"]
-    block_data = block.get(block_type, {})
-    print(f"[{block_type}] (id={block['id']})")
+for depth, block in walk(blocks):
+    print(f"{'  ' * depth}[{block['type']}] (id={block['id']})")
 
 # ─────────────────────────────────────────────
 # 3️⃣ Append Table of Contents (Inhaltsverzeichnis) after first image block
@@ -116,8 +94,6 @@ content_blocks = [
 children_to_append = [toc_block] + content_blocks
 
 # Append to the page
-append_url = f"https://api.notion.com/v1/blocks/{page_id}/children"
-patch_response = requests.patch(append_url, headers=HEADERS, json={"children": children_to_append})
-patch_response.raise_for_status()
+client.append_children(page_id, children_to_append)
 
 print("\nTable of Contents + headings appended successfully!")
@@ -1,16 +1,23 @@
 # inspect_ibooks.py
 
+import argparse
 import sqlite3
+import sys
 import pandas as pd
 from pathlib import Path
 import json
 
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT / "ebook_secondbrain_pipeline"))
+
+# analytics, annotation_store and warehouse are imported where used, so the
+# --from-sqlite path runs without pyarrow
+
 # -------------------------
 # Constants & Folders
 # -------------------------
-DATA_DIR = Path("../data")
+DATA_DIR = PROJECT_ROOT / "data"
 SUMMARY_DIR = DATA_DIR / "ibooks_summary"
-SUMMARY_DIR.mkdir(exist_ok=True)
 
 APPLE_EPOCH_START = pd.Timestamp("2001-01-01")
 
@@ -40,10 +47,11 @@ def load_annotations(db_file=None):
         select_cols.append("ZANNOTATIONENDLOC AS end_loc")
 
     query = f"SELECT {', '.join(select_cols)} FROM ZAEANNOTATION WHERE ZANNOTATIONSELECTEDTEXT IS NOT NULL"
+    if "ZANNOTATIONDELETED" in columns:
+        query += " AND ZANNOTATIONDELETED = 0"
     df = pd.read_sql_query(query, conn)
     conn.close()
 
-    df["book_id"] = df["book_id"].astype(str).str.strip()
     df["highlight"] = df["highlight"].astype(str).str.strip()
     df["modified"] = APPLE_EPOCH_START + pd.to_timedelta(df["modified"], unit="s", errors="coerce")
 
@@ -51,8 +59,23 @@ def load_annotations(db_file=None):
         if col in df.columns:
             df[col] = pd.to_numeric(df[col], errors="coerce")
     if "chapter_fallback" in df.columns:
-        df["chapter_fallback"] = df["chapter_fallback"].astype(str).str.strip()
+        # .str keeps missing values missing (astype(str) would make "None")
+        df["chapter_fallback"] = df["chapter_fallback"].str.strip()
+
+    return finish_annotations(df)
 
+
+def finish_annotations(df):
+    """
+    Last step of every loader, so the SQLite, Parquet and warehouse paths
+    hand ``summarize_annotations`` the same rows and types.
+    """
+    df["book_id"] = df["book_id"].astype(str).str.strip()
+    # a nullable int16 or a column with gaps would come back as float
+    df["color"] = pd.to_numeric(df["color"], errors="coerce").astype("Int64")
+    # without positions, chapters come from chapter_fallback
+    if "start_loc" in df.columns and df["start_loc"].isna().all():
+        df = df.drop(columns="start_loc")
     return df
 
 
@@ -87,6 +110,76 @@ def load_books(db_file=None):
     return df
 
 
+# -------------------------
+# Load from the Parquet store written by epub_parser
+# -------------------------
+# Only the columns summarize_annotations needs are read; timestamps are
+# already converted. Like the SQLite path, note-only rows are skipped and
+# the chapter fallback is ZFUTUREPROOFING5 (stored as chapter_hint).
+SUMMARY_ANNOTATION_COLUMNS = ["book_id", "color", "modified", "chapter_hint", "start_loc"]
+SUMMARY_BOOK_COLUMNS = ["book_id", "title", "author", "date_added", "date_finished"]
+
+
+def load_annotations_from_store(columns=SUMMARY_ANNOTATION_COLUMNS):
+    import annotation_store
+
+    df = annotation_store.read_annotations(columns=columns, highlights_only=True)
+    if "chapter_hint" in df.columns:
+        df = df.rename(columns={"chapter_hint": "chapter_fallback"})
+        df["chapter_fallback"] = df["chapter_fallback"].astype(object).str.strip()
+    return finish_annotations(df)
+
+
+def load_books_from_store(columns=SUMMARY_BOOK_COLUMNS):
+    import annotation_store
+
+    df = annotation_store.read_books(columns=columns)
+    df["author"] = df["author"].astype(str)
+    return df
+
+
+def store_exists():
+    try:
+        import annotation_store
+    except ImportError:  # no pyarrow: fall back to the SQLite files
+        return False
+    return annotation_store.store_exists()
+
+
+# -------------------------
+# Load from the local warehouse
+# -------------------------
+def load_from_warehouse(conn=None):
+    import warehouse
+
+    # the warehouse keeps no ZFUTUREPROOFING5; its chapter title is the
+    # fallback, which only matters for books without positions
+    conn = conn or warehouse.connect()
+    annotations = pd.read_sql_query(
+        """
+        SELECT b.external_id AS book_id, a.style AS color, a.modified,
+               c.title AS chapter_fallback, a.position AS start_loc
+        FROM annotations a
+        JOIN books b ON b.id = a.book_id
+        JOIN sources s ON s.id = b.source_id
+        LEFT JOIN chapters c ON c.id = a.chapter_id
+        WHERE s.name = 'ibooks' AND a.deleted = 0 AND a.highlight IS NOT NULL
+        """,
+        conn,
+        parse_dates=["modified"],
+    )
+    books = pd.read_sql_query(
+        """
+        SELECT b.external_id AS book_id, b.title, b.author, b.date_added, b.date_finished
+        FROM books b JOIN sources s ON s.id = b.source_id
+        WHERE s.name = 'ibooks'
+        """,
+        conn,
+        parse_dates=["date_added", "date_finished"],
+    )
+    return finish_annotations(annotations), books
+
+
 # -------------------------
 # Assign chapters more granularly
 # -------------------------
@@ -150,7 +243,7 @@ def summarize_annotations(annotations, books):
             chapter_summary = {
                 "chapter": chap,
                 "highlights_count": int(chap_df.shape[0]),
-                "colors_used": sorted(chap_df["color"].dropna().unique().tolist()),
+                "colors_used": sorted(int(c) for c in chap_df["color"].dropna().unique()),
                 "first_highlight": (chap_df["modified"].min().isoformat() if pd.notnull(chap_df["modified"].min()) else None),
                 "last_highlight": (chap_df["modified"].max().isoformat() if pd.notnull(chap_df["modified"].max()) else None)
             }
@@ -165,6 +258,7 @@ def summarize_annotations(annotations, books):
 # Save summary JSON
 # -------------------------
 def save_summary_json(summary_list, filename="books_summary.json"):
+    SUMMARY_DIR.mkdir(parents=True, exist_ok=True)
     out_path = SUMMARY_DIR / filename
     with open(out_path, "w", encoding="utf-8") as f:
         json.dump(summary_list, f, indent=4, ensure_ascii=False)
@@ -175,8 +269,32 @@ def save_summary_json(summary_list, filename="books_summary.json"):
 # Main
 # -------------------------
 def main():
-    annotations = load_annotations()
-    books = load_books()
+    parser = argparse.ArgumentParser(description="Summarize iBooks annotations per book and chapter.")
+    parser.add_argument("--from-sqlite", action="store_true",
+                        help="re-read the raw Apple SQLite files instead of the Parquet store")
+    parser.add_argument("--from-warehouse", action="store_true",
+                        help="query the local annotation warehouse")
+    parser.add_argument("--from-analytics", action="store_true",
+                        help="read the incrementally maintained aggregates (see analytics.py)")
+    args = parser.parse_args()
+
+    if args.from_analytics:
+        import analytics
+
+        conn = analytics.connect()
+        analytics.refresh(conn)
+        save_summary_json(analytics.summary_document(conn))
+        conn.close()
+        return
+
+    if args.from_warehouse:
+        annotations, books = load_from_warehouse()
+    elif not args.from_sqlite and store_exists():
+        annotations = load_annotations_from_store()
+        books = load_books_from_store()
+    else:
+        annotations = load_annotations()
+        books = load_books()
     summary = summarize_annotations(annotations, books)
     save_summary_json(summary)
     print("✔ Done! JSON summary is ready for Notion export.")
@@ -1,48 +1,31 @@
 from pathlib import Path
-import os
+import argparse
 import json
-import requests
-from dotenv import load_dotenv
-
-
-# ─────────────────────────────────────────────
-# Environment setup
-# ─────────────────────────────────────────────
+import sys
 
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
-ENV_PATH = PROJECT_ROOT / ".env"
-
-if not load_dotenv(ENV_PATH):
-    raise RuntimeError(f"Failed to load env file at {ENV_PATH}")
-
-NOTION_API_KEY = os.getenv("NOTION_API_KEY")
-NOTION_DATABASE_ID = os.getenv("NOTION_DATABASE_ID")
-
-if not NOTION_API_KEY:
-    raise ValueError("NOTION_API_KEY is missing or empty")
-
-if not NOTION_DATABASE_ID:
-    raise ValueError("NOTION_DATABASE_ID is missing or empty")
-
+sys.path.insert(0, str(PROJECT_ROOT / "ebook_secondbrain_pipeline"))
 
-HEADERS = {
-    "Authorization": f"Bearer {NOTION_API_KEY}",
-    "Notion-Version": "2022-06-28",
-    "Content-Type": "application/json",
-}
+from http_cache import add_cache_args
+from notion_client import NotionClient
+import notion_schema
 
 
 # ─────────────────────────────────────────────
-# Fetch database schema
+# Load database schema (cached in data/derived/notion_schema.json)
 # ─────────────────────────────────────────────
 
-url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}"
+parser = argparse.ArgumentParser(description="Print the Notion database schema.")
+parser.add_argument("--refresh", action="store_true", help="re-read the schema from Notion")
+parser.add_argument("--raw", action="store_true", help="also dump the cached schema JSON")
+add_cache_args(parser)
+args = parser.parse_args()
 
-response = requests.get(url, headers=HEADERS)
-response.raise_for_status()
+client = NotionClient(use_cache=not args.no_cache)
+schema = client.schema(refresh=args.refresh)
+properties = schema["properties"]
 
-database = response.json()
-properties = database.get("properties", {})
+print(f"(schema cache: {notion_schema.SCHEMA_PATH}, last edited {schema['last_edited_time']})")
 
 
 # ─────────────────────────────────────────────
@@ -71,8 +54,9 @@ for name, prop in properties.items():
 
 
 # ─────────────────────────────────────────────
-# Optional: raw JSON dump (comment out if noisy)
+# Optional: raw JSON dump
 # ─────────────────────────────────────────────
 
-# print("\nRaw database JSON:")
-# print(json.dumps(database, indent=2))
+if args.raw:
+    print("\nRaw schema JSON:")
+    print(json.dumps(schema, indent=2, ensure_ascii=False))
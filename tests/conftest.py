@@ -0,0 +1,117 @@
+import importlib.util
+import random
+import sys
+import tracemalloc
+from pathlib import Path
+
+import pytest
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT / "ebook_secondbrain_pipeline"))
+
+import synthetic_data
+
+# one line per benchmarked stage, printed after the run (records/s, peak memory)
+STAGE_RESULTS = []
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("synthetic data")
+    group.addoption("--bench-annotations", default="1000",
+                    help="comma-separated annotation/clipping counts (1000 up to 500000)")
+    group.addoption("--bench-books", type=int, default=200, help="books in the synthetic library")
+    group.addoption("--bench-rounds", type=int, default=3, help="timed rounds per stage")
+
+
+def pytest_generate_tests(metafunc):
+    if "n_annotations" in metafunc.fixturenames:
+        sizes = [int(s) for s in metafunc.config.getoption("--bench-annotations").split(",") if s.strip()]
+        metafunc.parametrize("n_annotations", sizes, scope="session")
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not STAGE_RESULTS:
+        return
+    terminalreporter.section("stage throughput")
+    terminalreporter.write_line(f"{'size':>8} {'stage':<18} {'records':>9} {'records/s':>12} {'peak MB':>9}")
+    for r in STAGE_RESULTS:
+        terminalreporter.write_line(f"{r['annotations']:>8} {r['stage']:<18} {r['records']:>9} "
+                                    f"{r['records_per_s']:>12.0f} {r['peak_mb']:>9.1f}")
+
+
+# -------------------------
+# Synthetic sources
+# -------------------------
+@pytest.fixture(scope="session")
+def books_meta(request):
+    return synthetic_data.book_titles(request.config.getoption("--bench-books"), random.Random(0))
+
+
+@pytest.fixture(scope="session")
+def library_db(tmp_path_factory, books_meta):
+    return synthetic_data.make_library_db(tmp_path_factory.mktemp("ibooks") / "BKLibrary-bench.sqlite", books_meta)
+
+
+@pytest.fixture(scope="session")
+def annotation_db(tmp_path_factory, books_meta, n_annotations):
+    path = tmp_path_factory.mktemp("ibooks") / "AEAnnotation_bench.sqlite"
+    return synthetic_data.make_annotation_db(path, books_meta, n_annotations)
+
+
+@pytest.fixture(scope="session")
+def clippings(tmp_path_factory, n_annotations):
+    """
+    ``(path, entries written)`` of a German/English clippings file.
+    """
+    path = tmp_path_factory.mktemp("kindle") / "bench_kindle_annotations_raw.txt"
+    return path, synthetic_data.write_clippings(path, n_clippings=n_annotations, language="mixed")
+
+
+@pytest.fixture(scope="session")
+def inspect_ibooks():
+    # scripts/ is not a package; load inspect_ibooks.py by path
+    spec = importlib.util.spec_from_file_location("inspect_ibooks", PROJECT_ROOT / "scripts" / "inspect_ibooks.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# -------------------------
+# Measuring
+# -------------------------
+def peak_mb(fn) -> float:
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1e6, 2)
+
+
+@pytest.fixture
+def run_stage(benchmark, request, n_annotations):
+    """
+    Time ``fn`` with pytest-benchmark and return its last result.
+    ``records`` maps that result to the number of records processed;
+    throughput and the tracemalloc peak (one extra, untimed run) go to
+    the benchmark's extra_info and the summary at the end.
+    """
+    def run(stage, fn, records):
+        result = benchmark.pedantic(fn, rounds=request.config.getoption("--bench-rounds"), iterations=1)
+        if benchmark.disabled:
+            return result
+
+        n = records(result)
+        info = {
+            "stage": stage,
+            "annotations": n_annotations,
+            "records": n,
+            "records_per_s": round(n / benchmark.stats.stats.mean, 1),
+            "peak_mb": peak_mb(fn),
+        }
+        benchmark.extra_info.update(info)
+        STAGE_RESULTS.append(info)
+        return result
+
+    return run
@@ -0,0 +1,44 @@
+import dedupe
+
+TEXT = ("What if we stopped celebrating being busy as a measurement of importance and instead "
+        "celebrated how much time we had spent listening, pondering, meditating and enjoying time")
+
+
+def test_near_copies_across_sources_keep_the_ibooks_one():
+    records = [
+        {"highlight": TEXT + " with the most important people in our lives.", "source": "kindle"},
+        {"highlight": "Only once you give yourself permission to stop trying to do it all can you "
+                      "make your highest contribution towards the things that really matter.", "source": "ibooks"},
+        {"highlight": TEXT + " with the most important people in our lives", "source": "ibooks"},
+    ]
+
+    duplicates = dedupe.find_duplicates(records)
+
+    assert [(i, canonical) for i, canonical, _ in duplicates] == [(0, 2)]
+    assert duplicates[0][2] >= dedupe.JACCARD_THRESHOLD
+
+
+def test_shorter_kindle_excerpt_is_a_duplicate():
+    records = [
+        {"highlight": TEXT, "source": "kindle"},
+        {"highlight": "Essentialism: " + TEXT + " with the most important people in our lives.", "source": "ibooks"},
+    ]
+
+    duplicates = dedupe.find_duplicates(records)
+
+    assert [(i, canonical) for i, canonical, _ in duplicates] == [(0, 1)]
+
+
+def test_copies_within_one_source_are_not_compared():
+    records = [{"highlight": TEXT, "source": "kindle"}, {"highlight": TEXT, "source": "kindle"}]
+
+    assert dedupe.find_duplicates(records) == []
+
+
+def test_unrelated_highlights_are_kept():
+    records = [
+        {"highlight": TEXT, "source": "ibooks"},
+        {"highlight": "The way of the Essentialist means living by design, not by default.", "source": "kindle"},
+    ]
+
+    assert dedupe.find_duplicates(records) == []
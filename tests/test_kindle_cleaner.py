@@ -0,0 +1,61 @@
+import kindle_cleaner
+
+CLIPPINGS = (
+    "﻿Essentialism (McKeown, Greg)\n"
+    "- Deine Markierung auf Seite 12 | Position 170-171 | Hinzugefügt am Donnerstag, 25. Dezember 2025 12:01:07\n"
+    "\n"
+    "Weniger, aber besser.\n"
+    "==========\n"
+    "Deep Work (Newport, Cal)\n"
+    "- Your Highlight on page 40 | Location 601-603 | Added on Wednesday, January 3, 2024 10:00:00 PM\n"
+    "\n"
+    "Clarity about what matters\n"
+    "provides clarity about what does not.\n"
+    "==========\n"
+    "Essentialism (McKeown, Greg)\n"
+    "- Your Highlight at location 900-902 | Added on Wednesday, 3 January 2024 09:30:00\n"
+    "\n"
+    "If it isn't a clear yes, then it's a clear no.\n"
+    "==========\n"
+)
+
+
+def test_parses_german_and_english_entries():
+    grouped = kindle_cleaner.parse_kindle_annotations(CLIPPINGS)
+
+    assert {title: len(items) for title, items in grouped.items()} == {
+        "Essentialism (McKeown, Greg)": 2,
+        "Deep Work (Newport, Cal)": 1,
+    }
+    essentialism = grouped["Essentialism (McKeown, Greg)"]
+    assert essentialism[0] == {"text": "Weniger, aber besser.", "page": "12", "timestamp": "2025-12-25T12:01:07"}
+    assert essentialism[1]["page"] is None
+    assert essentialism[1]["timestamp"] == "2024-01-03T09:30:00"
+
+
+def test_entry_after_book_change_is_not_merged():
+    grouped = kindle_cleaner.parse_kindle_annotations(CLIPPINGS)
+
+    assert grouped["Deep Work (Newport, Cal)"] == [{
+        "text": "Clarity about what matters\nprovides clarity about what does not.",
+        "page": "40",
+        "timestamp": "2024-01-03T22:00:00",
+    }]
+    assert grouped["Essentialism (McKeown, Greg)"][0]["text"] == "Weniger, aber besser."
+
+
+def test_write_shards_skips_unchanged_and_removes_gone_books(tmp_path):
+    grouped = kindle_cleaner.parse_kindle_annotations(CLIPPINGS)
+
+    assert kindle_cleaner.write_shards(grouped, "first.txt", tmp_path) == {"books": 2, "written": 2, "removed": 0}
+    assert kindle_cleaner.write_shards(grouped, "second.txt", tmp_path) == {"books": 2, "written": 0, "removed": 0}
+
+    index = kindle_cleaner.read_shard_index(tmp_path)
+    deep_work = index["books"]["Deep Work (Newport, Cal)"]["shard"]
+    essentialism = grouped["Essentialism (McKeown, Greg)"][:1]
+    stats = kindle_cleaner.write_shards({"Essentialism (McKeown, Greg)": essentialism}, "third.txt", tmp_path)
+
+    assert stats == {"books": 1, "written": 1, "removed": 1}
+    assert not (tmp_path / deep_work).exists()
+    assert kindle_cleaner.read_shard_index(tmp_path)["source"] == "third.txt"
+    assert list(kindle_cleaner.iter_book("Essentialism", tmp_path)) == essentialism
@@ -0,0 +1,67 @@
+import pytest
+
+import outbox
+import warehouse
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = outbox.connect(tmp_path / "warehouse.sqlite")
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def json_name(conn):
+    with conn:
+        book_id = warehouse.upsert_book(conn, warehouse.source_id(conn, "ibooks"), "asset-1", "Essentialism", "McKeown")
+        warehouse.upsert_annotations(conn, book_id, [
+            {"fingerprint": f"fp{i}", "highlight": f"Highlight {i}", "chapter": "Part 1"} for i in range(3)
+        ])
+    return warehouse.find_book(conn, "Essentialism")["export_name"] + ".json"
+
+
+def test_enqueue_skips_open_operations(conn, json_name):
+    assert outbox.enqueue_book(conn, json_name) == 3
+    assert outbox.enqueue_book(conn, json_name) == 0
+    assert outbox.status(conn) == {"pending": 3}
+
+
+def test_leased_page_is_not_leased_twice(conn, json_name):
+    outbox.enqueue_book(conn, json_name)
+
+    ops = outbox.lease(conn, "worker-a")
+
+    assert len(ops) == 3
+    assert outbox.lease(conn, "worker-b") == []
+    assert outbox.status(conn) == {"leased": 3}
+
+
+def test_complete_is_idempotent(conn, json_name):
+    outbox.enqueue_book(conn, json_name)
+    ops = outbox.lease(conn, "worker-a")
+    synced = [(op["book_id"], f"fp{i}", "page", f"block{i}") for i, op in enumerate(ops)]
+
+    outbox.complete(conn, ops, synced=synced)
+    outbox.complete(conn, ops, synced=synced)
+
+    assert outbox.status(conn) == {"done": 3}
+    assert conn.execute("SELECT COUNT(*) FROM notion_blocks").fetchone()[0] == 3
+    # synced highlights are not queued again once their operations are done
+    assert outbox.enqueue_book(conn, json_name) == 0
+
+
+def test_release_backs_off_the_failed_operation_only(conn, json_name):
+    outbox.enqueue_book(conn, json_name)
+    ops = outbox.lease(conn, "worker-a")
+    outbox.complete(conn, ops[:1])
+
+    outbox.release(conn, ops, "HTTPError: 502")
+
+    rows = {row["id"]: row for row in conn.execute("SELECT * FROM outbox")}
+    assert rows[ops[0]["id"]]["status"] == "done"
+    assert rows[ops[1]["id"]]["attempts"] == 1
+    assert rows[ops[1]["id"]]["error"] == "HTTPError: 502"
+    assert rows[ops[2]["id"]]["attempts"] == 0
+    # the page waits for its failed head, so order within the page holds
+    assert outbox.lease(conn, "worker-b") == []
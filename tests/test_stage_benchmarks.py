@@ -0,0 +1,101 @@
+import json
+import sqlite3
+
+import epub_parser
+import kindle_cleaner
+from utils_books import normalize_filename, normalize_string, normalize_title
+
+
+def live_annotation_count(annotation_db, library_db) -> int:
+    conn = sqlite3.connect(annotation_db)
+    conn.execute("ATTACH DATABASE ? AS lib", (str(library_db),))
+    count = conn.execute(
+        "SELECT COUNT(*) FROM ZAEANNOTATION WHERE ZANNOTATIONDELETED = 0 "
+        "AND ZANNOTATIONASSETID IN (SELECT ZASSETID FROM lib.ZBKLIBRARYASSET)"
+    ).fetchone()[0]
+    conn.close()
+    return count
+
+
+def load_ibooks(library_db, annotation_db):
+    books = epub_parser.load_books(library_db)
+    epub_parser.load_annotations(books, [annotation_db])
+    return books
+
+
+# -------------------------
+# iBooks
+# -------------------------
+def test_ibooks_read(run_stage, library_db, annotation_db):
+    books = run_stage("ibooks.read", lambda: load_ibooks(library_db, annotation_db),
+                      lambda books: sum(len(b["annotations"]) for b in books.values()))
+
+    assert sum(len(b["annotations"]) for b in books.values()) == live_annotation_count(annotation_db, library_db)
+
+
+def test_ibooks_export(run_stage, library_db, annotation_db):
+    books = load_ibooks(library_db, annotation_db)
+
+    def export():
+        # export_books only writes the focus titles; serialise every book instead
+        return [json.dumps(epub_parser.build_book_json(b), ensure_ascii=False, indent=2)
+                for b in books.values() if b["annotations"]]
+
+    def entries(documents):
+        return sum(len(c["entries"]) for doc in documents for c in json.loads(doc)["annotations"])
+
+    documents = run_stage("ibooks.export", export, entries)
+
+    assert entries(documents) == sum(len(b["annotations"]) for b in books.values())
+
+
+# -------------------------
+# Kindle
+# -------------------------
+def test_kindle_parse(run_stage, clippings):
+    path, written = clippings
+    text = path.read_text(encoding="utf-8")
+
+    grouped = run_stage("kindle.parse", lambda: kindle_cleaner.parse_kindle_annotations(text),
+                        lambda grouped: sum(len(items) for items in grouped.values()))
+
+    items = [item for entries in grouped.values() for item in entries]
+    assert len(items) == written
+    assert all(item["timestamp"] and item["page"] for item in items)
+
+
+# -------------------------
+# Normalisation
+# -------------------------
+def test_normalize(run_stage, library_db, annotation_db, clippings):
+    books = load_ibooks(library_db, annotation_db)
+    grouped = kindle_cleaner.parse_kindle_annotations(clippings[0].read_text(encoding="utf-8"))
+
+    def normalize():
+        n = 0
+        for book in books.values():
+            normalize_title(book["title"])
+            normalize_filename(book["author"])
+            for a in book["annotations"]:
+                normalize_string(a["highlight"])
+                n += 1
+        for title, items in grouped.items():
+            kindle_cleaner.split_title_author(kindle_cleaner.normalize_title(title))
+            n += len(items)
+        return n
+
+    n = run_stage("normalize", normalize, lambda n: n)
+
+    assert n == sum(len(b["annotations"]) for b in books.values()) + clippings[1]
+
+
+# -------------------------
+# inspect_ibooks
+# -------------------------
+def test_assign_chapters(run_stage, inspect_ibooks, annotation_db):
+    df = inspect_ibooks.load_annotations(annotation_db)
+
+    chapters = run_stage("assign_chapters", lambda: inspect_ibooks.assign_chapters(df), len)
+
+    assert len(chapters) == len(df)
+    assert chapters["chapter"].notna().all()
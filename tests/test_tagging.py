@@ -0,0 +1,77 @@
+import random
+
+import pytest
+
+import tagging
+import warehouse
+
+WORDS = ("market trader risk hedge volatility momentum value growth discipline habit focus "
+         "essential priority boundary routine attention energy leverage clarity purpose").split()
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = tagging.connect(tmp_path / "warehouse.sqlite")
+    yield conn
+    conn.close()
+
+
+def fill(conn, n_books=10, per_book=40, seed=1):
+    rng = random.Random(seed)
+    book_ids = []
+    with conn:
+        source = warehouse.source_id(conn, "ibooks")
+        for b in range(n_books):
+            book_id = warehouse.upsert_book(conn, source, str(b), f"Book {b}", "Author")
+            warehouse.upsert_annotations(conn, book_id, [
+                {"fingerprint": f"{b}-{i}", "highlight": " ".join(rng.choice(WORDS) for _ in range(12))}
+                for i in range(per_book)
+            ])
+            book_ids.append(book_id)
+    return book_ids
+
+
+def test_first_refresh_tags_everything(conn):
+    fill(conn)
+
+    result = tagging.refresh(conn)
+
+    assert result["full"] == 1
+    assert result["added"] == 400
+    assert result["books"] == 10
+    assert tagging.refresh(conn) == {"added": 0, "removed": 0, "touched": 0, "full": 0,
+                                     "highlights": 0, "books": 0}
+
+
+def test_small_change_retags_only_the_touched_book(conn):
+    book_ids = fill(conn)
+    tagging.refresh(conn)
+
+    with conn:
+        records = [{"fingerprint": f"0-{i}", "highlight": row["highlight"]}
+                   for i, row in enumerate(warehouse.book_annotations(conn, book_ids[0]))]
+        warehouse.upsert_annotations(conn, book_ids[0], records[:-5])
+    result = tagging.refresh(conn)
+
+    assert result["full"] == 0
+    assert (result["added"], result["removed"], result["touched"]) == (0, 5, 1)
+    assert conn.execute("SELECT COUNT(*) FROM tag_docs WHERE book_id = ?", (book_ids[0],)).fetchone()[0] == 35
+
+
+def test_drift_or_retag_triggers_a_full_retag(conn):
+    fill(conn)
+    tagging.refresh(conn)
+
+    assert tagging.refresh(conn, retag=True)["full"] == 1
+
+    # a new book doubles the corpus, well past RETAG_DRIFT
+    with conn:
+        source = warehouse.source_id(conn, "kindle")
+        book_id = warehouse.upsert_book(conn, source, "new", "New Book", "Author")
+        warehouse.upsert_annotations(conn, book_id, [
+            {"fingerprint": f"new-{i}", "highlight": " ".join(WORDS[i % len(WORDS):] + WORDS[:3])} for i in range(400)
+        ])
+    result = tagging.refresh(conn)
+
+    assert result["full"] == 1
+    assert result["added"] == 400
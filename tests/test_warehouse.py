@@ -0,0 +1,70 @@
+import pytest
+
+import warehouse
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = warehouse.connect(tmp_path / "warehouse.sqlite")
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def book_id(conn):
+    with conn:
+        return warehouse.upsert_book(conn, warehouse.source_id(conn, "ibooks"), "asset-1", "Essentialism", "McKeown")
+
+
+def record(fingerprint, highlight, note=None):
+    return {"fingerprint": fingerprint, "highlight": highlight, "note": note, "chapter": "Part 1"}
+
+
+def rows(conn, book_id):
+    return {row["fingerprint"]: row for row in conn.execute(
+        "SELECT fingerprint, note, deleted, updated_at FROM annotations WHERE book_id = ?", (book_id,))}
+
+
+def test_upsert_touches_only_changed_rows(conn, book_id):
+    with conn:
+        warehouse.upsert_annotations(conn, book_id, [record("a", "Less but better."), record("b", "Explore.")])
+    before = rows(conn, book_id)
+
+    with conn:
+        stats = warehouse.upsert_annotations(conn, book_id, [
+            record("a", "Less but better."),
+            record("b", "Explore.", note="edited"),
+        ])
+
+    assert stats == {"inserted": 0, "updated": 1, "deleted": 0}
+    after = rows(conn, book_id)
+    assert after["a"]["updated_at"] == before["a"]["updated_at"]
+    assert after["b"]["note"] == "edited"
+    assert after["b"]["updated_at"] > before["b"]["updated_at"]
+
+
+def test_missing_rows_are_soft_deleted_and_revived(conn, book_id):
+    with conn:
+        warehouse.upsert_annotations(conn, book_id, [record("a", "Less but better."), record("b", "Explore.")])
+        stats = warehouse.upsert_annotations(conn, book_id, [record("a", "Less but better.")])
+
+    assert stats == {"inserted": 0, "updated": 0, "deleted": 1}
+    assert rows(conn, book_id)["b"]["deleted"] == 1
+    assert [row["fingerprint"] for row in warehouse.book_annotations(conn, book_id)] == ["a"]
+
+    with conn:
+        stats = warehouse.upsert_annotations(conn, book_id, [record("a", "Less but better."), record("b", "Explore.")])
+
+    assert stats == {"inserted": 1, "updated": 0, "deleted": 0}
+    assert rows(conn, book_id)["b"]["deleted"] == 0
+
+
+def test_fingerprints_are_scoped_to_the_book(conn, book_id):
+    with conn:
+        other = warehouse.upsert_book(conn, warehouse.source_id(conn, "ibooks"), "asset-2", "Essentialism", "McKeown")
+        warehouse.upsert_annotations(conn, book_id, [record("a", "Less but better.")])
+        warehouse.upsert_annotations(conn, other, [record("a", "Less but better.")])
+        warehouse.upsert_annotations(conn, book_id, [])
+
+    assert rows(conn, book_id)["a"]["deleted"] == 1
+    assert rows(conn, other)["a"]["deleted"] == 0